@@ -0,0 +1,253 @@
+# -*- coding: utf-8 -*-
+
+# GNU General Public License v3.0+ (see COPYING or
+# https://www.gnu.org/licenses/gpl-3.0.txt)
+
+# Mapping between the prefix of an ACI relative name (the part of a DN
+# segment before the first "-") and the ACI class of the object, used to
+# rebuild the object hierarchy of flat configuration dumps.
+#
+# A prefix may only map to one class. Where ACI reuses a prefix under
+# different parents (e.g. "instP" for l3extInstP and l2extInstP) the most
+# common class is listed; users can override entries with the
+# aci_class_map/aci_class_file options of nae_prechange.
+
+from __future__ import absolute_import, division, print_function
+__metaclass__ = type
+
+ACI_CLASS_PREFIXES = {
+    # Tenant, application profiles, EPGs, ESGs
+    "tn": "fvTenant",
+    "ap": "fvAp",
+    "epg": "fvAEPg",
+    "esg": "fvESg",
+    "crtrn": "fvCrtrn",
+    "ipattr": "fvIpAttr",
+    "macattr": "fvMacAttr",
+    "vmattr": "fvVmAttr",
+    "epselector": "fvEPSelector",
+    "epgselector": "fvEPgSelector",
+    "rsbd": "fvRsBd",
+    "rscons": "fvRsCons",
+    "rsconsIf": "fvRsConsIf",
+    "rsprov": "fvRsProv",
+    "rsprotBy": "fvRsProtBy",
+    "rsintraEpg": "fvRsIntraEpg",
+    "rssecInherited": "fvRsSecInherited",
+    "rsdomAtt": "fvRsDomAtt",
+    "rspathAtt": "fvRsPathAtt",
+    "rsnodeAtt": "fvRsNodeAtt",
+    "rscustQosPol": "fvRsCustQosPol",
+    "rsdppPol": "fvRsDppPol",
+    "rsscope": "fvRsScope",
+
+    # Networking: VRFs, bridge domains, subnets
+    "ctx": "fvCtx",
+    "BD": "fvBD",
+    "subnet": "fvSubnet",
+    "rsctx": "fvRsCtx",
+    "rsBDToOut": "fvRsBDToOut",
+    "rsBDToNdP": "fvRsBDToNdP",
+    "rsBDToProfile": "fvRsBDToProfile",
+    "rsigmpsn": "fvRsIgmpsn",
+    "rsbdToEpRet": "fvRsBdToEpRet",
+    "rsctxToEpRet": "fvRsCtxToEpRet",
+    "rsctxToOspfCtxPol": "fvRsCtxToOspfCtxPol",
+    "rsctxToExtRouteTagPol": "fvRsCtxToExtRouteTagPol",
+    "rsctxToBgpCtxAfPol": "fvRsCtxToBgpCtxAfPol",
+    "rsbgpCtxPol": "fvRsBgpCtxPol",
+    "rsvrfValidationPol": "fvRsVrfValidationPol",
+
+    # Contracts, filters, taboos
+    "any": "vzAny",
+    "rsanyToCons": "vzRsAnyToCons",
+    "rsanyToConsIf": "vzRsAnyToConsIf",
+    "rsanyToProv": "vzRsAnyToProv",
+    "brc": "vzBrCP",
+    "oobbrc": "vzOOBBrCP",
+    "subj": "vzSubj",
+    "intmnl": "vzInTerm",
+    "outtmnl": "vzOutTerm",
+    "rssubjFiltAtt": "vzRsSubjFiltAtt",
+    "rsfiltAtt": "vzRsFiltAtt",
+    "rsSubjGraphAtt": "vzRsSubjGraphAtt",
+    "flt": "vzFilter",
+    "e": "vzEntry",
+    "taboo": "vzTaboo",
+    "tsubj": "vzTSubj",
+    "rsdenyRule": "vzRsDenyRule",
+    "cif": "vzCPIf",
+    "rsif": "vzRsIf",
+
+    # L3Outs and routing protocols
+    "out": "l3extOut",
+    "rsectx": "l3extRsEctx",
+    "rsl3DomAtt": "l3extRsL3DomAtt",
+    "lnodep": "l3extLNodeP",
+    "rsnodeL3OutAtt": "l3extRsNodeL3OutAtt",
+    "lifp": "l3extLIfP",
+    "rspathL3OutAtt": "l3extRsPathL3OutAtt",
+    "mem": "l3extMember",
+    "instP": "l3extInstP",
+    "extsubnet": "l3extSubnet",
+    "rttag": "l3extRouteTagPol",
+    "conslbl": "l3extConsLbl",
+    "provlbl": "l3extProvLbl",
+    "rsinstPToProfile": "l3extRsInstPToProfile",
+    "bgpExtP": "bgpExtP",
+    "peerP": "bgpPeerP",
+    "as": "bgpAsP",
+    "localasn": "bgpLocalAsnP",
+    "bgpCtxP": "bgpCtxPol",
+    "bgpCtxAfP": "bgpCtxAfPol",
+    "ospfExtP": "ospfExtP",
+    "ospfIfP": "ospfIfP",
+    "rsIfPol": "ospfRsIfPol",
+    "ospfCtxP": "ospfCtxPol",
+    "ospfIfPol": "ospfIfPol",
+    "eigrpExtP": "eigrpExtP",
+    "eigrpIfP": "eigrpIfP",
+    "bfdIfP": "bfdIfP",
+    "rt": "ipRouteP",
+    "nh": "ipNexthopP",
+    "prof": "rtctrlProfile",
+    "attr": "rtctrlAttrP",
+    "rsctxPToSubjP": "rtctrlRsCtxPToSubjP",
+
+    # L2Outs
+    "l2out": "l2extOut",
+    "rsEBd": "l2extRsEBd",
+
+    # Tenant policies
+    "epRPol": "fvEpRetPol",
+    "ndifpol": "ndIfPol",
+    "ndpfxpol": "ndPfxPol",
+    "snPol": "igmpSnoopPol",
+    "hsrpIfPol": "hsrpIfPol",
+    "relayp": "dhcpRelayP",
+    "dhcplbl": "dhcpLbl",
+    "qoscustom": "qosCustomPol",
+    "qosdpppol": "qosDppPol",
+    "monepg": "monEPGPol",
+    "tagKey": "tagTag",
+    "annotationKey": "tagAnnotation",
+
+    # L4-L7 services
+    "lDevVip": "vnsLDevVip",
+    "lIf": "vnsLIf",
+    "cDev": "vnsCDev",
+    "cIf": "vnsCIf",
+    "rscIfAttN": "vnsRsCIfAttN",
+    "rsCIfPathAtt": "vnsRsCIfPathAtt",
+    "rsALDevToPhysDomP": "vnsRsALDevToPhysDomP",
+    "rsALDevToDomP": "vnsRsALDevToDomP",
+    "AbsGraph": "vnsAbsGraph",
+    "AbsNode": "vnsAbsNode",
+    "AbsTermNodeCon": "vnsAbsTermNodeCon",
+    "AbsTermNodeProv": "vnsAbsTermNodeProv",
+    "AbsConnection": "vnsAbsConnection",
+    "AbsFConn": "vnsAbsFuncConn",
+    "rsNodeToLDev": "vnsRsNodeToLDev",
+    "ldevCtx": "vnsLDevCtx",
+    "lIfCtx": "vnsLIfCtx",
+    "rsLDevCtxToLDev": "vnsRsLDevCtxToLDev",
+    "rsLIfCtxToBD": "vnsRsLIfCtxToBD",
+    "rsLIfCtxToLIf": "vnsRsLIfCtxToLIf",
+    "svcCont": "vnsSvcCont",
+    "svcRedirectPol": "vnsSvcRedirectPol",
+    "RedirectDest_ip": "vnsRedirectDest",
+
+    # Management
+    "mgmtp": "mgmtMgmtP",
+    "oob": "mgmtOoB",
+    "inb": "mgmtInB",
+    "rsooBStNode": "mgmtRsOoBStNode",
+    "rsinBStNode": "mgmtRsInBStNode",
+    "rsmgmtBD": "mgmtRsMgmtBD",
+    "instp": "mgmtInstP",
+    "rsooBCons": "mgmtRsOoBCons",
+    "rsooBProv": "mgmtRsOoBProv",
+    "extmgmt": "mgmtExtMgmtEntity",
+
+    # SPAN
+    "destgrp": "spanDestGrp",
+    "dest": "spanDest",
+    "srcgrp": "spanSrcGrp",
+    "src": "spanSrc",
+    "rssrcToEpg": "spanRsSrcToEpg",
+    "spanlbl": "spanSpanLbl",
+    "epgsummary": "spanEpgSummary",
+
+    # Access policies
+    "infra": "infraInfra",
+    "attentp": "infraAttEntityP",
+    "attenp": "infraAttEntityP",
+    "rsdomP": "infraRsDomP",
+    "gen": "infraGeneric",
+    "rsfuncToEpg": "infraRsFuncToEpg",
+    "nprof": "infraNodeP",
+    "leaves": "infraLeafS",
+    "nodeblk": "infraNodeBlk",
+    "rsaccNodePGrp": "infraRsAccNodePGrp",
+    "rsaccPortP": "infraRsAccPortP",
+    "accportprof": "infraAccPortP",
+    "hports": "infraHPortS",
+    "portblk": "infraPortBlk",
+    "subportblk": "infraSubPortBlk",
+    "rsaccBaseGrp": "infraRsAccBaseGrp",
+    "funcprof": "infraFuncP",
+    "accportgrp": "infraAccPortGrp",
+    "accbundle": "infraAccBndlGrp",
+    "rsattEntP": "infraRsAttEntP",
+    "rscdpIfPol": "infraRsCdpIfPol",
+    "rslldpIfPol": "infraRsLldpIfPol",
+    "rshIfPol": "infraRsHIfPol",
+    "rslacpPol": "infraRsLacpPol",
+    "rsmcpIfPol": "infraRsMcpIfPol",
+    "rsstpIfPol": "infraRsStpIfPol",
+    "rsl2IfPol": "infraRsL2IfPol",
+    "rsstormctrlIfPol": "infraRsStormctrlIfPol",
+    "rsmonIfInfraPol": "infraRsMonIfInfraPol",
+    "spprof": "infraSpineP",
+    "spines": "infraSpineS",
+    "rsspAccPortP": "infraRsSpAccPortP",
+    "spaccportprof": "infraSpAccPortP",
+    "shports": "infraSHPortS",
+    "spaccportgrp": "infraSpAccPortGrp",
+    "rsvlanNs": "infraRsVlanNs",
+    "vlanns": "fvnsVlanInstP",
+    "vxlanns": "fvnsVxlanInstP",
+    "from": "fvnsEncapBlk",
+    "hintfpol": "fabricHIfPol",
+    "cdpIfP": "cdpIfPol",
+    "lldpIfP": "lldpIfPol",
+    "lacplagp": "lacpLagPol",
+    "mcpIfP": "mcpIfPol",
+    "ifPol": "stpIfPol",
+    "l2IfP": "l2IfPol",
+    "stormctrlifp": "stormctrlIfPol",
+
+    # Domains
+    "phys": "physDomP",
+    "l3dom": "l3extDomP",
+    "l2dom": "l2extDomP",
+    "vmmp": "vmmProvP",
+    "dom": "vmmDomP",
+    "ctrlr": "vmmCtrlrP",
+    "usracc": "vmmUsrAccP",
+
+    # Fabric
+    "fabric": "fabricInst",
+    "protpol": "fabricProtPol",
+    "expgep": "fabricExplicitGEp",
+    "nodepep": "fabricNodePEp",
+    "controller": "ctrlrInst",
+    "nodeidentpol": "fabricNodeIdentPol",
+    "nodep": "fabricNodeIdentP",
+    "topology": "fabricTopology",
+    "pod": "fabricPod",
+    "node": "fabricNode",
+    "paths": "fabricPathEpCont",
+    "protpaths": "fabricProtPathEpCont",
+    "pathep": "fabricPathEp",
+}
@@ -33,25 +33,48 @@ from __future__ import (absolute_import, division, print_function)
 __metaclass__ = type
 
 from requests_toolbelt.multipart.encoder import MultipartEncoder
-from datetime import datetime
+from datetime import datetime, timezone
 import base64
+import codecs
+import io
+import bisect
 import requests
 import csv
 import json
 import os
+import random
+import re
 import sys
+import threading
 import time
 import gzip
+import zlib
 import filelock
 import pathlib
 import hashlib
+import math
+import mmap
+from array import array
+from collections import deque
+from itertools import chain
+from contextlib import contextmanager, nullcontext
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from copy import deepcopy
+from http.cookiejar import DefaultCookiePolicy
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+from urllib.parse import quote
 from ansible.module_utils.basic import AnsibleModule
 from ansible.module_utils.parsing.convert_bool import boolean
 from ansible.module_utils.urls import fetch_url
 from ansible.module_utils._text import to_bytes, to_native
-from jsonpath_ng import jsonpath, parse
-import requests
+from ansible_collections.cisco.nae.plugins.module_utils.aci_classes import ACI_CLASS_PREFIXES
+
+try:
+    import numpy as np
+    HAS_NUMPY = True
+except ImportError:
+    HAS_NUMPY = False
 
 def nae_argument_spec():
     return dict(
@@ -59,45 +82,1136 @@ def nae_argument_spec():
         port=dict(type='int', required=False, default=443),
         username=dict(type='str', default='admin', aliases=['user']),
         password=dict(type='str', no_log=True),
+        session_cache=dict(type='bool', default=False),
+        session_ttl=dict(type='int', default=900),
+        ag_cache_ttl=dict(type='int', default=60),
+        cache_dir=dict(type='path', default='~/.ansible/nae'),
+        page_size=dict(type='int', default=100),
     )
 
 
-class NAEModule(object):
+class AciClassRegistry(object):
+    """
+    Dict backed lookup of ACI classes by relative name prefix.
+
+    Starts from the bundled ACI_CLASS_PREFIXES table and can be extended or
+    overridden with user supplied mappings.
+    """
+
+    def __init__(self, prefixes=None):
+        self.prefixes = dict(ACI_CLASS_PREFIXES)
+        if prefixes:
+            self.update(prefixes)
+
+    def update(self, prefixes):
+        self.prefixes.update(prefixes)
+
+    def load(self, path):
+        """
+        Merge a JSON file holding a {"prefix": "aciClass"} object.
+        """
+        with open(path) as f:
+            self.update(json.load(f))
+
+    def get(self, prefix):
+        return self.prefixes.get(prefix, False)
+
+    @property
+    def version(self):
+        """
+        Digest of the effective mapping, changes whenever an entry does.
+        """
+        return hashlib.sha256(
+            json.dumps(self.prefixes, sort_keys=True).encode()).hexdigest()
+
+
+class TreeNode(object):
+    """
+    Node of the DN tree built by NAEModule.construct_tree.
+
+    data is None for dataless nodes, otherwise a (aci_class, attributes)
+    tuple. children is only allocated once the node gets a child.
+    """
+    __slots__ = ('name', 'data', 'children', 'existing_children')
+
+    def __init__(self, name, data=None):
+        self.name = name
+        self.data = data
+        self.children = None
+        self.existing_children = None
+
+
+class NAESessionCache(object):
+    """
+    On-disk store of authenticated NAE sessions.
+
+    Entries are keyed by host/port/username and hold the session cookie,
+    the CSRF token and the detected NAE version, so that later module
+    invocations can skip the login handshake until the session expires.
+    """
+
+    def __init__(self, cache_dir, ttl):
+        self.path = os.path.join(os.path.expanduser(cache_dir), 'sessions')
+        self.ttl = ttl
+
+    def _entry(self, host, port, username):
+        key = hashlib.sha256(
+            ('%s:%s:%s' % (host, port, username)).encode()).hexdigest()
+        return os.path.join(self.path, key + '.json')
+
+    def load(self, host, port, username):
+        entry = self._entry(host, port, username)
+        try:
+            with filelock.FileLock(entry + '.lock'):
+                with open(entry) as f:
+                    session = json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+        if session.get('expires', 0) <= time.time():
+            self.drop(host, port, username)
+            return None
+        return session
+
+    def save(self, host, port, username, cookie, csrf_token, version):
+        entry = self._entry(host, port, username)
+        session = dict(cookie=cookie,
+                       csrf_token=csrf_token,
+                       version=version,
+                       expires=time.time() + self.ttl)
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path, mode=0o700)
+        with filelock.FileLock(entry + '.lock'):
+            # The entry holds live credentials, keep it private to the user.
+            fd = os.open(entry, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, 'w') as f:
+                json.dump(session, f)
+
+    def drop(self, host, port, username):
+        try:
+            os.remove(self._entry(host, port, username))
+        except OSError:
+            pass
+
+
+def iter_response_body(resp, chunk_size=65536):
+    """
+    Yield the body of a response chunk by chunk, inflating gzip and deflate
+    encoded bodies incrementally instead of buffering the compressed payload.
+    """
+    encoding = (resp.headers.get('Content-Encoding') or '').lower()
+    decompressor = None
+    if encoding in ('gzip', 'deflate'):
+        # 32 + MAX_WBITS lets zlib detect the gzip or zlib header itself.
+        decompressor = zlib.decompressobj(32 + zlib.MAX_WBITS)
+    while True:
+        chunk = resp.read(chunk_size)
+        if not chunk:
+            break
+        if decompressor is not None:
+            chunk = decompressor.decompress(chunk)
+        if chunk:
+            yield chunk
+    if decompressor is not None:
+        tail = decompressor.flush()
+        if tail:
+            yield tail
+
+
+def read_json(resp):
+    """
+    Decode and parse a JSON response body exactly once.
+    """
+    body = bytearray()
+    for chunk in iter_response_body(resp):
+        body += chunk
+    return json.loads(body)
+
+
+def read_page(resp):
+    """
+    Return value.data and value.data_summary of an NAE API response.
+    """
+    value = read_json(resp)['value']
+    return value.get('data'), value.get('data_summary')
+
+
+def read_data(resp):
+    """
+    Return value.data of an NAE API response.
+    """
+    return read_page(resp)[0]
+
+
+class UploadManifest(object):
+    """
+    On-disk record of a chunked file upload, so that an interrupted upload
+    can be resumed instead of restarted.
+
+    The manifest lives at <cache_dir>/uploads/<key>.json. The key covers
+    the NAE host, the upload's unique name and the source file's path,
+    size and mtime, so a modified file never resumes a stale upload. It
+    holds the chunk and completion urls, the chunk size and, per
+    acknowledged chunk, its offset, size and checksum.
+    """
+
+    def __init__(self, cache_dir, host, port, name, filename):
+        st = os.stat(filename)
+        key = hashlib.sha256(('%s:%s:%s:%s:%d:%d' % (
+            host, port, name, os.path.abspath(filename),
+            st.st_size, int(st.st_mtime))).encode()).hexdigest()
+        self.path = os.path.join(os.path.expanduser(cache_dir), 'uploads', key + '.json')
+        self.entry = None
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                self.entry = json.load(f)
+        except (IOError, OSError, ValueError):
+            self.entry = None
+        return self.entry is not None
+
+    def start(self, chunk_url, chunk_size):
+        self.entry = dict(chunk_url=chunk_url,
+                          chunk_size=chunk_size,
+                          complete_url=None,
+                          chunks={})
+        self.save()
+
+    def acked(self, chunk_id):
+        return str(chunk_id) in self.entry['chunks']
+
+    def ack(self, chunk_id, offset, size, checksum, complete_url=None):
+        self.entry['chunks'][str(chunk_id)] = dict(offset=offset, size=size, checksum=checksum)
+        if complete_url:
+            self.entry['complete_url'] = complete_url
+        self.save()
+
+    def save(self):
+        if not os.path.isdir(os.path.dirname(self.path)):
+            os.makedirs(os.path.dirname(self.path), mode=0o700)
+        partial = '%s.%d.tmp' % (self.path, os.getpid())
+        with open(partial, 'w') as f:
+            json.dump(self.entry, f)
+        os.replace(partial, self.path)
+
+    def drop(self):
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
+def first_json_char(filename, block_size=4096):
+    """
+    First non-whitespace character of a JSON file, or '' if it is blank.
+    Only reads as far as that character.
+    """
+    with open(filename) as f:
+        for block in iter(lambda: f.read(block_size), ''):
+            block = block.lstrip(' \t\n\r')
+            if block:
+                return block[0]
+    return ''
+
+
+def file_digest(filename, block_size=8388608):
+    """
+    SHA-256 of a file's content, read in blocks.
+    """
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+# Parsed pre-change payloads not used for PRECHANGE_CACHE_MAX_AGE seconds are
+# evicted, then the least recently used ones until the cache fits in
+# PRECHANGE_CACHE_MAX_BYTES.
+PRECHANGE_CACHE_MAX_AGE = 604800
+PRECHANGE_CACHE_MAX_BYTES = 1073741824
+
+
+def prune_cache_dir(path, max_age, max_bytes):
+    """
+    Evict files from a cache directory by last use (mtime).
+
+    Files older than max_age seconds are removed, then the oldest of the
+    rest until their total size is within max_bytes. Temporary files are
+    left to their writer unless they are older than max_age.
+    """
+    entries = []
+    for name in os.listdir(path):
+        entry = os.path.join(path, name)
+        try:
+            st = os.stat(entry)
+        except OSError:
+            continue
+        entries.append((st.st_mtime, st.st_size, entry))
+    entries.sort(reverse=True)
+    now = time.time()
+    total = 0
+    for mtime, size, entry in entries:
+        if entry.endswith('.tmp') and now - mtime <= max_age:
+            continue
+        total += size
+        if now - mtime > max_age or total > max_bytes:
+            try:
+                os.remove(entry)
+            except OSError:
+                pass
+
+
+class UploadIndex(object):
+    """
+    Local index of files uploaded to an NAE appliance, by content.
+
+    Kept at <cache_dir>/uploads/index-<key>.json per host and port, it
+    maps content digests to the uploaded file's uuid and unique name,
+    records alias names that were resolved to an existing upload instead
+    of being uploaded again, and caches digests by path, size and mtime
+    so unchanged files are not hashed twice. Entries are hints only and
+    must be checked against the appliance before use.
+    """
+
+    def __init__(self, cache_dir, host, port):
+        key = hashlib.sha256(('%s:%s' % (host, port)).encode()).hexdigest()
+        self.path = os.path.join(os.path.expanduser(cache_dir), 'uploads', 'index-%s.json' % key)
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                index = json.load(f)
+        except (IOError, OSError, ValueError):
+            index = {}
+        for section in ('digests', 'aliases', 'files'):
+            index.setdefault(section, {})
+        return index
+
+    def _update(self, change):
+        if not os.path.isdir(os.path.dirname(self.path)):
+            os.makedirs(os.path.dirname(self.path), mode=0o700)
+        with filelock.FileLock(self.path + '.lock'):
+            index = self._load()
+            change(index)
+            partial = '%s.%d.tmp' % (self.path, os.getpid())
+            with open(partial, 'w') as f:
+                json.dump(index, f)
+            os.replace(partial, self.path)
+
+    def digest(self, filename):
+        st = os.stat(filename)
+        key = '%s:%d:%d' % (os.path.abspath(filename), st.st_size, int(st.st_mtime))
+        digest = self._load()['files'].get(key)
+        if digest is None:
+            digest = file_digest(filename)
+            self._update(lambda index: index['files'].__setitem__(key, digest))
+        return digest
+
+    def lookup(self, digest):
+        return self._load()['digests'].get(digest)
+
+    def add(self, digest, uuid, name):
+        self._update(lambda index: index['digests'].__setitem__(
+            digest, dict(uuid=uuid, unique_name=name)))
+
+    def drop(self, digest):
+        self._update(lambda index: index['digests'].pop(digest, None))
+
+    def alias(self, name, uuid):
+        self._update(lambda index: index['aliases'].__setitem__(name, uuid))
+
+    def resolve(self, name):
+        return self._load()['aliases'].get(name)
+
+
+# Upload chunk sizing: chunks are sized to take about UPLOAD_CHUNK_SECONDS
+# at the last throughput measured for the host, within these bounds.
+UPLOAD_CHUNK_MIN = 10000000
+UPLOAD_CHUNK_MAX = 200000000
+UPLOAD_CHUNK_SECONDS = 10
+
+
+def _tcam_dn(name):
+    return lambda item: item['bucket'][name]['dn'].replace("uni/", "")
+
+
+def _tcam_output(name, default=None):
+    return lambda item: item['output'].get(name, default)
+
+
+# CSV columns for TCAM exports, in default order: header -> row extractor
+TCAM_CSV_COLUMNS = {
+    'Provider EPG': _tcam_dn('provider_epg'),
+    'Consumer EPG': _tcam_dn('consumer_epg'),
+    'Consumer VRF': _tcam_dn('consumer_vrf'),
+    'Contract': _tcam_dn('contract'),
+    'Filter': _tcam_dn('filter'),
+    'Monthly Hits': _tcam_output('month_count', "N/A"),
+    'Total Hits': _tcam_output('cumulative_count'),
+    'TCAM Usage': _tcam_output('tcam_entry_count'),
+}
+
+
+class TcamDataset(object):
+    """
+    Column-oriented store of TCAM hit-count rows.
+
+    DNs are dictionary encoded: each distinct DN is stored once in dns and
+    rows hold its index. Counters are int64 columns, with -1 standing for
+    a missing month_count. Aggregations use numpy when it is installed and
+    fall back to plain loops over the integer columns otherwise.
+    """
+    KEYS = ('provider_epg', 'consumer_epg', 'consumer_vrf', 'contract', 'filter')
+    METRICS = ('tcam_entry_count', 'cumulative_count', 'month_count')
+    GROUPS = {
+        'contract': ('contract',),
+        'epg_pair': ('provider_epg', 'consumer_epg'),
+        'vrf': ('consumer_vrf',),
+        'filter': ('filter',),
+        'provider_epg': ('provider_epg',),
+        'consumer_epg': ('consumer_epg',),
+    }
+
+    def __init__(self):
+        self.dns = []
+        self.dn_ids = {}
+        self.columns = dict((k, array('l')) for k in self.KEYS)
+        self.columns.update((m, array('q')) for m in self.METRICS)
+
+    def __len__(self):
+        return len(self.columns['contract'])
+
+    def encode(self, dn):
+        dn = dn.replace("uni/", "")
+        code = self.dn_ids.get(dn)
+        if code is None:
+            code = self.dn_ids[dn] = len(self.dns)
+            self.dns.append(dn)
+        return code
+
+    def add_page(self, page):
+        for item in page:
+            bucket = item['bucket']
+            output = item['output']
+            for key in self.KEYS:
+                self.columns[key].append(self.encode(bucket[key]['dn']))
+            self.columns['tcam_entry_count'].append(output.get('tcam_entry_count') or 0)
+            self.columns['cumulative_count'].append(output.get('cumulative_count') or 0)
+            month_count = output.get('month_count')
+            self.columns['month_count'].append(-1 if month_count is None else month_count)
+
+    def row(self, i):
+        row = dict((key, self.dns[self.columns[key][i]]) for key in self.KEYS)
+        for metric in self.METRICS:
+            row[metric] = self.columns[metric][i]
+        if row['month_count'] < 0:
+            row['month_count'] = "N/A"
+        return row
+
+    def group_by(self, group, sort_by='tcam_entry_count', top=None):
+        """
+        Total the counters per group (see GROUPS), sorted descending by
+        sort_by. Returns a list of dicts with the group keys, the number
+        of rules and the summed counters.
+        """
+        keys = self.GROUPS[group]
+        if HAS_NUMPY:
+            groups = self._group_by_numpy(keys)
+        else:
+            groups = self._group_by_loop(keys)
+        groups.sort(key=lambda g: g[sort_by], reverse=True)
+        if top:
+            groups = groups[:top]
+        for g in groups:
+            for key in keys:
+                g[key] = self.dns[g[key]]
+        return groups
+
+    def _group_by_loop(self, keys):
+        totals = {}
+        key_columns = [self.columns[k] for k in keys]
+        metric_columns = [self.columns[m] for m in self.METRICS]
+        for i, codes in enumerate(zip(*key_columns)):
+            total = totals.get(codes)
+            if total is None:
+                total = totals[codes] = [0, 0, 0, 0]
+            total[0] += 1
+            for j, column in enumerate(metric_columns):
+                if column[i] > 0:
+                    total[j + 1] += column[i]
+        groups = []
+        for codes, total in totals.items():
+            g = dict(zip(keys, codes))
+            g['rules'] = total[0]
+            g.update(zip(self.METRICS, total[1:]))
+            groups.append(g)
+        return groups
+
+    def _group_by_numpy(self, keys):
+        if not len(self):
+            return []
+        width = len(self.dns)
+        combined = np.zeros(len(self), dtype=np.int64)
+        for key in keys:
+            combined = combined * width + np.frombuffer(self.columns[key], dtype=np.dtype(self.columns[key].typecode))
+        codes, inverse = np.unique(combined, return_inverse=True)
+        rules = np.bincount(inverse)
+        sums = []
+        for metric in self.METRICS:
+            values = np.frombuffer(self.columns[metric], dtype=np.int64)
+            # bincount weights are float64, sum in int64 to stay exact.
+            total = np.zeros(len(codes), dtype=np.int64)
+            np.add.at(total, inverse, np.maximum(values, 0))
+            sums.append(total)
+        groups = []
+        for n, code in enumerate(codes.tolist()):
+            parts = []
+            for key in keys:
+                code, part = divmod(code, width)
+                parts.append(part)
+            g = dict(zip(keys, reversed(parts)))
+            g['rules'] = int(rules[n])
+            for metric, total in zip(self.METRICS, sums):
+                g[metric] = int(total[n])
+            groups.append(g)
+        return groups
+
+    def zero_hit(self, top=None):
+        """
+        Rules with no hits, largest TCAM usage first.
+        """
+        if not len(self):
+            return []
+        if HAS_NUMPY:
+            hits = np.frombuffer(self.columns['cumulative_count'], dtype=np.int64)
+            usage = np.frombuffer(self.columns['tcam_entry_count'], dtype=np.int64)
+            idx = np.flatnonzero(hits == 0)
+            idx = idx[np.argsort(-usage[idx], kind='stable')].tolist()
+        else:
+            hits = self.columns['cumulative_count']
+            usage = self.columns['tcam_entry_count']
+            idx = sorted((i for i in range(len(hits)) if hits[i] == 0), key=lambda i: -usage[i])
+        if top:
+            idx = idx[:top]
+        return [self.row(i) for i in idx]
+
+
+def tcam_row(item):
+    """
+    Reduce a TCAM hit-count item to (key, counters): the five bucket DNs
+    and (tcam_entry_count, cumulative_count, month_count), with -1 for a
+    missing month_count.
+    """
+    bucket = item['bucket']
+    output = item['output']
+    key = tuple(bucket[k]['dn'].replace("uni/", "") for k in TcamDataset.KEYS)
+    month_count = output.get('month_count')
+    return key, (output.get('tcam_entry_count') or 0,
+                 output.get('cumulative_count') or 0,
+                 -1 if month_count is None else month_count)
+
+
+def tcam_item(key, counters):
+    """
+    Inverse of tcam_row, builds an item the TCAM csv columns can read.
+    """
+    output = dict(zip(TcamDataset.METRICS, counters))
+    if output['month_count'] < 0:
+        del output['month_count']
+    return {'bucket': dict((k, {'dn': dn}) for k, dn in zip(TcamDataset.KEYS, key)),
+            'output': output}
+
+
+class TcamSnapshotStore(object):
+    """
+    On-disk TCAM hit-count snapshots.
+
+    One gzipped JSON-lines file per fabric and epoch, at
+    <cache_dir>/tcam/<fabric_id>/<epoch_id>.jsonl.gz. Each line is a row
+    of the five bucket DNs followed by the three counters, as returned by
+    tcam_row.
+    """
+
+    def __init__(self, cache_dir):
+        self.path = os.path.join(os.path.expanduser(cache_dir), 'tcam')
+
+    def _entry(self, fabric_id, epoch_id):
+        return os.path.join(self.path, str(fabric_id), '%s.jsonl.gz' % epoch_id)
+
+    def exists(self, fabric_id, epoch_id):
+        return os.path.isfile(self._entry(fabric_id, epoch_id))
+
+    def load(self, fabric_id, epoch_id):
+        rows = {}
+        with gzip.open(self._entry(fabric_id, epoch_id), 'rt') as f:
+            for line in f:
+                row = json.loads(line)
+                rows[tuple(row[:5])] = tuple(row[5:])
+        return rows
+
+    @contextmanager
+    def writer(self, fabric_id, epoch_id):
+        """
+        Context manager yielding a write(key, counters) callable. The
+        snapshot only replaces any existing one once the block completes.
+        """
+        entry = self._entry(fabric_id, epoch_id)
+        if not os.path.isdir(os.path.dirname(entry)):
+            os.makedirs(os.path.dirname(entry))
+        partial = '%s.%d.tmp' % (entry, os.getpid())
+        try:
+            with gzip.open(partial, 'wt') as f:
+                yield lambda key, counters: f.write(json.dumps(key + counters) + '\n')
+            os.replace(partial, entry)
+        except BaseException:
+            if os.path.exists(partial):
+                os.remove(partial)
+            raise
+
+    def prune(self, fabric_id, keep, epoch_ids):
+        """
+        Keep the snapshots of the keep most recent epochs. epoch_ids lists
+        the fabric's epochs newest first; snapshots of epochs no longer in
+        it are older than any listed one and go first.
+        """
+        path = os.path.join(self.path, str(fabric_id))
+        rank = dict((str(epoch_id), n) for n, epoch_id in enumerate(epoch_ids))
+        snapshots = [f[:-len('.jsonl.gz')] for f in os.listdir(path) if f.endswith('.jsonl.gz')]
+        snapshots.sort(key=lambda epoch_id: rank.get(epoch_id, len(rank)))
+        for epoch_id in snapshots[keep:]:
+            os.remove(self._entry(fabric_id, epoch_id))
+
+
+def find_item(pages, **match):
+    """
+    Return the first item of an iterable of pages whose fields equal all
+    of match, or None. Stops consuming pages at the first hit.
+    """
+    for page in pages:
+        for item in page:
+            if all(item.get(k) == v for k, v in match.items()):
+                return item
+    return None
+
+
+def _first(d, *keys):
+    for key in keys:
+        if d.get(key) not in (None, ''):
+            return d[key]
+    return None
+
+
+# Epoch indexes are rebuilt from scratch once a day, to drop epochs NAE has
+# since expired.
+EPOCH_INDEX_RESYNC = 86400
+
+
+def epoch_timestamp(epoch):
+    """
+    Collection time of an epoch, in milliseconds since the Unix epoch.
+    Raises ValueError if the epoch carries no collection timestamp, as it
+    could not be ordered.
+    """
+    timestamp = _first(epoch, 'collection_timestamp', 'collectionTimestamp')
+    if timestamp is None:
+        raise ValueError('Epoch %s has no collection timestamp' % epoch.get('epoch_id'))
+    return int(timestamp)
+
+
+class EpochIndex(object):
+    """
+    Locally persisted index of the epochs of one assurance group.
+
+    Stored at <cache_dir>/epochs/<key>.json, keyed by host, port and
+    fabric id. Epochs are kept oldest first together with a parallel list
+    of their collection timestamps (milliseconds), so the latest and
+    previous epochs are direct lookups and the last epoch at or before a
+    point in time is a binary search.
+    """
+
+    def __init__(self, cache_dir, host, port, fabric_id):
+        key = hashlib.sha256(('%s:%s:%s' % (host, port, fabric_id)).encode()).hexdigest()
+        self.path = os.path.join(os.path.expanduser(cache_dir), 'epochs', key + '.json')
+        self.epochs = []
+        self.timestamps = []
+        self.by_id = {}
+        self.synced = 0
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                entry = json.load(f)
+        except (IOError, OSError, ValueError):
+            return False
+        self.synced = entry.get('synced', 0)
+        self.update(entry.get('epochs', []), replace=True)
+        return True
+
+    def save(self):
+        if not os.path.isdir(os.path.dirname(self.path)):
+            os.makedirs(os.path.dirname(self.path), mode=0o700)
+        partial = '%s.%d.tmp' % (self.path, os.getpid())
+        with open(partial, 'w') as f:
+            json.dump(dict(synced=self.synced, epochs=self.epochs), f)
+        os.replace(partial, self.path)
+
+    def update(self, epochs, replace=False):
+        """
+        Add epochs, in any order, or replace the index with them.
+        """
+        if replace:
+            merged = list(epochs)
+        else:
+            merged = self.epochs + [e for e in epochs if e['epoch_id'] not in self.by_id]
+        merged.sort(key=epoch_timestamp)
+        self.epochs = merged
+        self.timestamps = [epoch_timestamp(e) for e in merged]
+        self.by_id = dict((e['epoch_id'], e) for e in merged)
+
+    def latest(self):
+        return self.previous(0)
+
+    def previous(self, n=1):
+        """
+        The epoch n before the latest one, or None.
+        """
+        if n < 0 or n >= len(self.epochs):
+            return None
+        return self.epochs[-1 - n]
+
+    def get(self, epoch_id):
+        return self.by_id.get(epoch_id)
+
+    def at_or_before(self, timestamp):
+        """
+        The last epoch collected at or before timestamp (milliseconds), or
+        None if all epochs are newer.
+        """
+        i = bisect.bisect_right(self.timestamps, timestamp)
+        return self.epochs[i - 1] if i else None
+
+
+SMART_EVENT_CATEGORIES = ('ADC', 'CHANGE_ANALYSIS', 'TENANT_ENDPOINT', 'TENANT_FORWARDING',
+                          'TENANT_SECURITY', 'RESOURCE_UTILIZATION', 'SYSTEM', 'COMPLIANCE')
+SMART_EVENT_SEVERITIES = ('EVENT_SEVERITY_CRITICAL', 'EVENT_SEVERITY_MAJOR', 'EVENT_SEVERITY_MINOR',
+                          'EVENT_SEVERITY_WARNING', 'EVENT_SEVERITY_INFO')
+
+
+# Fields of a delta aggregate-table row that describe one epoch, or the
+# row's place in the delta, rather than the smart event itself.
+SMART_EVENT_EPOCH_FIELDS = ('count', 'epoch_status', 'epoch1_details', 'epoch2_details')
+SMART_EVENT_CHANGES = ('added', 'removed', 'count_changed', 'unchanged')
+
+
+def smart_event(row, side):
+    """
+    One epoch's side ('epoch1_details' or 'epoch2_details') of a delta
+    aggregate-table row.
+
+    The event is the row without its per-epoch fields, plus the severity
+    and count that side's details give it.
+    """
+    details = row.get(side) or {}
+    event = dict((k, v) for k, v in row.items() if k not in SMART_EVENT_EPOCH_FIELDS)
+    event['severity'] = details.get('severity')
+    event['count'] = int(details.get('count') or 0)
+    return event
+
+
+def diff_smart_events(rows):
+    """
+    Diff the smart events of the two epochs of a delta aggregate table.
+
+    Each row is classified by its epoch_status alone: EPOCH1_ONLY rows
+    were removed, EPOCH2_ONLY rows added, and BOTH_EPOCHS rows are
+    unchanged or count_changed (with their prior_count) depending on the
+    counts of their two sides. Rows are never matched with each other.
+    Returns the four lists and a summary of their sizes, overall and by
+    severity. Raises ValueError on any other epoch_status.
+    """
+    diff = dict((change, []) for change in SMART_EVENT_CHANGES)
+    for row in rows:
+        status = row.get('epoch_status')
+        if status == 'EPOCH1_ONLY':
+            diff['removed'].append(smart_event(row, 'epoch1_details'))
+        elif status == 'EPOCH2_ONLY':
+            diff['added'].append(smart_event(row, 'epoch2_details'))
+        elif status == 'BOTH_EPOCHS':
+            before = smart_event(row, 'epoch1_details')
+            event = smart_event(row, 'epoch2_details')
+            if before['count'] == event['count']:
+                diff['unchanged'].append(event)
+            else:
+                diff['count_changed'].append(dict(event, prior_count=before['count']))
+        else:
+            raise ValueError('unknown epoch_status %r' % (status,))
+    summary = dict((change, len(diff[change])) for change in SMART_EVENT_CHANGES)
+    summary['by_severity'] = {}
+    for change in SMART_EVENT_CHANGES:
+        for event in diff[change]:
+            severity = summary['by_severity'].setdefault(
+                event['severity'], dict((c, 0) for c in SMART_EVENT_CHANGES))
+            severity[change] += 1
+    diff['summary'] = summary
+    return diff
+
+
+def wait_for(probe, timeout, initial_delay=2, max_delay=30, factor=2, jitter=0.25):
+    """
+    Poll probe() until it returns something other than None.
+
+    The delay between polls starts at initial_delay seconds and grows by
+    factor up to max_delay, each delay randomized by +/- jitter so that
+    concurrent waiters do not poll in lockstep. Returns the probe result,
+    or None once timeout seconds have elapsed (no timeout if it is None).
+    """
+    deadline = None if timeout is None else time.time() + timeout
+    delay = initial_delay
+    while True:
+        result = probe()
+        if result is not None:
+            return result
+        now = time.time()
+        if deadline is not None and now >= deadline:
+            return None
+        pause = delay * random.uniform(1 - jitter, 1 + jitter)
+        if deadline is not None:
+            pause = min(pause, deadline - now)
+        time.sleep(pause)
+        delay = min(delay * factor, max_delay)
+
+
+def iter_json_array_items(chunks, decoder=None, single=False):
+    """
+    Lazily yield the items of the top-level JSON array(s) in a stream of
+    text chunks.
+
+    Items are decoded with JSONDecoder.raw_decode over a sliding window, so
+    each item is parsed once and only the item being decoded is held in
+    memory. Items (and escape sequences) may span chunk boundaries.
+    Several consecutive top-level arrays are treated as one, unless single
+    is set, in which case the input after the first array is ignored.
+    """
+    decoder = decoder or json.JSONDecoder()
+    chunks = iter(chunks)
+    buf = ''
+    pos = 0
+    eof = False
+    in_array = False
+    expect_item = False
+    allow_close = False
+
+    while True:
+        while pos < len(buf) and buf[pos] in ' \t\n\r':
+            pos += 1
+        if pos == len(buf):
+            if eof:
+                break
+            buf = next(chunks, None)
+            if buf is None:
+                buf = ''
+                eof = True
+            pos = 0
+            continue
+
+        c = buf[pos]
+        if not in_array:
+            if c != '[':
+                raise ValueError("Expected '[' at top level, found %r" % c)
+            in_array = expect_item = allow_close = True
+            pos += 1
+            continue
+        if expect_item and c == ']' and allow_close:
+            if single:
+                return
+            in_array = False
+            pos += 1
+            continue
+        if not expect_item:
+            if c == ',':
+                expect_item = True
+                allow_close = False
+            elif c == ']':
+                if single:
+                    return
+                in_array = False
+            else:
+                raise ValueError("Expected ',' or ']', found %r" % c)
+            pos += 1
+            continue
+
+        # A decode failure, or a number not yet followed by a delimiter, may
+        # only mean the item is incomplete: grow the window geometrically
+        # and retry until the input is exhausted.
+        while True:
+            try:
+                item, end = decoder.raw_decode(buf, pos)
+                if eof or not isinstance(item, (int, float)):
+                    break
+                if end < len(buf) and buf[end] in ' \t\n\r,]':
+                    break
+            except ValueError:
+                if eof:
+                    raise
+            parts = [buf[pos:]]
+            want = 2 * len(parts[0])
+            size = 0
+            while size == 0 or size < want:
+                chunk = next(chunks, None)
+                if chunk is None:
+                    eof = True
+                    break
+                parts.append(chunk)
+                size += len(chunk)
+            buf = ''.join(parts)
+            pos = 0
+        pos = end
+        expect_item = False
+        yield item
+
+    if in_array:
+        raise ValueError('Unterminated JSON array')
+
+
+def iter_json_key_array(chunks, key, decoder=None):
+    """
+    Lazily yield the items of the array value of the first occurrence of
+    key in a stream of JSON text chunks. Everything before the array is
+    skipped without being decoded and everything after it is not read.
+    """
+    pattern = re.compile(r'"%s"\s*:\s*(?=\[)' % re.escape(key))
+    chunks = iter(chunks)
+    buf = ''
+    for chunk in chunks:
+        buf += chunk
+        match = pattern.search(buf)
+        if match:
+            break
+        # Keep enough of the tail for a key split across chunks.
+        buf = buf[-(len(key) + 64):]
+    else:
+        raise ValueError('No "%s" array found' % key)
+    for item in iter_json_array_items(chain([buf[match.end():]], chunks), decoder, single=True):
+        yield item
+
+
+class NAEResponse(object):
+    """
+    File-like wrapper around a requests response.
+
+    It mirrors what fetch_url hands back: headers only carries the first
+    Set-Cookie value. A streamed response's read() returns the body exactly
+    as sent on the wire (Content-Encoding is left to the caller) and holds
+    its connection until closed. Otherwise the body was already read, and
+    decoded, by requests and the connection is back in the pool.
+    """
+
+    def __init__(self, response, stream=False):
+        self.response = response
+        self.status = response.status_code
+        self.headers = CaseInsensitiveDict(response.headers)
+        cookies = response.raw.headers.getlist('Set-Cookie')
+        if cookies:
+            self.headers['Set-Cookie'] = cookies[0]
+        self.body = None
+        if not stream:
+            self.body = io.BytesIO(response.content)
+            self.headers.pop('Content-Encoding', None)
+
+    def read(self, amt=None):
+        if self.body is not None:
+            return self.body.read(amt)
+        return self.response.raw.read(amt, decode_content=False)
+
+    def close(self):
+        self.response.close()
+
+
+class RequestsTransport(object):
+    """
+    Pooled keep-alive HTTP transport.
+
+    Bodies are read as soon as the response arrives, which returns the
+    connection to the pool even when the caller ignores the response.
+    Callers that parse a body incrementally pass stream=True and must
+    close the response.
+
+    A single requests session (and so a single connection pool) is shared by
+    every NAEModule in the process, so consecutive and concurrent requests
+    to the same NAE pay the TCP/TLS handshake once. Cookies are never stored
+    in the shared session, authentication is carried by the NAEModule
+    headers only.
+    """
+    _sessions = {}
+
+    def __init__(self, validate_certs=True, pool_size=16, timeout=10):
+        self.validate_certs = validate_certs
+        self.timeout = timeout
+        if pool_size not in self._sessions:
+            session = requests.Session()
+            session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            self._sessions[pool_size] = session
+        self.session = self._sessions[pool_size]
+
+    def request(self, method, url, headers=None, data=None, files=None, timeout=-1, stream=False):
+        info = dict(url=url)
+        try:
+            response = self.session.request(method, url,
+                                            headers=headers,
+                                            data=data,
+                                            files=files,
+                                            verify=self.validate_certs,
+                                            timeout=self.timeout if timeout == -1 else timeout,
+                                            stream=stream)
+        except requests.exceptions.RequestException as e:
+            info.update(status=-1, msg='Request failed: %s' % to_native(e))
+            return None, info
+
+        info['status'] = response.status_code
+        info.update((k.lower(), v) for k, v in response.headers.items())
+        if response.status_code >= 400:
+            info['msg'] = 'HTTP Error %s: %s' % (response.status_code, response.reason)
+            info['body'] = response.text
+            stream = False
+        else:
+            info['msg'] = 'OK (%s bytes)' % response.headers.get('Content-Length', 'unknown')
+        return NAEResponse(response, stream), info
+
+
+class FetchUrlTransport(object):
+    """
+    Transport built on Ansible's fetch_url, one connection per request.
+    """
+
     def __init__(self, module):
         self.module = module
+
+    def request(self, method, url, headers=None, data=None, files=None, timeout=-1, stream=False):
+        if files is not None:
+            # MultipartEncoder only takes str, bytes or file objects, so
+            # views (upload chunks) are copied out here.
+            files = dict((name, tuple(bytes(v) if isinstance(v, memoryview) else v for v in field))
+                         for name, field in files.items())
+            m = MultipartEncoder(fields=files)
+            headers = dict(headers or {}, **{'Content-Type': m.content_type})
+            data = m.to_string()
+        kwargs = {}
+        if timeout != -1:
+            kwargs['timeout'] = timeout
+        return fetch_url(self.module, url,
+                         headers=headers,
+                         data=data,
+                         method=method,
+                         **kwargs)
+
+
+class NAEItemExit(BaseException):
+    """
+    Raised in place of exit_json/fail_json by NAEItemModule. Like the
+    SystemExit it stands in for, it is not an Exception, so it passes
+    through the generic error handlers of the code it interrupts.
+    """
+
+    def __init__(self, failed, result):
+        super(NAEItemExit, self).__init__(result.get('msg'))
+        self.failed = failed
+        self.result = result
+
+
+class NAEItemModule(object):
+    """
+    Stand-in for the AnsibleModule while one item of a batch is processed,
+    possibly on a worker thread. exit_json and fail_json raise NAEItemExit
+    instead of printing the module result and exiting, everything else is
+    delegated to the real module.
+    """
+
+    def __init__(self, module, params):
+        self._module = module
+        self.params = params
+
+    def __getattr__(self, name):
+        return getattr(self._module, name)
+
+    def exit_json(self, **kwargs):
+        raise NAEItemExit(False, kwargs)
+
+    def fail_json(self, msg=None, **kwargs):
+        kwargs['msg'] = msg
+        raise NAEItemExit(True, kwargs)
+
+
+class NAEModule(object):
+    def __init__(self, module, transport=None):
+        self.module = module
         self.resp = {}
         self.params = module.params
         self.result = dict(changed=False)
         self.files = []
         self.assuranceGroups = []
+        self.ag_by_name = {}
+        self.ag_by_uuid = {}
+        self.ag_index_time = None
+        self.aci_classes = AciClassRegistry()
         self.offlineAnalysis = []
         self.session_cookie = ""
+        self.session_cache = None
+        self.session_restored = False
+        self.parent = None
+        self.epoch_indexes = {}
+        self.batch_status_lock = threading.Lock()
+        self.login_lock = threading.Lock()
         self.error = dict(code=None, text=None)
         self.version = ""
+        if transport is None:
+            transport = RequestsTransport(
+                validate_certs=self.params.get('validate_certs', True))
+        self.transport = transport
         self.http_headers = {
             'Accept': 'application/json, text/plain, */*',
-            'Accept-Encoding': 'gzip, deflate, br',
+            'Accept-Encoding': 'gzip, deflate',
             'Accept-Language': 'en-GB,en-US;q=0.9,en;q=0.8,it;q=0.7',
             'Sec-Fetch-Mode': 'cors',
             'Sec-Fetch-Site': 'same-origin',
             'Host': self.params.get('host'),
             'Content-Type': 'application/json;charset=utf-8',
             'Connection': 'keep-alive'}
-        self.login()
+        if self.params.get('session_cache'):
+            self.session_cache = NAESessionCache(
+                self.params.get('cache_dir'), self.params.get('session_ttl'))
+        if not self.restore_session():
+            self.login()
 
     def __del__(self):
+        if getattr(self, 'parent', None) is not None:
+            # Batch items share their parent's session.
+            return
+        if getattr(self, 'session_cache', None) is not None:
+            # Keep the session alive for the next task, NAE expires idle
+            # sessions on its own.
+            self.save_session()
+            return
         url = 'https://%(host)s:%(port)s/nae/api/v1/logout' % self.params
-        resp, auth = fetch_url(self.module, url,
-                        headers=self.http_headers,
-                        data=None,
-                        method='POST')
+        resp, auth = self.transport.request('POST', url,
+                                            headers=self.http_headers)
         #self.module.fail_json(msg="LOGOUG", **self.result)
 
     def login(self):
+        """
+        Log in and install the new session in self.http_headers.
+
+        The handshake runs on a private copy of the headers, so that other
+        threads sending with self.http_headers never see a half-built
+        session.
+        """
+        headers = self.http_headers.copy()
+        headers.pop('X-NAE-CSRF-TOKEN', None)
         url = 'https://%(host)s:%(port)s/nae/api/v1/whoami' % self.params
-        resp, auth = fetch_url(self.module, url,
-                               data=None,
-                               method='GET')
+        resp, auth = self.transport.request('GET', url)
 
         if auth.get('status') != 200:
             if('filename' in self.params):
@@ -116,14 +1230,13 @@ class NAEModule(object):
         url = 'https://%(host)s:%(port)s/nae/api/v1/login' % self.params
         user_credentials = json.dumps({"username": self.params.get(
             'username'), "password": self.params.get('password'), "domain": 'Local'})
-        self.http_headers['Cookie'] = resp.headers.get('Set-Cookie')
+        headers['Cookie'] = resp.headers.get('Set-Cookie')
         self.session_cookie = resp.headers.get('Set-Cookie')
-        self.http_headers['X-NAE-LOGIN-OTP'] = resp.headers.get(
+        headers['X-NAE-LOGIN-OTP'] = resp.headers.get(
             'X-NAE-LOGIN-OTP')
-        resp, auth = fetch_url(self.module, url,
-                               headers=self.http_headers,
-                               data=user_credentials,
-                               method='POST')
+        resp, auth = self.transport.request('POST', url,
+                                            headers=headers,
+                                            data=user_credentials)
 
         if auth.get('status') != 200:
             if('filename' in self.params):
@@ -134,16 +1247,15 @@ class NAEModule(object):
                     auth.get('body'))['messages'][0]['message'],
                 **self.result)
 
-        self.http_headers['X-NAE-CSRF-TOKEN'] = resp.headers['X-NAE-CSRF-TOKEN']
+        headers['X-NAE-CSRF-TOKEN'] = resp.headers['X-NAE-CSRF-TOKEN']
 
         # # Update with the authenticated Cookie
-        self.http_headers['Cookie'] = resp.headers.get('Set-Cookie')
+        headers['Cookie'] = resp.headers.get('Set-Cookie')
 
         # Remove the LOGIN-OTP from header, it is only needed at the beginning
-        self.http_headers.pop('X-NAE-LOGIN-OTP', None)
+        headers.pop('X-NAE-LOGIN-OTP', None)
         url = 'https://%(host)s:%(port)s/nae/api/v1/event-services/candid-version' % self.params
-        resp, auth = fetch_url(
-            self.module, url, headers=self.http_headers, data=None, method='GET')
+        resp, auth = self.transport.request('GET', url, headers=headers)
         if auth.get('status') != 200:
             if('filename' in self.params):
                 self.params['file'] = self.params['filename']
@@ -157,15 +1269,96 @@ class NAEModule(object):
                 self.fail_json(
                     msg='Connection failed for %(url)s. %(msg)s' %
                     auth, **self.result)
-        self.version = json.loads(
-            resp.read())['value']['data']['candid_version']
+        self.version = read_data(resp)['candid_version']
+        self.http_headers.update({'Cookie': headers['Cookie'],
+                                  'X-NAE-CSRF-TOKEN': headers['X-NAE-CSRF-TOKEN']})
+        self.save_session()
         # self.result['response'] = data
 
+    def restore_session(self):
+        """
+        Reuse a cached session (cookie, CSRF token and version) if one
+        exists for this host/port/username and has not expired.
+        """
+        if self.session_cache is None:
+            return False
+        session = self.session_cache.load(self.params.get('host'),
+                                          self.params.get('port'),
+                                          self.params.get('username'))
+        if session is None:
+            return False
+        self.http_headers['Cookie'] = session['cookie']
+        self.http_headers['X-NAE-CSRF-TOKEN'] = session['csrf_token']
+        self.session_cookie = session['cookie']
+        self.version = session['version']
+        self.session_restored = True
+        return True
+
+    def save_session(self):
+        if self.session_cache is None or not self.http_headers.get('X-NAE-CSRF-TOKEN'):
+            return
+        self.session_cache.save(self.params.get('host'),
+                                self.params.get('port'),
+                                self.params.get('username'),
+                                self.http_headers.get('Cookie'),
+                                self.http_headers.get('X-NAE-CSRF-TOKEN'),
+                                self.version)
+
+    def send(self, url, data=None, headers=None, method='GET', files=None, timeout=-1, stream=False):
+        """
+        Issue an authenticated request through the transport.
+
+        When the session was restored from the session cache and NAE rejects
+        it, the cached entry is dropped, a fresh login is done and the
+        request is retried once. Concurrent callers (worker threads, batch
+        items) log in one at a time, and a caller whose token was already
+        replaced by another thread's login just retries with the new one.
+        stream is passed to the transport.
+        """
+        if headers is None:
+            headers = self.http_headers
+        token = headers.get('X-NAE-CSRF-TOKEN')
+        resp, auth = self.transport.request(method, url,
+                                            headers=headers,
+                                            data=data,
+                                            files=files,
+                                            timeout=timeout,
+                                            stream=stream)
+        relogged = token != self.http_headers.get('X-NAE-CSRF-TOKEN')
+        if auth.get('status') in (401, 403) and (self.session_restored or relogged):
+            with self.login_lock:
+                if self.http_headers.get('X-NAE-CSRF-TOKEN') == token:
+                    if self.session_cache is not None:
+                        self.session_cache.drop(self.params.get('host'),
+                                                self.params.get('port'),
+                                                self.params.get('username'))
+                    self.login()
+                self.session_restored = False
+                cookie = self.http_headers['Cookie']
+                token = self.http_headers['X-NAE-CSRF-TOKEN']
+            # Streamed bodies (multipart uploads) are consumed by the first
+            # attempt and cannot be replayed.
+            if hasattr(data, 'read'):
+                return resp, auth
+            if headers is not self.http_headers:
+                headers['Cookie'] = cookie
+                headers['X-NAE-CSRF-TOKEN'] = token
+            resp, auth = self.transport.request(method, url,
+                                                headers=headers,
+                                                data=data,
+                                                files=files,
+                                                timeout=timeout,
+                                                stream=stream)
+        return resp, auth
+
     def get_logout_lock(self):
         # This lock has been introduced because logout and file upload cannot be
         # done in parallel. This is because logout incorrectly aborts all file
         # uploads by a user (not just that session). So, this lock must be
         # acquired for logout and file upload.
+        if self.parent is not None:
+            # Batch items upload under the lock held by their parent.
+            return nullcontext()
         lock_filename = "logout.lock"
         try:
             pathlib.Path(lock_filename).touch(exist_ok=False)
@@ -173,9 +1366,18 @@ class NAEModule(object):
             pass
         return filelock.FileLock(lock_filename)
 
-    def get_all_assurance_groups(self):
+    def get_all_assurance_groups(self, refresh=False):
+        """
+        Fetch the assurance groups and index them by unique_name and uuid.
+
+        The index is reused for ag_cache_ttl seconds, pass refresh=True to
+        force a new fetch.
+        """
+        ttl = self.params.get('ag_cache_ttl') or 0
+        if not refresh and self.ag_index_time is not None and time.time() - self.ag_index_time < ttl:
+            return self.assuranceGroups
         url = 'https://%(host)s:%(port)s/nae/api/v1/config-services/assured-networks/aci-fabric/' % self.params
-        resp, auth = fetch_url(self.module, url,
+        resp, auth = self.send(url,
                                headers=self.http_headers,
                                data=None,
                                method='GET')
@@ -189,29 +1391,31 @@ class NAEModule(object):
                     auth.get('body'))['messages'][0]['message'],
                 **self.result)
 
-        if resp.headers['Content-Encoding'] == "gzip":
-            r = gzip.decompress(resp.read())
-            self.assuranceGroups = json.loads(r.decode())['value']['data']
-            return
-        self.assuranceGroups = json.loads(resp.read())['value']['data']
+        self.assuranceGroups = read_data(resp)
+        self.ag_by_name = dict((ag['unique_name'], ag) for ag in self.assuranceGroups)
+        self.ag_by_uuid = dict((ag['uuid'], ag) for ag in self.assuranceGroups)
+        self.ag_index_time = time.time()
+        return self.assuranceGroups
+
+    def invalidate_assurance_groups(self):
+        self.ag_index_time = None
 
     def get_assurance_group(self, name):
         self.get_all_assurance_groups()
-        for ag in self.assuranceGroups:
-            if ag['unique_name'] == name:
-                return ag
-        return None
+        return self.ag_by_name.get(name)
+
+    def get_assurance_group_by_uuid(self, uuid):
+        self.get_all_assurance_groups()
+        return self.ag_by_uuid.get(uuid)
 
     def deleteAG(self):
         ag = self.get_assurance_group(self.params.get('name'))
         if ag == None:
             self.result['Result'] = "No such Assurance Group exists"
         else:
-            self.params['uuid'] = str(
-                self.get_assurance_group(
-                    self.params.get('name'))['uuid'])
+            self.params['uuid'] = str(ag['uuid'])
             url = 'https://%(host)s:%(port)s/nae/api/v1/config-services/assurance-group/fabric/%(uuid)s' % self.params
-            resp, auth = fetch_url(self.module, url,
+            resp, auth = self.send(url,
                                 headers=self.http_headers,
                                 data=None,
                                 method='DELETE')
@@ -228,7 +1432,8 @@ class NAEModule(object):
                     self.fail_json(
                         msg='Connection failed for %(url)s. %(msg)s' %
                         auth, **self.result)
-            if json.loads(resp.read())['success'] is True:
+            self.invalidate_assurance_groups()
+            if read_json(resp)['success'] is True:
                 self.result['Result'] = 'Assurance Group "%(name)s" deleted successfully' % self.params
 
     def newOnlineAG(self):
@@ -260,7 +1465,7 @@ class NAEModule(object):
           "assured_fabric_type": null,
           "analysis_schedule_id": ""}'''
 
-        resp, auth = fetch_url(self.module, url,
+        resp, auth = self.send(url,
                                headers=self.http_headers,
                                data=form,
                                method='POST')
@@ -279,11 +1484,11 @@ class NAEModule(object):
                 self.fail_json(
                     msg='Connection failed for %(url)s. %(msg)s' %
                     auth, **self.result)
+        self.invalidate_assurance_groups()
         self.result['Result'] = 'Successfully created Assurance Group "%(name)s"' % self.params
 
     def newOfflineAG(self):
-        self.get_all_assurance_groups()
-        self.params['ag'] = [ag for ag in self.assuranceGroups if ag['unique_name'] == self.params.get('name')]
+        self.params['ag'] = self.get_assurance_group(self.params.get('name'))
         if self.params['ag']:
             self.module.exit_json(msg="WARNING: An assurance group with the same name already exisit!!!",**self.result)
         # This method creates a new Offline Assurance Group, you only need to
@@ -307,7 +1512,7 @@ class NAEModule(object):
           },
           "analysis_schedule_id": ""}'''
 
-        resp, auth = fetch_url(self.module, url,
+        resp, auth = self.send(url,
                                headers=self.http_headers,
                                data=form,
                                method='POST')
@@ -326,6 +1531,7 @@ class NAEModule(object):
                 self.fail_json(
                     msg='Connection failed for %(url)s. %(msg)s' %
                     auth, **self.result)
+        self.invalidate_assurance_groups()
         self.result['Result'] = 'Successfully created Assurance Group "%(name)s"' % self.params
 
     def get_pre_change_analyses(self):
@@ -333,7 +1539,7 @@ class NAEModule(object):
             self.get_assurance_group(
                 self.params.get('ag_name'))['uuid'])
         url = 'https://%(host)s:%(port)s/nae/api/v1/config-services/prechange-analysis?fabric_id=%(fabric_id)s' % self.params
-        resp, auth = fetch_url(self.module, url,
+        resp, auth = self.send(url,
                                headers=self.http_headers,
                                data=None,
                                method='GET')
@@ -348,10 +1554,7 @@ class NAEModule(object):
                     auth.get('body'))['messages'][0]['message'],
                 **self.result)
 
-        if resp.headers['Content-Encoding'] == "gzip":
-            r = gzip.decompress(resp.read())
-            return json.loads(r.decode())['value']['data']
-        return json.loads(resp.read())['value']['data']
+        return read_data(resp)
 
     def show_pre_change_analyses(self):
         result = self.get_pre_change_analyses()
@@ -413,38 +1616,148 @@ class NAEModule(object):
                 return a
         return None
 
+    def aggregate_table_url(self, job_id, epoch_status=None, severities=SMART_EVENT_SEVERITIES):
+        url = 'https://%(host)s:%(port)s/nae/api/v1/epoch-delta-services/assured-networks/%(fabric_id)s/job/' % self.params
+        url = url + '%s/health/view/aggregate-table?category=%s' % (job_id, ','.join(SMART_EVENT_CATEGORIES))
+        if epoch_status:
+            url = url + '&epoch_status=' + epoch_status
+        return url + '&severity=' + ','.join(severities)
+
+    def get_smart_event_diff(self, job_id):
+        """
+        Fetch the aggregate table of a delta job once, for both epochs, and
+        diff its smart events. The summary goes in the module result;
+        with diff_dir the events of each change (see SMART_EVENT_CHANGES)
+        are written there as <name>-<change>.json.
+        """
+        rows = (row for page in self.iter_pages(self.aggregate_table_url(job_id)) for row in page)
+        try:
+            diff = diff_smart_events(rows)
+        except ValueError as e:
+            self.module.fail_json(msg='Cannot diff the smart events of job %s: %s' % (job_id, e), **self.result)
+        self.result['smart_event_diff'] = diff['summary']
+        diff_dir = self.params.get('diff_dir')
+        if diff_dir:
+            if not os.path.isdir(diff_dir):
+                os.makedirs(diff_dir)
+            files = {}
+            for change in SMART_EVENT_CHANGES:
+                files[change] = os.path.join(diff_dir, '%s-%s.json' % (self.params.get('name'), change))
+                with open(files[change], 'w') as f:
+                    json.dump(diff[change], f, indent=2)
+            self.result['smart_event_diff_files'] = files
+        return diff
+
+    def gate_pre_change_result(self, job_id):
+        """
+        Check the later epoch of a pre-change analysis for smart events at
+        or above the gate_severity threshold.
+
+        Only those severities are requested, and each page is
+        stream-parsed so reading stops as soon as gate_sample offending
+        rows have been seen. Since the data summary is not read, pages are
+        requested until one comes back empty: the appliance may cap $size
+        below page_size, so a short page is not the last one. Fails with
+        that capped sample, or returns the passed message.
+        """
+        threshold = 'EVENT_SEVERITY_' + self.params.get('gate_severity').upper()
+        severities = SMART_EVENT_SEVERITIES[:SMART_EVENT_SEVERITIES.index(threshold) + 1]
+        sample = max(1, self.params.get('gate_sample') or 1)
+        page_size = self.params.get('page_size') or 100
+        url = self.aggregate_table_url(job_id, epoch_status='EPOCH2_ONLY', severities=severities)
+        offenders = []
+        page = 0
+        while len(offenders) < sample:
+            resp, auth = self.send(url + '&$page=%d&$size=%d' % (page, page_size),
+                                   headers=self.http_headers,
+                                   data=None,
+                                   method='GET',
+                                   stream=True)
+            if auth.get('status') != 200:
+                self.module.exit_json(
+                    msg=json.loads(
+                        auth.get('body'))['messages'][0]['message'],
+                    **self.result)
+            text = codecs.getincrementaldecoder('utf-8')()
+            rows = 0
+            try:
+                for row in iter_json_key_array((text.decode(chunk) for chunk in iter_response_body(resp)), 'data'):
+                    rows += 1
+                    details = row.get('epoch2_details') or {}
+                    if int(row.get('count') or 0) > 0 and details.get('severity') in severities:
+                        offenders.append(row)
+                        if len(offenders) >= sample:
+                            break
+            finally:
+                resp.close()
+            if rows == 0:
+                break
+            page += 1
+        self.result['gate'] = dict(severity=threshold, passed=not offenders,
+                                   sample=len(offenders), sample_limit=sample)
+        if offenders:
+            self.result['Later Epoch Smart Events'] = offenders
+            self.module.fail_json(
+                msg="Pre-change analysis failed. Smart events of severity %s or higher have been detected for later epoch only." % threshold,
+                **self.result)
+            return False
+        return "Pre-change analysis '%(name)s' passed." % self.params
+
+    def gate_smart_event_diff(self, job_id, label):
+        """
+        Fail when the later epoch has smart events above INFO that the
+        prior epoch did not have, or had fewer of.
+        """
+        diff = self.get_smart_event_diff(job_id)
+        grown = [e for e in diff['count_changed'] if e['count'] > e['prior_count']]
+        added = [e for e in diff['added'] + grown if e['severity'] != "EVENT_SEVERITY_INFO"]
+        if added:
+            self.result['New Smart Events'] = added
+            self.module.fail_json(
+                msg="%s failed. The above smart events are new or more frequent in the later epoch." % label,
+                **self.result)
+            return False
+        return "%s '%s' passed." % (label, self.params.get('name'))
+
     def get_pre_change_result(self):
-        if self.get_assurance_group(self.params.get('ag_name')) is None:
+        ag = self.get_assurance_group(self.params.get('ag_name'))
+        if ag is None:
             self.module.exit_json(
                 msg='No such Assurance Group exists on this fabric.')
-        self.params['fabric_id'] = str(
-            self.get_assurance_group(
-                self.params.get('ag_name'))['uuid'])
-        if self.get_pre_change_analysis() is None:
+        self.params['fabric_id'] = str(ag['uuid'])
+        analysis = self.get_pre_change_analysis()
+        if analysis is None:
             self.module.fail_json(
                 msg='No such Pre-Change Job exists.',
                 **self.result)
         if self.params['verify']:
-            status = None
-            while status != "COMPLETED":
-                try:
-                    status = str(
-                        self.get_pre_change_analysis()['analysis_status'])
-                    if status == "COMPLETED":
-                        break
-                except BaseException:
-                    pass
-                time.sleep(30)
+            # NAE has no status-only endpoint for a pre-change job, so each
+            # probe reads the assurance group's analysis list.
+            def probe():
+                a = self.get_pre_change_analysis()
+                status = str(a.get('analysis_status')) if a else ''
+                if status == "COMPLETED" or 'FAIL' in status:
+                    return a
+                return None
+            analysis = wait_for(probe, self.params.get('wait_timeout'))
+            if analysis is None:
+                self.module.fail_json(
+                    msg='Timed out waiting for Pre-Change Job to complete.', **self.result)
+            if str(analysis['analysis_status']) != "COMPLETED":
+                self.module.fail_json(
+                    msg='Pre-Change Job ended with status %s.' % analysis['analysis_status'], **self.result)
         else:
-            job_is_done = str(
-                self.get_pre_change_analysis()['analysis_status'])
+            job_is_done = str(analysis['analysis_status'])
             if job_is_done != "COMPLETED":
                 self.module.exit_json(
                     msg='Pre-Change Job has not yet completed.', **self.result)
-        self.params['epoch_delta_job_id'] = str(
-            self.get_pre_change_analysis()['epoch_delta_job_id'])
-        url = 'https://%(host)s:%(port)s/nae/api/v1/epoch-delta-services/assured-networks/%(fabric_id)s/job/%(epoch_delta_job_id)s/health/view/aggregate-table?category=ADC,CHANGE_ANALYSIS,TENANT_ENDPOINT,TENANT_FORWARDING,TENANT_SECURITY,RESOURCE_UTILIZATION,SYSTEM,COMPLIANCE&epoch_status=EPOCH2_ONLY&severity=EVENT_SEVERITY_CRITICAL,EVENT_SEVERITY_MAJOR,EVENT_SEVERITY_MINOR,EVENT_SEVERITY_WARNING,EVENT_SEVERITY_INFO' % self.params
-        resp, auth = fetch_url(self.module, url,
+        self.params['epoch_delta_job_id'] = str(analysis['epoch_delta_job_id'])
+        if self.params.get('gate_severity'):
+            return self.gate_pre_change_result(self.params['epoch_delta_job_id'])
+        if self.params.get('diff'):
+            return self.gate_smart_event_diff(self.params['epoch_delta_job_id'], 'Pre-change analysis')
+        url = self.aggregate_table_url(self.params['epoch_delta_job_id'], epoch_status='EPOCH2_ONLY')
+        resp, auth = self.send(url,
                                headers=self.http_headers,
                                data=None,
                                method='GET')
@@ -453,11 +1766,7 @@ class NAEModule(object):
                 msg=json.loads(
                     auth.get('body'))['messages'][0]['message'],
                 **self.result)
-        if resp.headers['Content-Encoding'] == "gzip":
-            r = gzip.decompress(resp.read())
-            result = json.loads(r.decode())['value']['data']
-        else:
-            result = json.loads(resp.read())['value']['data']
+        result = read_data(resp)
         count = 0
         for x in result:
             if int(x['count']) > 0:
@@ -474,25 +1783,25 @@ class NAEModule(object):
         return "Pre-change analysis '%(name)s' passed." % self.params
 
     def get_delta_result(self):
-        if self.get_assurance_group(self.params.get('ag_name')) is None:
+        ag = self.get_assurance_group(self.params.get('ag_name'))
+        if ag is None:
             self.module.exit_json(
                 msg='No such Assurance Group exists on this fabric.')
-        self.params['fabric_id'] = str(
-            self.get_assurance_group(
-                self.params.get('ag_name'))['uuid'])
-        if self.get_delta_analysis() is None:
+        self.params['fabric_id'] = str(ag['uuid'])
+        analysis = self.get_delta_analysis()
+        if analysis is None:
             self.module.fail_json(
                 msg='No such Delta analysis exists.',
                 **self.result)
-        job_is_done = str(
-            self.get_delta_analysis()['status'])
+        job_is_done = str(analysis['status'])
         if job_is_done != "COMPLETED_SUCCESSFULLY":
             self.module.exit_json(
                 msg='Delta analysis has not yet completed.', **self.result)
-        self.params['uuid'] = str(
-            self.get_delta_analysis()['uuid'])
-        url = 'https://%(host)s:%(port)s/nae/api/v1/epoch-delta-services/assured-networks/%(fabric_id)s/job/%(uuid)s/health/view/aggregate-table?category=ADC,CHANGE_ANALYSIS,TENANT_ENDPOINT,TENANT_FORWARDING,TENANT_SECURITY,RESOURCE_UTILIZATION,SYSTEM,COMPLIANCE&epoch_status=EPOCH2_ONLY&severity=EVENT_SEVERITY_CRITICAL,EVENT_SEVERITY_MAJOR,EVENT_SEVERITY_MINOR,EVENT_SEVERITY_WARNING,EVENT_SEVERITY_INFO' % self.params
-        resp, auth = fetch_url(self.module, url,
+        self.params['uuid'] = str(analysis['uuid'])
+        if self.params.get('diff'):
+            return self.gate_smart_event_diff(self.params['uuid'], 'Delta analysis')
+        url = self.aggregate_table_url(self.params['uuid'], epoch_status='EPOCH2_ONLY')
+        resp, auth = self.send(url,
                                headers=self.http_headers,
                                data=None,
                                method='GET')
@@ -501,11 +1810,7 @@ class NAEModule(object):
                 msg=json.loads(
                     auth.get('body'))['messages'][0]['message'],
                 **self.result)
-        if resp.headers['Content-Encoding'] == "gzip":
-            r = gzip.decompress(resp.read())
-            result = json.loads(r.decode())['value']['data']
-        else:
-            result = json.loads(resp.read())['value']['data']
+        result = read_data(resp)
         count = 0
         for x in result:
             if int(x['count']) > 0:
@@ -529,7 +1834,7 @@ class NAEModule(object):
         self.params['fabric_id'] = str(
             self.get_assurance_group(
                 self.params.get('ag_name'))['uuid'])
-        self.params['base_epoch_id'] = str(self.get_epochs()[0]["epoch_id"])
+        self.params['base_epoch_id'] = str(self.get_latest_epoch()["epoch_id"])
         if '4.1' in self.version:
             f = self.params['file']
             fields = {
@@ -552,7 +1857,7 @@ class NAEModule(object):
             m = MultipartEncoder(fields=fields)
             h = self.http_headers.copy()
             h['Content-Type'] = m.content_type
-            resp, auth = fetch_url(self.module, url,
+            resp, auth = self.send(url,
                                    headers=h,
                                    data=m,
                                    method='POST')
@@ -583,7 +1888,7 @@ class NAEModule(object):
                                     "imdata": ''' + self.params.get('changes') + '''
                                     }'''
 
-            resp, auth = fetch_url(self.module, url,
+            resp, auth = self.send(url,
                                    headers=self.http_headers,
                                    data=form,
                                    method='POST')
@@ -603,118 +1908,110 @@ class NAEModule(object):
             self.result['Result'] = "Pre-change analysis %(name)s successfully created." % self.params
 
     def create_pre_change_from_file(self):
-        no_parse = False
         if not os.path.exists(self.params.get('file')):
             raise AssertionError("File not found, " +
                                  str(self.params.get('file')))
         filename = self.params.get('file')
         self.params['filename'] = filename
+        self.params['payload_file'] = filename
         # self.result['Checking'] = str(self.params.get('filename'))
         # self.module.exit_json(msg="Testing", **self.result)
-        f = open(self.params.get('file'), "rb")
-        if self.is_json(f.read()) is True:
-            no_parse = True
-        if self.params['verify'] and no_parse is False:
-            # # Input file is not parsed.
-            self.params['cmap'] = {}
-            data = self.load(open(self.params.get('file')))
-            tree = self.construct_tree(data)
-            if tree is False:
-                self.module.fail_json(
-                    msg="Error parsing input file, unsupported object found in heirarchy.",
-                    **self.result)
-            tree_roots = self.find_tree_roots(tree)
-            ansible_ds = {}
-            for root in tree_roots:
-                exp = self.export_tree(root)
-                for key, val in exp.items():
-                    ansible_ds[key] = val
-            self.copy_children(ansible_ds)
-            toplevel = {"totalCount": "1", "imdata": []}
-            toplevel['imdata'].append(ansible_ds)
-            with open(self.params.get('file'), 'w') as f:
-                json.dump(toplevel, f)
-            del self.params['cmap']
-            f.close()
+        if self.params['verify']:
+            if self.params.get('aci_class_file'):
+                self.aci_classes.load(self.params.get('aci_class_file'))
+            if self.params.get('aci_class_map'):
+                self.aci_classes.update(self.params.get('aci_class_map'))
+            self.params['payload_file'] = self.get_parsed_payload(filename)
 
         # self.result['Checking'] = f
         # self.module.exit_json(msg="Testing", **self.result)
         config = []
-        self.params['file'] = f
         self.params['changes'] = config
         self.send_pre_change_payload()
 
-    def copy_children(self, tree):
+    def get_parsed_payload(self, filename):
+        """
+        Returns the path of the hierarchical payload for a flat config dump.
+
+        Parsed payloads are cached under cache_dir, keyed by the SHA-256 of
+        the input file and the ACI class registry version, so repeat runs
+        of the same file skip parsing. The input file is never modified.
+        Input that is already a hierarchical payload, a JSON object rather
+        than the flat dump's array(s), is uploaded as is. The cache is
+        bounded by PRECHANGE_CACHE_MAX_AGE and PRECHANGE_CACHE_MAX_BYTES.
+        """
+        digest = hashlib.sha256()
+        with open(filename, 'rb') as f:
+            for block in iter(lambda: f.read(1048576), b''):
+                digest.update(block)
+        digest.update(self.aci_classes.version.encode())
+        cache_path = os.path.join(os.path.expanduser(self.params.get('cache_dir')), 'prechange')
+        cached = os.path.join(cache_path, digest.hexdigest() + '.json')
+        passthrough = os.path.join(cache_path, digest.hexdigest() + '.raw')
+        if os.path.exists(cached):
+            os.utime(cached)
+            return cached
+        if os.path.exists(passthrough):
+            os.utime(passthrough)
+            return filename
+        if not os.path.isdir(cache_path):
+            os.makedirs(cache_path)
+        prune_cache_dir(cache_path, PRECHANGE_CACHE_MAX_AGE, PRECHANGE_CACHE_MAX_BYTES)
+
+        if first_json_char(filename) == '{':
+            # Input file is already parsed.
+            open(passthrough, 'w').close()
+            return filename
+
+        dn_index = {}
+        cmap = {}
+        with open(filename) as fh:
+            tree = self.construct_tree(self.load(fh), dn_index, cmap)
+        if tree is False:
+            self.module.fail_json(
+                msg="Error parsing input file, unsupported object found in heirarchy.",
+                **self.result)
+        self.copy_children(dn_index, cmap)
+        tree_roots = self.find_tree_roots(tree)
+        # Write next to the final name and rename, so that an interrupted
+        # run never leaves a truncated payload in the cache.
+        partial = '%s.%d.tmp' % (cached, os.getpid())
+        try:
+            with open(partial, 'w') as f:
+                self.export_tree(tree_roots, f)
+            os.replace(partial, cached)
+        finally:
+            if os.path.exists(partial):
+                os.remove(partial)
+        return cached
+
+    def copy_children(self, dn_index, cmap):
         '''
         Copies existing children objects to the built tree
 
+        Nodes are looked up in the DN index built by construct_tree, the
+        children are emitted after the constructed ones by export_tree.
         '''
-        cmap = self.params['cmap']
         for dn, children in cmap.items():
-            aci_class = self.get_aci_class(
-                (self.parse_path(dn)[-1]).split("-")[0])
-            json_path_expr_search = parse(f'$..children.[*].{aci_class}')
-            json_path_expr_update = parse(str([str(match.full_path) for match in json_path_expr_search.find(
-                tree) if match.value['attributes']['dn'] == dn][0]))
-            curr_obj = [
-                match.value for match in json_path_expr_update.find(tree)][0]
-            if 'children' in curr_obj:
-                for child in children:
-                    curr_obj['children'].append(child)
-            elif 'children' not in curr_obj:
-                curr_obj['children'] = []
-                for child in children:
-                    curr_obj['children'].append(child)
-            json_path_expr_update.update(curr_obj, tree)
+            dn_index[dn].existing_children = children
 
         return
 
-    def load(self, fh, chunk_size=1024):
-        depth = 0
-        in_str = False
-        items = []
-        buffer = ""
-
-        while True:
-            chunk = fh.read(chunk_size)
-            if len(chunk) == 0:
-                break
-            i = 0
-            while i < len(chunk):
-                c = chunk[i]
-                # if i == 0 and c != '[':
-                # self.module.fail_json(msg="Input file invalid or already parsed.", **self.result)
-                buffer += c
-
-                if c == '"':
-                    in_str = not in_str
-                elif c == '[':
-                    if not in_str:
-                        depth += 1
-                elif c == ']':
-                    if not in_str:
-                        depth -= 1
-                elif c == '\\':
-                    buffer += f[i + 1]
-                    i += 1
-
-                if depth == 0:
-                    if len(buffer.strip()) > 0:
-                        j = json.loads(buffer)
-                        assert isinstance(j, list)
-                        items += j
-                    buffer = ""
-
-                i += 1
-
-        assert depth == 0
-        return items
+    def load(self, fh, chunk_size=1048576):
+        """
+        Lazily yield the items of the flat JSON array(s) in fh, reading
+        chunk_size characters at a time.
+        """
+        for item in iter_json_array_items(iter(lambda: fh.read(chunk_size), '')):
+            yield item
 
     def parse_path(self, dn):
         """
         Grouping aware extraction of items in a path
         E.g. for /a[b/c/d]/b/c/d/e extracts [a[b/c/d/], b, c, d, e]
         """
+        if '[' not in dn:
+            return dn.split('/')
 
         path = []
         buffer = ""
@@ -736,7 +2033,7 @@ class NAEModule(object):
         path.append(buffer)
         return path
 
-    def construct_tree(self, item_list):
+    def construct_tree(self, item_list, dn_index, cmap):
         """
         Given a flat list of items, each with a dn. Construct a tree represeting their relative relationships.
         E.g. Given [/a/b/c/d, /a/b, /a/b/c/e, /a/f, /z], the function will construct
@@ -751,8 +2048,13 @@ class NAEModule(object):
           - z (data of /z)
 
         __root__ is a predefined name, you could replace this with a flag root:True/False
+
+        Nodes are TreeNode instances, segment names are interned since the
+        same names repeat across many DNs. dn_index is filled with the node
+        of every DN and cmap with the existing children of each item, for
+        copy_children.
         """
-        tree = {'data': None, 'name': '__root__', 'children': {}}
+        tree = TreeNode('__root__')
 
         for item in item_list:
             for nm, desc in item.items():
@@ -761,107 +2063,46 @@ class NAEModule(object):
                 assert 'dn' in attr
                 if 'children' in desc:
                     existing_children = desc['children']
-                    self.params['cmap'][attr['dn']] = existing_children
+                    cmap[attr['dn']] = existing_children
                 path = self.parse_path(attr['dn'])
                 cursor = tree
-                prev_node = None
                 curr_node_dn = ""
                 for node in path:
                     curr_node_dn += "/" + str(node)
                     if curr_node_dn[0] == "/":
                         curr_node_dn = curr_node_dn[1:]
-                    if node not in cursor['children']:
+                    if cursor.children is None:
+                        cursor.children = {}
+                    child = cursor.children.get(node)
+                    if child is None:
+                        node = sys.intern(node)
                         if node == 'uni':
-                            cursor['children'][node] = {
-                                'data': None,
-                                'name': node,
-                                'children': {}
-                            }
+                            child = TreeNode(node)
                         else:
                             aci_class_identifier = node.split("-")[0]
                             aci_class = self.get_aci_class(
                                 aci_class_identifier)
                             if not aci_class:
+                                self.result['unsupported_dn'] = curr_node_dn
                                 return False
-                            data_dic = {}
-                            data_dic['attributes'] = dict(dn=curr_node_dn)
-                            cursor['children'][node] = {
-                                'data': (aci_class, data_dic),
-                                'name': node,
-                                'children': {}
-                            }
-                    cursor = cursor['children'][node]
-                    prev_node = node
-                cursor['data'] = (nm, desc)
-                cursor['name'] = path[-1]
+                            child = TreeNode(node, (aci_class, dict(dn=curr_node_dn)))
+                        cursor.children[node] = child
+                        dn_index[curr_node_dn] = child
+                    cursor = child
+                cursor.data = (sys.intern(nm), attr)
+                dn_index[attr['dn']] = cursor
 
         return tree
 
     def get_aci_class(self, prefix):
         """
-        Contains a hardcoded mapping between dn prefix and aci class.
+        Looks up the aci class of a dn prefix in the class registry.
 
         E.g for the input identifier prefix of "tn"
         this function will return "fvTenant"
 
         """
-
-        if prefix == "tn":
-            return "fvTenant"
-        elif prefix == "epg":
-            return "fvAEPg"
-        elif prefix == "rscons":
-            return "fvRsCons"
-        elif prefix == "rsprov":
-            return "fvRsProv"
-        elif prefix == "rsdomAtt":
-            return "fvRsDomAtt"
-        elif prefix == "attenp":
-            return "infraAttEntityP"
-        elif prefix == "rsdomP":
-            return "infraRsDomP"
-        elif prefix == "ap":
-            return "fvAp"
-        elif prefix == "BD":
-            return "fvBD"
-        elif prefix == "subnet":
-            return "fvSubnet"
-        elif prefix == "rsBDToOut":
-            return "fvRsBDToOut"
-        elif prefix == "brc":
-            return "vzBrCP"
-        elif prefix == "subj":
-            return "vzSubj"
-        elif prefix == "rssubjFiltAtt":
-            return "vzRsSubjFiltAtt"
-        elif prefix == "flt":
-            return "vzFilter"
-        elif prefix == "e":
-            return "vzEntry"
-        elif prefix == "out":
-            return "l3extOut"
-        elif prefix == "instP":
-            return "l3extInstP"
-        elif prefix == "extsubnet":
-            return "l3extSubnet"
-        elif prefix == "rttag":
-            return "l3extRouteTagPol"
-        elif prefix == "rspathAtt":
-            return "fvRsPathAtt"
-        elif prefix == "leaves":
-            return "infraLeafS"
-        elif prefix == "taboo":
-            return "vzTaboo"
-        elif prefix == "destgrp":
-            return "spanDestGrp"
-        elif prefix == "srcgrp":
-            return "spanSrcGrp"
-        elif prefix == "spanlbl":
-            return "spanSpanLbl"
-        elif prefix == "ctx":
-            return "fvCtx"
-        else:
-            return False
+        return self.aci_classes.get(prefix)
 
     def find_tree_roots(self, tree):
         """
@@ -879,30 +2120,58 @@ class NAEModule(object):
 
         This function will return [__root__, a, c]
         """
-        if tree['data'] is not None:
-            return [tree]
-
         roots = []
-        for child in tree['children'].values():
-            roots += self.find_tree_roots(child)
+        stack = [tree]
+        while stack:
+            node = stack.pop()
+            if node.data is not None:
+                roots.append(node)
+            elif node.children:
+                stack.extend(reversed(list(node.children.values())))
 
         return roots
 
-    def export_tree(self, tree):
-        """
-        Exports the constructed tree to a heirachial json representation. (equal to tn-ansible, except for ordering)
+    def export_tree(self, roots, fh):
         """
-        tree_data = {
-            'attributes': tree['data'][1]['attributes']
-        }
-        children = []
-        for child in tree['children'].values():
-            children.append(self.export_tree(child))
+        Writes the constructed tree to fh as a heirachial imdata json document, one imdata entry per root.
+        (equal to tn-ansible, except for ordering)
 
-        if len(children) > 0:
-            tree_data['children'] = children
-
-        return {tree['data'][0]: tree_data}
+        The tree is walked iteratively and written as it goes, the nested
+        representation is never built in memory.
+        """
+        dumps = json.dumps
+        stack = []
+
+        def open_node(node):
+            fh.write('{%s: {"attributes": %s' % (dumps(node.data[0]), dumps(node.data[1])))
+            if node.children or node.existing_children:
+                fh.write(', "children": [')
+                stack.append([node, iter(node.children.values() if node.children else ()), True])
+            else:
+                fh.write('}}')
+
+        fh.write('{"totalCount": "%d", "imdata": [' % len(roots))
+        for i, root in enumerate(roots):
+            if i:
+                fh.write(', ')
+            open_node(root)
+            while stack:
+                frame = stack[-1]
+                child = next(frame[1], None)
+                if child is not None:
+                    if not frame[2]:
+                        fh.write(', ')
+                    frame[2] = False
+                    open_node(child)
+                    continue
+                for existing in frame[0].existing_children or ():
+                    if not frame[2]:
+                        fh.write(', ')
+                    frame[2] = False
+                    fh.write(dumps(existing))
+                fh.write(']}}')
+                stack.pop()
+        fh.write(']}')
 
     def delete_pre_change_analysis(self):
         if self.get_pre_change_analysis() is None:
@@ -910,7 +2179,7 @@ class NAEModule(object):
         self.params['job_id'] = str(self.get_pre_change_analysis()['job_id'])
 
         url = 'https://%(host)s:%(port)s/nae/api/v1/config-services/prechange-analysis/%(job_id)s' % self.params
-        resp, auth = fetch_url(self.module, url,
+        resp, auth = self.send(url,
                                headers=self.http_headers,
                                data=None,
                                method='DELETE')
@@ -924,37 +2193,98 @@ class NAEModule(object):
                     auth.get('body'))['messages'][0]['message'],
                 **self.result)
 
-        self.result['msg'] = json.loads(resp.read())['value']['data']
+        self.result['msg'] = read_data(resp)
 
-    def get_epochs(self):
+    def get_epoch_index(self):
+        """
+        Return the epoch index of the ag_name assurance group, refreshed
+        once per run.
+
+        Epochs are walked newest first and the walk stops at the first
+        epoch already in the persisted index, so a refresh normally costs
+        a single page. The index is rebuilt fully every EPOCH_INDEX_RESYNC
+        seconds.
+        """
         self.params['fabric_id'] = str(
             self.get_assurance_group(
                 self.params.get('ag_name'))['uuid'])
+        fabric_id = self.params['fabric_id']
+        index = self.epoch_indexes.get(fabric_id)
+        if index is not None:
+            return index
+        index = EpochIndex(self.params.get('cache_dir') or '~/.ansible/nae',
+                           self.params.get('host'), self.params.get('port'), fabric_id)
+        full = not index.load() or time.time() - index.synced > EPOCH_INDEX_RESYNC
+        known = {} if full else index.by_id
+        fresh = []
         url = 'https://%(host)s:%(port)s/nae/api/v1/event-services/assured-networks/%(fabric_id)s/epochs?$sort=-collectionTimestamp' % self.params
-        resp, auth = fetch_url(self.module, url,
-                               headers=self.http_headers,
-                               data=None,
-                               method='GET')
+        for page in self.iter_pages(url):
+            new = [epoch for epoch in page if epoch['epoch_id'] not in known]
+            fresh.extend(new)
+            if len(new) < len(page):
+                break
+        try:
+            index.update(fresh, replace=full)
+        except ValueError as e:
+            self.module.fail_json(msg='Cannot order the epochs of assurance group %s: %s' % (
+                self.params.get('ag_name'), e), **self.result)
+        if full:
+            index.synced = time.time()
+        try:
+            index.save()
+        except (IOError, OSError):
+            pass
+        self.epoch_indexes[fabric_id] = index
+        return index
 
-        if auth.get('status') != 200:
-            if('filename' in self.params):
-                self.params['file'] = self.params['filename']
-                del self.params['filename']
-            self.module.exit_json(
-                msg=json.loads(
-                    auth.get('body'))['messages'][0]['message'],
-                **self.result)
+    def get_epochs(self):
+        """
+        All epochs of the ag_name assurance group, newest first.
+        """
+        return list(reversed(self.get_epoch_index().epochs))
 
-        if resp.headers['Content-Encoding'] == "gzip":
-            r = gzip.decompress(resp.read())
-            return json.loads(r.decode())['value']['data']
-        return json.loads(resp.read())['value']['data']
+    def resolve_epoch(self, selector):
+        """
+        Resolve an epoch selector against the epoch index.
+
+        The selector is an epoch id; an offset from the latest epoch (0 is
+        the latest, -1 the one before); a Unix timestamp in seconds or
+        milliseconds; or an ISO 8601 date and time, UTC unless it carries
+        an offset. Times select the last epoch collected at or before
+        them. Returns None if nothing matches.
+        """
+        index = self.get_epoch_index()
+        selector = str(selector).strip()
+        epoch = index.get(selector)
+        if epoch is not None:
+            return epoch
+        if re.match(r'^(0|-\d+)$', selector):
+            return index.previous(-int(selector))
+        if selector.isdigit():
+            timestamp = int(selector)
+            if timestamp < 10 ** 11:
+                timestamp = timestamp * 1000
+            return index.at_or_before(timestamp)
+        try:
+            when = datetime.fromisoformat(selector.replace('Z', '+00:00'))
+        except ValueError:
+            return None
+        if when.tzinfo is None:
+            when = when.replace(tzinfo=timezone.utc)
+        return index.at_or_before(int(when.timestamp() * 1000))
+
+    def get_latest_epoch(self):
+        epoch = self.get_epoch_index().latest()
+        if epoch is None:
+            self.module.fail_json(
+                msg='No epochs found for assurance group %(ag_name)s' % self.params, **self.result)
+        return epoch
 
     def send_pre_change_payload(self):
         self.params['fabric_id'] = str(
             self.get_assurance_group(
                 self.params.get('ag_name'))['uuid'])
-        self.params['base_epoch_id'] = str(self.get_epochs()[0]["epoch_id"])
+        self.params['base_epoch_id'] = str(self.get_latest_epoch()["epoch_id"])
         f = self.params.get('file')
         payload = {
             "name": self.params.get('name'),
@@ -974,7 +2304,7 @@ class NAEModule(object):
             url = 'https://%(host)s:%(port)s/nae/api/v1/config-services/prechange-analysis/file-changes' % self.params
 
         files = {"file": (str(self.params.get('filename')),
-                          open(str(self.params.get('filename')),
+                          open(str(self.params.get('payload_file') or self.params.get('filename')),
                                'rb'),
                           'application/json'),
                  "data": ("blob",
@@ -987,7 +2317,7 @@ class NAEModule(object):
         h = self.http_headers.copy()
         h['Content-Type'] = m.content_type
 
-        resp, auth = fetch_url(self.module, url,
+        resp, auth = self.send(url,
                                headers=h,
                                data=m,
                                method='POST')
@@ -1009,7 +2339,7 @@ class NAEModule(object):
     def new_object_selector(self):
         self.params['fabric_uuid'] = self.getFirstAG()["uuid"]
         url = 'https://%(host)s:%(port)s/nae/api/v1/event-services/assured-networks/%(fabric_uuid)s/model/aci-policy/compliance-requirement/object-selectors' % self.params
-        resp, auth = fetch_url(self.module, url,
+        resp, auth = self.send(url,
                                data=self.params['form'],
                                headers=self.http_headers,
                                method='POST')
@@ -1028,14 +2358,13 @@ class NAEModule(object):
                     auth, **self.result)
         else:
             final_msg = "Object Selector " + \
-                str(json.loads(resp.read())['value']
-                    ['data']['name']) + " created"
+                str(read_data(resp)['name']) + " created"
             self.result['Result'] = final_msg
 
     def new_traffic_selector(self):
         self.params['fabric_uuid'] = self.getFirstAG()["uuid"]
         url = 'https://%(host)s:%(port)s/nae/api/v1/event-services/assured-networks/%(fabric_uuid)s/model/aci-policy/compliance-requirement/traffic-selectors' % self.params
-        resp, auth = fetch_url(self.module, url,
+        resp, auth = self.send(url,
                                data=self.params['form'],
                                headers=self.http_headers,
                                method='POST')
@@ -1054,14 +2383,13 @@ class NAEModule(object):
                     auth, **self.result)
         else:
             final_msg = "Traffic Selector " + \
-                str(json.loads(resp.read())['value']
-                    ['data']['name']) + " created"
+                str(read_data(resp)['name']) + " created"
             self.result['Result'] = final_msg
 
     def new_compliance_requirement(self):
         self.params['fabric_uuid'] = self.getFirstAG()["uuid"]
         url = 'https://%(host)s:%(port)s/nae/api/v1/event-services/assured-networks/%(fabric_uuid)s/model/aci-policy/compliance-requirement/requirements' % self.params
-        resp, auth = fetch_url(self.module, url,
+        resp, auth = self.send(url,
                                data=self.params['form'],
                                headers=self.http_headers,
                                method='POST')
@@ -1080,8 +2408,7 @@ class NAEModule(object):
                     auth, **self.result)
         else:
             final_msg = "Compliance requirement " + \
-                str(json.loads(resp.read())['value']
-                    ['data']['name']) + " created"
+                str(read_data(resp)['name']) + " created"
             self.result['Result'] = final_msg
 
     def new_compliance_requirement_set(self):
@@ -1093,7 +2420,7 @@ class NAEModule(object):
         self.params['form'] = json.dumps(d)
         self.params['fabric_uuid'] = self.getFirstAG()["uuid"]
         url = 'https://%(host)s:%(port)s/nae/api/v1/event-services/assured-networks/%(fabric_uuid)s/model/aci-policy/compliance-requirement/requirement-sets' % self.params
-        resp, auth = fetch_url(self.module, url,
+        resp, auth = self.send(url,
                                data=self.params['form'],
                                headers=self.http_headers,
                                method='POST')
@@ -1111,14 +2438,13 @@ class NAEModule(object):
                     auth, **self.result)
         else:
             final_msg = "Compliance requirement set " + \
-                str(json.loads(resp.read())['value']
-                    ['data']['name']) + " created"
+                str(read_data(resp)['name']) + " created"
             self.result['Result'] = final_msg
 
     def get_all_requirement_sets(self):
         self.params['fabric_uuid'] = self.getFirstAG()["uuid"]
         url = 'https://%(host)s:%(port)s/nae/api/v1/event-services/assured-networks/%(fabric_uuid)s/model/aci-policy/compliance-requirement/requirement-sets' % self.params
-        resp, auth = fetch_url(self.module, url,
+        resp, auth = self.send(url,
                                headers=self.http_headers,
                                method='GET')
         if auth.get('status') != 200:
@@ -1134,17 +2460,13 @@ class NAEModule(object):
                     msg='Connection failed for %(url)s. %(msg)s' %
                     auth, **self.result)
         else:
-            if resp.headers['Content-Encoding'] == "gzip":
-                r = gzip.decompress(resp.read())
-                self.result['Result'] = json.loads(r.decode())['value']['data']
-                return json.loads(r.decode())['value']['data']
-            self.result['Result'] = json.loads(resp.read())['value']['data']
-            return json.loads(resp.read())['value']['data']
+            self.result['Result'] = read_data(resp)
+            return self.result['Result']
 
     def get_all_requirements(self):
         self.params['fabric_uuid'] = self.getFirstAG()["uuid"]
         url = 'https://%(host)s:%(port)s/nae/api/v1/event-services/assured-networks/%(fabric_uuid)s/model/aci-policy/compliance-requirement/requirements' % self.params
-        resp, auth = fetch_url(self.module, url,
+        resp, auth = self.send(url,
                                headers=self.http_headers,
                                method='GET')
         if auth.get('status') != 200:
@@ -1160,17 +2482,13 @@ class NAEModule(object):
                     msg='Connection failed for %(url)s. %(msg)s' %
                     auth, **self.result)
         else:
-            if resp.headers['Content-Encoding'] == "gzip":
-                r = gzip.decompress(resp.read())
-                self.result['Result'] = json.loads(r.decode())['value']['data']
-                return json.loads(r.decode())['value']['data']
-            self.result['Result'] = json.loads(resp.read())['value']['data']
-            return json.loads(resp.read())['value']['data']
+            self.result['Result'] = read_data(resp)
+            return self.result['Result']
 
     def get_all_traffic_selectors(self):
         self.params['fabric_uuid'] = self.getFirstAG()["uuid"]
         url = 'https://%(host)s:%(port)s/nae/api/v1/event-services/assured-networks/%(fabric_uuid)s/model/aci-policy/compliance-requirement/traffic-selectors' % self.params
-        resp, auth = fetch_url(self.module, url,
+        resp, auth = self.send(url,
                                headers=self.http_headers,
                                method='GET')
         if auth.get('status') != 200:
@@ -1186,17 +2504,13 @@ class NAEModule(object):
                     msg='Connection failed for %(url)s. %(msg)s' %
                     auth, **self.result)
         else:
-            if resp.headers['Content-Encoding'] == "gzip":
-                r = gzip.decompress(resp.read())
-                self.result['Result'] = json.loads(r.decode())['value']['data']
-                return json.loads(r.decode())['value']['data']
-            self.result['Result'] = json.loads(resp.read())['value']['data']
-            return json.loads(resp.read())['value']['data']
+            self.result['Result'] = read_data(resp)
+            return self.result['Result']
 
     def get_all_object_selectors(self):
         self.params['fabric_uuid'] = self.getFirstAG()["uuid"]
         url = 'https://%(host)s:%(port)s/nae/api/v1/event-services/assured-networks/%(fabric_uuid)s/model/aci-policy/compliance-requirement/object-selectors' % self.params
-        resp, auth = fetch_url(self.module, url,
+        resp, auth = self.send(url,
                                headers=self.http_headers,
                                method='GET')
         if auth.get('status') != 200:
@@ -1212,12 +2526,8 @@ class NAEModule(object):
                     msg='Connection failed for %(url)s. %(msg)s' %
                     auth, **self.result)
         else:
-            if resp.headers['Content-Encoding'] == "gzip":
-                r = gzip.decompress(resp.read())
-                self.result['Result'] = json.loads(r.decode())['value']['data']
-                return json.loads(r.decode())['value']['data']
-            self.result['Result'] = json.loads(resp.read())['value']['data']
-            return json.loads(r.decode())['value']['data']
+            self.result['Result'] = read_data(resp)
+            return self.result['Result']
 
     def get_compliance_object(self, name):
         if self.params.get('selector') == 'object':
@@ -1238,7 +2548,7 @@ class NAEModule(object):
         self.params['obj_uuid'] = self.get_compliance_object(
             self.params.get('name'))["uuid"]
         url = 'https://%(host)s:%(port)s/nae/api/v1/event-services/assured-networks/%(fabric_uuid)s/model/aci-policy/compliance-requirement/object-selectors/%(obj_uuid)s' % self.params
-        resp, auth = fetch_url(self.module, url,
+        resp, auth = self.send(url,
                                headers=self.http_headers,
                                method='DELETE')
         if auth.get('status') != 200:
@@ -1262,7 +2572,7 @@ class NAEModule(object):
         self.params['obj_uuid'] = self.get_compliance_object(
             self.params.get('name'))["uuid"]
         url = 'https://%(host)s:%(port)s/nae/api/v1/event-services/assured-networks/%(fabric_uuid)s/model/aci-policy/compliance-requirement/traffic-selectors/%(obj_uuid)s' % self.params
-        resp, auth = fetch_url(self.module, url,
+        resp, auth = self.send(url,
                                headers=self.http_headers,
                                method='DELETE')
         if auth.get('status') != 200:
@@ -1286,7 +2596,7 @@ class NAEModule(object):
         self.params['obj_uuid'] = self.get_compliance_object(
             self.params.get('name'))["uuid"]
         url = 'https://%(host)s:%(port)s/nae/api/v1/event-services/assured-networks/%(fabric_uuid)s/model/aci-policy/compliance-requirement/requirements/%(obj_uuid)s' % self.params
-        resp, auth = fetch_url(self.module, url,
+        resp, auth = self.send(url,
                                headers=self.http_headers,
                                method='DELETE')
         if auth.get('status') != 200:
@@ -1310,7 +2620,7 @@ class NAEModule(object):
         self.params['obj_uuid'] = self.get_compliance_object(
             self.params.get('name'))["uuid"]
         url = 'https://%(host)s:%(port)s/nae/api/v1/event-services/assured-networks/%(fabric_uuid)s/model/aci-policy/compliance-requirement/requirement_set/%(obj_uuid)s' % self.params
-        resp, auth = fetch_url(self.module, url,
+        resp, auth = self.send(url,
                                headers=self.http_headers,
                                method='DELETE')
         if auth.get('status') != 200:
@@ -1330,31 +2640,109 @@ class NAEModule(object):
                 self.params.get('name') + " deleted"
 
     def getFirstAG(self):
-        self.get_all_assurance_groups()
-        return self.assuranceGroups[0]
+        return self.get_all_assurance_groups()[0]
+
+    def find_uploaded_file(self, name=None, uuid=None):
+        """
+        Return the uploaded file with the given unique name or uuid, or
+        None. A name that is not found is looked up in the upload index
+        aliases, for uploads that were deduplicated against an existing
+        file.
+        """
+        if uuid:
+            return find_item(self.iter_files(), uuid=uuid)
+        uploaded = find_item(self.iter_files(), unique_name=name)
+        if uploaded:
+            return uploaded
+        if name:
+            index = UploadIndex(self.params.get('cache_dir') or '~/.ansible/nae',
+                                self.params.get('host'), self.params.get('port'))
+            uuid = index.resolve(name)
+            if uuid:
+                return self.find_uploaded_file(uuid=uuid)
+        return None
+
+    def get_duplicate_upload(self, index, digest):
+        """
+        Return the completed upload recorded for digest, dropping the
+        index entry if the appliance no longer has it.
+        """
+        entry = index.lookup(digest)
+        if not entry:
+            return None
+        existing = self.find_uploaded_file(uuid=entry['uuid'])
+        if existing and existing.get('status') == 'UPLOAD_COMPLETED':
+            return existing
+        index.drop(digest)
+        return None
 
     def upload_file(self):
-        for page in self.get_all_files():
-            self.params['file_id'] = [f for f in page if f['unique_name'] == self.params.get('name')]
-        if self.params['file_id']:
+        """
+        Upload params['file'] as params['name'] and return the uuid of the
+        file on NAE, which is also put in the result. With dedup, a file of
+        the same content already on NAE is returned instead, and the result
+        records whether that happened under 'deduplicated'.
+        """
+        index = None
+        self.result['deduplicated'] = False
+        if self.params.get('dedup'):
+            index = UploadIndex(self.params.get('cache_dir'),
+                                self.params.get('host'),
+                                self.params.get('port'))
+            digest = index.digest(self.params.get('file'))
+            existing = self.get_duplicate_upload(index, digest)
+            if existing:
+                if existing['unique_name'] != self.params.get('name'):
+                    index.alias(self.params.get('name'), existing['uuid'])
+                self.result['uuid'] = existing['uuid']
+                self.result['deduplicated'] = True
+                self.result['duplicate_of'] = existing['unique_name']
+                self.result['Result'] = 'File %s already uploaded as %s' % (
+                    self.params.get('file'), existing['unique_name'])
+                return existing['uuid']
+        manifest = None
+        if self.params.get('resume', True):
+            manifest = UploadManifest(self.params.get('cache_dir'),
+                                      self.params.get('host'),
+                                      self.params.get('port'),
+                                      self.params.get('name'),
+                                      self.params.get('file'))
+            if not manifest.load():
+                manifest.entry = None
+        self.params['file_id'] = find_item(self.iter_files(), unique_name=self.params.get('name'))
+        # A file of the same name is expected when resuming our own upload.
+        if self.params['file_id'] and not (manifest and manifest.entry):
             self.module.exit_json(msg="WARNING: file with the same name already exisit!!!",**self.result)
+        if manifest and manifest.entry and not self.params['file_id']:
+            # The appliance no longer knows the upload, start over.
+            manifest.drop()
+            manifest.entry = None
 
         self.params['fabric_uuid'] = self.getFirstAG()["uuid"]
-        file_upload_uuid = None
         uri = 'https://%(host)s:%(port)s/nae/api/v1/file-services/upload-file' % self.params
         try:
             with self.get_logout_lock():
-                chunk_url = self.start_upload(uri, 'OFFLINE_ANALYSIS')
+                if manifest and manifest.entry:
+                    chunk_url = manifest.entry['chunk_url']
+                    self.result['resumed'] = len(manifest.entry['chunks'])
+                else:
+                    chunk_url = self.start_upload(uri, 'OFFLINE_ANALYSIS')
                 complete_url = None
                 if chunk_url:
-                    complete_url = self.upload_file_by_chunk(chunk_url)
+                    complete_url = self.upload_file_by_chunk(chunk_url, manifest)
                 else:
                     self.module.fail_json(msg='Error', **self.result)
                 if complete_url:
-                    file_upload_uuid = self.complete_upload(complete_url)
+                    self.complete_upload(complete_url)
                 else:
                     self.module.fail_json(
                         'Failed to upload file chunks', **self.result)
+            if manifest:
+                manifest.drop()
+            file_upload_uuid = complete_url.split('/')[-2]
+            if index:
+                index.add(digest, file_upload_uuid, self.params.get('name'))
+            self.result['uuid'] = file_upload_uuid
             return file_upload_uuid
         except Exception as e:
             self.module.fail_json(msg='Failed to upload file chunks', **self.result)
@@ -1383,12 +2771,12 @@ class NAEModule(object):
                          "size_in_bytes": int(file_size_in_bytes),
                          "upload_type": upload_type}}  # "OFFLINE_ANALYSIS"
 
-        resp, auth = fetch_url(self.module, uri,
+        resp, auth = self.send(uri,
                                data=json.dumps(args['data']),
                                headers=self.http_headers,
                                method='POST')
         if auth.get('status') == 201:
-            return str(json.loads(resp.read())['value']['data']['links'][-1]['href'])
+            return str(read_data(resp)['links'][-1]['href'])
         else:
             self.status = auth.get('status')
             try:
@@ -1402,70 +2790,173 @@ class NAEModule(object):
 
         return None
 
-    def upload_file_by_chunk(self, chunk_url):
+    def upload_file_by_chunk(self, chunk_url, manifest=None):
         """Pass metadata to api and trigger start of upload file.
+
+        The file is mapped into memory once and upload_workers threads hash
+        and send memoryview slices of the mapping over the transport's
+        pooled connections, so no chunk is read into a private buffer. The
+        transport still builds each chunk's multipart body in memory, which
+        copies the chunk once. With a manifest, every
+        acknowledged chunk is recorded and chunks acknowledged by an
+        earlier run are skipped.
         Args:
            chunk_url: str: url to send chunks
-           file_path: str: path of file and filename
+           manifest: UploadManifest: optional record of the upload
         Returns:
             str: chunk url , used for uploading chunks or None if issue uploading
         """
+        chunk_uri = 'https://%(host)s:%(port)s/nae' % self.params
+        chunk_uri = chunk_uri + chunk_url[chunk_url.index('/api/'):]
+        file_size_in_bytes = os.path.getsize(self.params.get('file'))
+        chunk_byte_size = self.get_upload_chunk_size(file_size_in_bytes)
+        complete_url = None
+        last_chunk_id = -1
+        if manifest:
+            if manifest.entry:
+                chunk_byte_size = manifest.entry['chunk_size']
+                complete_url = manifest.entry['complete_url']
+                if manifest.entry['chunks']:
+                    last_chunk_id = max(int(c) for c in manifest.entry['chunks'])
+            else:
+                manifest.start(chunk_url, chunk_byte_size)
+        chunks = [(chunk_id, offset, min(chunk_byte_size, file_size_in_bytes - offset))
+                  for chunk_id, offset in enumerate(range(0, file_size_in_bytes, chunk_byte_size))]
+        if manifest:
+            chunks = [chunk for chunk in chunks if not manifest.acked(chunk[0])]
+        plan = dict((chunk[0], chunk) for chunk in chunks)
+        workers = max(1, self.params.get('upload_workers') or 1)
+        sent_bytes = 0
+        busy_time = 0.0
         try:
-            chunk_id = 0
-            offset = 0
-            chunk_uri = 'https://%(host)s:%(port)s/nae' % self.params
-            chunk_uri = chunk_uri + chunk_url[chunk_url.index('/api/'):]
-            response = None
-            file_size_in_bytes = os.path.getsize(self.params.get('file'))
-            chunk_byte_size = 10000000
-            if file_size_in_bytes < chunk_byte_size:
-                chunk_byte_size = int(file_size_in_bytes // 2)
-            with open(self.params.get('file'), 'rb') as f:
-                for chunk in self.read_in_chunks(f, chunk_byte_size):
-                    checksum = hashlib.md5(chunk).hexdigest()
-                    chunk_info = {"offset": int(offset),
-                                  "checksum": checksum,
-                                  "chunk_id": chunk_id,
-                                  "size_in_bytes": sys.getsizeof(chunk)}
-                    files = {"chunk-info": (None, json.dumps(chunk_info),
-                                            'application/json'),
-                             "chunk-data": (os.path.basename(self.params.get('file')) +
-                                            str(chunk_id),
-                                            chunk, 'application/octet-stream')}
-                    args = {"files": files}
-                    chunk_headers = self.http_headers.copy()
-                    chunk_headers.pop("Content-Type", None)
-                    # Ansible preders us to use fetch_url but does not support binary file uploads so reverting back to requests seems the only thing not working. 
-                    response = requests.post(chunk_uri, data = None, files=args['files'], headers=chunk_headers, verify=False)
-                    chunk_id += 1
-                    if response and response.status_code != 201:
-                        self.module.fail_json(
-                            msg="Incorrect response code", **self.result)
-                        return None
-                if response:
-                    return str(response.json()['value']['data']['links'][-1]['href'])
-                else:
-                    self.module.fail_json(
-                        msg="No reponse received while uploading chunks", **self.result)
-        except IOError as ioex:
+            f = open(self.params.get('file'), 'rb')
+        except IOError:
             self.module.fail_json(
                 msg="Cannot open supplied file", **self.result)
+        with f:
+            # Zero length files cannot be mapped, and have no chunks anyway.
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if chunks else None
+            try:
+                with ThreadPoolExecutor(max_workers=workers) as pool:
+                    futures = [pool.submit(self.upload_chunk, chunk_uri, data, *chunk) for chunk in chunks]
+                    try:
+                        for future in as_completed(futures):
+                            chunk_id, auth, href, checksum, elapsed = future.result()
+                            if auth.get('status') != 201:
+                                self.result['chunk_id'] = chunk_id
+                                self.result['Error'] = auth.get('msg')
+                                self.module.fail_json(
+                                    msg="Incorrect response code", **self.result)
+                            sent_bytes += plan[chunk_id][2]
+                            busy_time += elapsed
+                            # Every chunk response links the completion url,
+                            # keep the one for the final chunk.
+                            if chunk_id > last_chunk_id:
+                                last_chunk_id = chunk_id
+                                complete_url = href
+                            if manifest:
+                                _, offset, size = plan[chunk_id]
+                                manifest.ack(chunk_id, offset, size, checksum,
+                                             href if chunk_id == last_chunk_id else None)
+                    finally:
+                        for future in futures:
+                            future.cancel()
+            finally:
+                if data is not None:
+                    data.close()
+        if busy_time:
+            self.record_upload_throughput(sent_bytes / busy_time)
+        if complete_url:
+            return complete_url
+        self.module.fail_json(
+            msg="No reponse received while uploading chunks", **self.result)
         return None
 
-    def read_in_chunks(self, file_object, chunk_byte_size):
+    def upload_chunk(self, chunk_uri, data, chunk_id, offset, size):
         """
-        Return chunks of file.
+        Upload one chunk of the file.
+
+        Runs on worker threads, so it does not fail the module: returns
+        (chunk_id, auth, complete url or None, checksum, seconds spent).
         Args:
-           file_object: file: open file object
-           chunk_byte_size: int: size of chunk to return
-        Returns:
-            Returns a chunk of the file
+           chunk_uri: str: url to send chunks
+           data: mmap: read-only mapping of the file
+           chunk_id: int: index of the chunk
+           offset: int: byte offset of the chunk in the file
+           size: int: chunk length in bytes
         """
-        while True:
-            data = file_object.read(chunk_byte_size)
-            if not data:
-                break
-            yield data
+        start = time.time()
+        chunk = memoryview(data)[offset:offset + size]
+        try:
+            checksum = hashlib.md5(chunk).hexdigest()
+            chunk_info = {"offset": int(offset),
+                          "checksum": checksum,
+                          "chunk_id": chunk_id,
+                          "size_in_bytes": chunk.nbytes}
+            files = {"chunk-info": (None, json.dumps(chunk_info),
+                                    'application/json'),
+                     "chunk-data": (os.path.basename(self.params.get('file')) +
+                                    str(chunk_id),
+                                    chunk, 'application/octet-stream')}
+            chunk_headers = self.http_headers.copy()
+            chunk_headers.pop("Content-Type", None)
+            response, auth = self.send(chunk_uri,
+                                       headers=chunk_headers,
+                                       files=files,
+                                       method='POST',
+                                       timeout=None)
+        finally:
+            # The mapping cannot be closed while views of it are alive.
+            chunk.release()
+        href = None
+        if auth.get('status') == 201:
+            href = str(read_data(response)['links'][-1]['href'])
+        return chunk_id, auth, href, checksum, time.time() - start
+
+    def _throughput_file(self):
+        return os.path.join(os.path.expanduser(self.params.get('cache_dir') or '~/.ansible/nae'),
+                            'uploads', 'throughput.json')
+
+    def get_upload_chunk_size(self, file_size_in_bytes):
+        """
+        Pick the chunk size for an upload.
+
+        Files up to UPLOAD_CHUNK_MIN go in a single chunk. Larger files use
+        chunks sized to take UPLOAD_CHUNK_SECONDS at the per-connection
+        throughput last recorded for this host, bounded by
+        UPLOAD_CHUNK_MIN and UPLOAD_CHUNK_MAX.
+        """
+        if file_size_in_bytes <= UPLOAD_CHUNK_MIN:
+            return max(1, file_size_in_bytes)
+        try:
+            with open(self._throughput_file()) as f:
+                rate = json.load(f).get(self.params.get('host'), 0)
+        except (IOError, OSError, ValueError):
+            rate = 0
+        chunk_byte_size = int(rate * UPLOAD_CHUNK_SECONDS)
+        return min(max(chunk_byte_size, UPLOAD_CHUNK_MIN), UPLOAD_CHUNK_MAX)
+
+    def record_upload_throughput(self, rate):
+        """
+        Remember the per-connection upload rate, in bytes per second, for
+        sizing the next upload's chunks to this host.
+        """
+        path = self._throughput_file()
+        try:
+            with open(path) as f:
+                rates = json.load(f)
+        except (IOError, OSError, ValueError):
+            rates = {}
+        rates[self.params.get('host')] = rate
+        try:
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path), mode=0o700)
+            partial = '%s.%d.tmp' % (path, os.getpid())
+            with open(partial, 'w') as f:
+                json.dump(rates, f)
+            os.replace(partial, path)
+        except (IOError, OSError):
+            pass
 
     def complete_upload(self, complete_url):
         """Complete request to start dag.
@@ -1481,32 +2972,29 @@ class NAEModule(object):
         case, the api returns a timeout even though the upload
         completes successfully later.
         """
-        timeout = 300
+        timeout = self.params.get('wait_timeout', 300)
         complete_uri = 'https://%(host)s:%(port)s/nae' % self.params
         complete_uri = complete_uri + \
             complete_url[complete_url.index('/api/'):]
-        resp, auth = fetch_url(self.module, complete_uri,
+        resp, auth = self.send(complete_uri,
                                data=None,
                                headers=self.http_headers,
                                method='POST')
         try:
             if resp and auth.get('status') == 200:
-                return str(json.loads(resp.read())['value']['data']['links'][-1]['href'])
+                return str(read_data(resp)['links'][-1]['href'])
             elif not resp or auth.get('status') == 400:
-                total_time = 0
-                while total_time < timeout:
-                    time.sleep(10)
-                    total_time += 10
-                    resp, auth = fetch_url(
-                        self.module, 'https://%(host)s:%(port)s/nae/api/v1/file-services/upload-file', data=None, method='GET')
-                    if resp and auth.get('status') == 200:
-                        json.loads(resp.read())
-                        uuid = complete_url.split('/')[-2]
-                        for offline_file in resp['value']['data']:
-                            if offline_file['uuid'] == uuid:
-                                success = offline_file['status'] == 'UPLOAD_COMPLETED'
-                                if success:
-                                    return {'uuid': offline_file['uuid']}
+                uuid = complete_url.split('/')[-2]
+
+                def probe():
+                    uploaded = self.find_uploaded_file(uuid=uuid)
+                    if uploaded and uploaded.get('status') == 'UPLOAD_COMPLETED':
+                        return uuid
+                    return None
+
+                uploaded = wait_for(probe, timeout)
+                if uploaded:
+                    return uploaded
 
             self.module.fail_json(msg="No upload complete", **self.result)
             raise Exception
@@ -1525,75 +3013,196 @@ class NAEModule(object):
             if (ag['status'] == "RUNNING" or ag['status'] == "ANALYSIS_NOT_STARTED" or ag['status'] == "ANALYSIS_IN_PROGRESS") and ('iterations' in ag):
                 return ag['unique_name']
 
-    def get_tcam_stats(self):
+    def get_tcam_page(self, page):
+        """
+        Fetch one page of TCAM hit counts.
+
+        Runs on worker threads, so errors are returned rather than raised
+        through fail_json: the result is (data, data_summary, None) or
+        (None, None, error) where error carries the url and message.
+        """
+        url = 'https://%(host)s:%(port)s/nae/api/v1/event-services/assured-networks/%(fabric_id)s/model/aci-policy/tcam/hitcount-by-rules/hitcount-by-epgpair-contract-filter?$epoch_id=%(latest_epoch)s&$size=%(tcam_page_size)s&$sort=-cumulative_count&$view=histogram' % self.params
+        url = url + '&$page=%s' % page
+        resp, auth = self.send(url, headers=self.http_headers, method='GET')
+        if auth.get('status') != 200:
+            return None, None, {'url': url, 'msg': auth.get('msg')}
+        data, data_summary = read_page(resp)
+        return data, data_summary, None
+
+    def iter_tcam_pages(self, epoch_id=None):
+        """
+        Yield TCAM hit-count pages in page order.
+
+        The first page is fetched on its own to learn the total count from
+        its data_summary; the remaining pages are then fetched by
+        tcam_workers threads with at most two requests per worker in
+        flight. If the appliance does not report a total, pages are walked
+        sequentially until has_more_data is false.
+
+        Reads the latest epoch unless epoch_id is given.
+        """
         self.params['fabric_id'] = str(
             self.get_assurance_group(
                 self.params.get('ag_name'))['uuid'])
-        self.params['latest_epoch'] = str(self.get_epochs()[-1]["epoch_id"])
+        if epoch_id is None:
+            epoch_id = self.get_latest_epoch()["epoch_id"]
+        self.params['latest_epoch'] = str(epoch_id)
+        self.params.setdefault('tcam_page_size', 200)
         self.params['page'] = 0
-        self.params['obj_per_page'] = 200
-        has_more_data = True
-        tcam_data = []
-        # As long as there is more data get it
-        while has_more_data:
-            # I get data sorter by tcam hists for hitcount-by-rules --> hitcount-by-epgpair-contract-filter
-            url = 'https://%(host)s:%(port)s/nae/api/v1/event-services/assured-networks/%(fabric_id)s/model/aci-policy/tcam/hitcount-by-rules/hitcount-by-epgpair-contract-filter?$epoch_id=%(latest_epoch)s&$page=%(page)s&$sort=-cumulative_count&$view=histogram' % self.params
-            resp, auth = fetch_url(
-                self.module, url, headers=self.http_headers, method='GET')
-            if auth.get('status') != 200:
-                self.result['Error'] = auth.get('msg')
-                self.result['url'] = url
+
+        def check(page):
+            data, data_summary, error = page
+            if error:
+                self.result['Error'] = error['msg']
+                self.result['url'] = error['url']
                 self.module.fail_json(msg="Error getting TCAM", **self.result)
-            if resp.headers['Content-Encoding'] == "gzip":
-                r = gzip.decompress(resp.read())
-                has_more_data = json.loads(r.decode())[
-                    'value']['data_summary']['has_more_data']
-                tcam_data.append(json.loads(r.decode())['value']['data'])
-            else:
-                has_more_data = json.loads(resp.read())[
-                    'value']['data_summary']['has_more_data']
-                tcam_data.append(json.loads(resp.read())['value']['data'])
             self.params['page'] = self.params['page'] + 1
+            return data, data_summary
+
+        data, data_summary = check(self.get_tcam_page(0))
+        yield data
+        if not data_summary.get('has_more_data'):
+            return
 
+        total = data_summary.get('total_count')
+        if total is None:
+            has_more_data = True
+            while has_more_data:
+                data, data_summary = check(self.get_tcam_page(self.params['page']))
+                has_more_data = data_summary['has_more_data']
+                yield data
+            return
+
+        pages = int(math.ceil(int(total) / float(self.params['tcam_page_size'])))
+        workers = max(1, self.params.get('tcam_workers') or 1)
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            pending = deque()
+            next_page = 1
+            while next_page < pages or pending:
+                while next_page < pages and len(pending) < 2 * workers:
+                    pending.append(pool.submit(self.get_tcam_page, next_page))
+                    next_page += 1
+                page = pending.popleft().result()
+                if page[2]:
+                    for future in pending:
+                        future.cancel()
+                data, data_summary = check(page)
+                yield data
+
+    def get_tcam_stats(self):
+        tcam_data = list(self.iter_tcam_pages())
         self.result['Result'] = 'Pages extracted %(page)s ' % self.params
         return tcam_data
 
-    def tcam_to_csv(self):
-        tcam_data = self.get_tcam_stats()
-        tcam_stats = []
-        for page in tcam_data:
-            for item in page:
-                tdic = {}
-                for key, value in item.items():
-                    if key == "bucket":
-                        tdic['Provider EPG'] = value['provider_epg']['dn'].replace(
-                            "uni/", "")
-                        tdic['Consumer VRF'] = value['consumer_vrf']['dn'].replace(
-                            "uni/", "")
-                        tdic['Consumer EPG'] = value['consumer_epg']['dn'].replace(
-                            "uni/", "")
-                        tdic['Contract'] = value['contract']['dn'].replace(
-                            "uni/", "")
-                        tdic['Filter'] = value['filter']['dn'].replace(
-                            "uni/", "")
-                    if key == "output":
-                        if 'month_count' in value:
-                            tdic["Monthly Hits"] = value['month_count']
-                        else:
-                            tdic["Monthly Hits"] = "N/A"
-                        tdic['Total Hits'] = value['cumulative_count']
-                        tdic['TCAM Usage'] = value['tcam_entry_count']
-                tcam_stats.append(tdic)
+    def get_tcam_dataset(self):
+        dataset = TcamDataset()
+        for page in self.iter_tcam_pages():
+            dataset.add_page(page)
+        self.result['Result'] = 'Pages extracted %(page)s ' % self.params
+        self.result['rows'] = len(dataset)
+        return dataset
+
+    def tcam_to_csv(self, pages=None, change=False):
+        """
+        Write TCAM hit counts to <file>.csv (or <file>.csv.gz with
+        compress), one page at a time as pages arrive.
+
+        pages defaults to all pages of the latest epoch. With change, a
+        leading Change column is filled from each item's 'change' key.
+        """
+        columns = self.params.get('csv_columns') or list(TCAM_CSV_COLUMNS)
+        unknown = [c for c in columns if c not in TCAM_CSV_COLUMNS]
+        if unknown:
+            self.module.fail_json(
+                msg='Unknown TCAM csv columns: %s. Valid columns are: %s' % (', '.join(unknown), ', '.join(TCAM_CSV_COLUMNS)),
+                **self.result)
+        extractors = [TCAM_CSV_COLUMNS[c] for c in columns]
+        if change:
+            columns = ['Change'] + columns
+            extractors = [lambda item: item['change']] + extractors
+        if pages is None:
+            pages = self.iter_tcam_pages()
         outfile = self.params.get('file') + '.csv'
-        with open(outfile, 'w', newline='') as f:
-            fieldnames = ['Provider EPG', 'Consumer EPG', 'Consumer VRF',
-                          'Contract', 'Filter', 'Monthly Hits', 'Total Hits', 'TCAM Usage']
-            writer = csv.DictWriter(f, fieldnames=fieldnames)
-            writer.writeheader()
-            for i in tcam_stats:
-                writer.writerow(i)
-        success = 'to file %(file)s.csv' % self.params
-        self.result['Result'] = self.result['Result'] + success
+        if self.params.get('compress'):
+            outfile = outfile + '.gz'
+            f = gzip.open(outfile, 'wt', newline='')
+        else:
+            f = open(outfile, 'w', newline='')
+        rows = 0
+        with f:
+            writer = csv.writer(f)
+            writer.writerow(columns)
+            for page in pages:
+                writer.writerows([extract(item) for extract in extractors] for item in page)
+                rows += len(page)
+        self.result['Result'] = 'Pages extracted %s ' % self.params.get('page', 0) + 'to file %s' % outfile
+        self.result['rows'] = rows
+
+    def get_tcam_delta(self):
+        """
+        Compare the latest epoch's TCAM hit counts with the most recent
+        earlier epoch that has a local snapshot.
+
+        NAE has no server-side diff, so a new epoch is still read in full;
+        it is written to the snapshot store as pages arrive and only
+        changed rows are kept. If the latest epoch is already in the store
+        nothing is fetched. Returns the changed rows as TCAM items with a
+        'change' key of added, changed or removed, and puts the count of
+        each in the result. With no earlier snapshot the epoch is only
+        recorded as the baseline and no rows are returned.
+        """
+        store = TcamSnapshotStore(self.params.get('cache_dir'))
+        epochs = self.get_epochs()
+        if not epochs:
+            self.module.fail_json(
+                msg='No epochs found for assurance group %(ag_name)s' % self.params, **self.result)
+        fabric_id = self.params['fabric_id']
+        epoch_id = str(epochs[0]['epoch_id'])
+        previous_id = None
+        for epoch in epochs[1:]:
+            if store.exists(fabric_id, epoch['epoch_id']):
+                previous_id = str(epoch['epoch_id'])
+                break
+        previous = store.load(fabric_id, previous_id) if previous_id else {}
+        changes = []
+
+        def compare(key, counters):
+            before = previous.pop(key, None)
+            if before is None:
+                changes.append(('added', key, counters))
+            elif before != counters:
+                changes.append(('changed', key, counters))
+
+        if store.exists(fabric_id, epoch_id):
+            for key, counters in store.load(fabric_id, epoch_id).items():
+                compare(key, counters)
+        else:
+            with store.writer(fabric_id, epoch_id) as write:
+                for page in self.iter_tcam_pages(epoch_id):
+                    for item in page:
+                        key, counters = tcam_row(item)
+                        write(key, counters)
+                        compare(key, counters)
+            store.prune(fabric_id, self.params.get('keep_snapshots') or 1,
+                        [epoch['epoch_id'] for epoch in epochs])
+        self.result['epoch'] = epoch_id
+        self.result['previous_epoch'] = previous_id
+        if not previous_id:
+            self.result['Result'] = 'No earlier TCAM snapshot, %d rows recorded as the baseline for epoch %s' % (
+                len(changes), epoch_id)
+            return []
+        changes.extend(('removed', key, counters) for key, counters in previous.items())
+
+        delta = []
+        counts = dict(added=0, changed=0, removed=0)
+        for change, key, counters in changes:
+            item = tcam_item(key, counters)
+            item['change'] = change
+            counts[change] += 1
+            delta.append(item)
+        self.result['tcam_delta_counts'] = counts
+        self.result['Result'] = '%d TCAM rows changed since epoch %s' % (len(delta), previous_id)
+        return delta
 
     def StartOnDemandAnalysis(self, iterations):
         runningLive = self.isLiveAnalysis()
@@ -1615,7 +3224,7 @@ class NAEModule(object):
 
             ag_iterations = json.dumps({'iterations': iterations})
             url = 'https://%(host)s:%(port)s/nae/api/v1/config-services/assured-networks/aci-fabric/%(fabric_uuid)s/start-analysis' % self.params
-            resp, auth = fetch_url(self.module, url,
+            resp, auth = self.send(url,
                                    data=ag_iterations,
                                    headers=self.http_headers,
                                    method='POST')
@@ -1627,39 +3236,49 @@ class NAEModule(object):
                 self.module.fail_json(
                     msg="OnDemand Analysis failed to start", **self.result)
 
-    def get_delta_analysis(self):
-        ret = self.get_delta_analyses()
-        for a in ret:
-            if a['unique_name'] == self.params.get('name'):
-                # self.result['analysis'] = a
-                return a
-        return None
-
-    def query_delta_analyses(self):
-        self.result['Delta analyses'] = self.get_delta_analyses()
+    def iter_jobs(self, job_type, name=None, status=None):
+        """
+        Lazily yield pages of the ag_name assurance group's jobs of
+        job_type.
 
-    def get_delta_analyses(self):
+        name and status are passed to NAE as unique_name and status
+        filters, but appliances that ignore them return everything, so
+        each page is filtered again here.
+        """
         self.params['fabric_id'] = str(
             self.get_assurance_group(
                 self.params.get('ag_name'))['uuid'])
-        url = 'https://%(host)s/nae/api/v1/job-services?$page=0&$size=100&$sort=status&$type=EPOCH_DELTA_ANALYSIS&assurance_group_id=%(fabric_id)s' % self.params
-        resp, auth = fetch_url(self.module, url, data=None,
-                               headers=self.http_headers, method='GET')
-        return json.loads(resp.read())['value']['data']
+        url = 'https://%(host)s:%(port)s/nae/api/v1/job-services?$sort=status' % self.params
+        url = url + '&$type=%s&assurance_group_id=%s' % (quote(job_type), quote(self.params['fabric_id']))
+        match = {}
+        if name:
+            url = url + '&unique_name=' + quote(name)
+            match['unique_name'] = name
+        if status:
+            url = url + '&status=' + quote(status)
+            match['status'] = status
+        for page in self.iter_pages(url):
+            yield [job for job in page if all(job.get(k) == v for k, v in match.items())]
+
+    def get_delta_analysis(self):
+        return find_item(self.iter_jobs('EPOCH_DELTA_ANALYSIS', name=self.params.get('name')),
+                         unique_name=self.params.get('name'))
+
+    def query_delta_analyses(self):
+        self.result['Delta analyses'] = self.get_delta_analyses(self.params.get('job_status'))
+
+    def get_delta_analyses(self, status=None):
+        return [job for page in self.iter_jobs('EPOCH_DELTA_ANALYSIS', status=status) for job in page]
 
     def delete_delta_analysis(self):
-        self.params['fabric_id'] = str(
-            self.get_assurance_group(
-                self.params.get('ag_name'))['uuid'])
-        try:
-            self.params['analysis_id'] = [analysis for analysis in self.get_delta_analyses(
-            ) if analysis['unique_name'] == self.params.get('name')][0]['uuid']
-        except IndexError:
+        analysis = self.get_delta_analysis()
+        if analysis is None:
             fail = "Delta analysis %(name)s does not exist on %(ag_name)s." % self.params
             self.module.fail_json(msg=fail, **self.result)
+        self.params['analysis_id'] = analysis['uuid']
 
         url = 'https://%(host)s/nae/api/v1/job-services/%(analysis_id)s' % self.params
-        resp, auth = fetch_url(self.module, url, data=None,
+        resp, auth = self.send(url, data=None,
                                headers=self.http_headers, method='DELETE')
         if 'OK' in auth.get('msg'):
             self.result['Result'] = 'Delta analysis %(name)s successfully deleted' % self.params
@@ -1668,13 +3287,21 @@ class NAEModule(object):
             self.module.fail_json(msg=fail, **self.result)
 
     def new_delta_analysis(self):
-        fabric_id = str(
-            self.get_assurance_group(
-                self.params.get('ag_name'))['uuid'])
-        epochs = list(self.get_epochs())
-        e = [epoch for epoch in epochs if epoch['fabric_id'] == fabric_id]
-        later_epoch_uuid = e[0]['epoch_id']
-        prior_epoch_uuid = e[1]['epoch_id']
+        epochs = {}
+        for selector in ('prior_epoch', 'later_epoch'):
+            epochs[selector] = self.resolve_epoch(self.params.get(selector))
+            if epochs[selector] is None:
+                self.module.fail_json(
+                    msg='No epoch matches %s %s' % (selector, self.params.get(selector)), **self.result)
+        if epoch_timestamp(epochs['prior_epoch']) >= epoch_timestamp(epochs['later_epoch']):
+            self.module.fail_json(
+                msg='prior_epoch %s is not older than later_epoch %s' % (
+                    epochs['prior_epoch']['epoch_id'], epochs['later_epoch']['epoch_id']),
+                **self.result)
+        later_epoch_uuid = epochs['later_epoch']['epoch_id']
+        prior_epoch_uuid = epochs['prior_epoch']['epoch_id']
+        self.result['prior_epoch'] = prior_epoch_uuid
+        self.result['later_epoch'] = later_epoch_uuid
         url = 'https://%(host)s/nae/api/v1/job-services' % self.params
         form = '''{
                "type": "EPOCH_DELTA_ANALYSIS",
@@ -1690,7 +3317,7 @@ class NAEModule(object):
                    }
                    ]
                }'''
-        resp, auth = fetch_url(self.module, url, data=form,
+        resp, auth = self.send(url, data=form,
                                headers=self.http_headers, method='POST')
 
         if 'OK' in auth.get('msg'):
@@ -1699,14 +3326,20 @@ class NAEModule(object):
             fail = "Delta analysis creation failed " + auth.get('msg')
             self.module.fail_json(msg=fail, **self.result)
 
-    def get_all_files(self):
+    def iter_pages(self, url):
+        """
+        Lazily yield the data of each page of a paged NAE collection,
+        requesting successive $page values with $size set to page_size.
+        """
+        page = 0
         has_more_data = True
+        separator = '&' if '?' in url else '?'
         while has_more_data:
-            url = 'https://%(host)s:%(port)s/nae/api/v1/file-services/upload-file' % self.params
-            resp, auth = fetch_url(self.module, url,
-                                headers=self.http_headers,
-                                data=None,
-                                method='GET')
+            page_url = url + separator + '$page=%d&$size=%d' % (page, self.params.get('page_size') or 100)
+            resp, auth = self.send(page_url,
+                                   headers=self.http_headers,
+                                   data=None,
+                                   method='GET')
 
             if auth.get('status') != 200:
                 if('filename' in self.params):
@@ -1717,33 +3350,34 @@ class NAEModule(object):
                         auth.get('body'))['messages'][0]['message'],
                     **self.result)
 
-            if resp.headers['Content-Encoding'] == "gzip":
-                r = gzip.decompress(resp.read())
-                has_more_data = json.loads(r.decode())['value']['data_summary']['has_more_data']
-                self.files.append(json.loads(r.decode())['value']['data'])
-            else:
-                r = resp.read()
-                has_more_data = json.loads(r)['value']['data_summary']['has_more_data']
-                self.files.append(json.loads(r)['value']['data'])
-            return self.files
-   
-    def delete_file(self):  
-        try:
-            for page in self.get_all_files():
-                self.params['file_id'] = [f for f in page if f['unique_name'] == self.params.get('name')][0]['uuid']
+            data, data_summary = read_page(resp)
+            has_more_data = data_summary['has_more_data']
+            page += 1
+            yield data
+
+    def iter_files(self):
+        url = 'https://%(host)s:%(port)s/nae/api/v1/file-services/upload-file' % self.params
+        return self.iter_pages(url)
+
+    def get_all_files(self):
+        self.files = list(self.iter_files())
+        return self.files
 
-        except IndexError:
+    def delete_file(self):
+        uploaded = find_item(self.iter_files(), unique_name=self.params.get('name'))
+        if not uploaded:
             fail = "File %(name)s does not exist on." % self.params
             self.module.fail_json(msg=fail, **self.result)
+        self.params['file_id'] = uploaded['uuid']
         url = 'https://%(host)s/nae/api/v1/file-services/upload-file/%(file_id)s' % self.params
-        resp, auth = fetch_url(self.module, url, data=None,
+        resp, auth = self.send(url, data=None,
                                headers=self.http_headers, method='DELETE')
         if 'OK' in auth.get('msg'):
             self.result['Result'] = 'File %(name)s successfully deleted' % self.params
         else:
             fail = "File  deleted failed " + auth.get('msg')
             self.module.fail_json(msg=fail, **self.result)
-   
+
     def newOfflineAnalysis(self):
         if self.isOnDemandAnalysis() or self.isLiveAnalysis():
             self.module.fail_json(msg="There is currently an  analysis running.",**self.result)
@@ -1751,16 +3385,14 @@ class NAEModule(object):
         if self.get_OfflineAnalysis(self.params.get('name')):
             self.result['Result']=  'Offline Analysis %(name)s elready exists ' % self.params
         else:    
-            self.get_all_files()
-            for uploadedFile in self.files:
-                fileID = [f for f in uploadedFile if f['unique_name'] == self.params.get('filename')]
-                if not fileID:
-                    self.module.fail_json(msg="File %(filename)s not found" % self.params ,**self.result) 
-            fileID = fileID[0]['uuid']
+            fileID = self.find_uploaded_file(self.params.get('filename'))
+            if not fileID:
+                self.module.fail_json(msg="File %(filename)s not found" % self.params ,**self.result) 
+            fileID = fileID['uuid']
             fabricID = self.get_assurance_group(self.params.get('ag_name'))
             if not fabricID:
                 self.module.fail_json(msg="Assurace Group %(name)s not found" % self.params ,**self.result) 
-            fabricID = self.get_assurance_group(self.params.get('ag_name'))["uuid"]
+            fabricID = fabricID["uuid"]
             form = '''{
             "unique_name": "''' + self.params.get('name') + '''",
             "file_upload_uuid": "''' + fileID +'''",
@@ -1772,12 +3404,12 @@ class NAEModule(object):
                 # 1 Create the Offline analysis
                 url ='https://%(host)s/nae/api/v1/config-services/offline-analysis' % self.params
 
-                resp, auth = fetch_url(self.module, url, data=form,
+                resp, auth = self.send(url, data=form,
                             headers=self.http_headers, method='POST')
             
                 if auth.get('status') == 202:
                     #Get the analysis UUID:
-                    analysis_id = json.loads(resp.read())['value']['data']['uuid']
+                    analysis_id = read_data(resp)['uuid']
 
                     url ='https://%(host)s/nae/api/v1/config-services/analysis' % self.params
 
@@ -1796,69 +3428,150 @@ class NAEModule(object):
                     ],
                     "iterations": 1
                     }'''
-                    resp, auth = fetch_url(self.module, url, data=form,
+                    resp, auth = self.send(url, data=form,
                                 headers=self.http_headers, method='POST')
                     if auth.get('status') == 202 or auth.get('status') == 200 :
                         self.result['Result']=  'Offline Analysis %(name)s successfully created' % self.params
                         if self.params['complete']:
-                            status = None
-                            while status != "ANALYSIS_COMPLETED":
-                                status = self.get_OfflineAnalysis(self.params.get('name'))['status']
-                                time.sleep(10)
+                            # Status comes from the paged analysis list, which
+                            # stops at the page holding this analysis.
+                            def probe():
+                                oa = self.get_OfflineAnalysis(self.params.get('name'))
+                                if oa and oa['status'] == "ANALYSIS_COMPLETED":
+                                    return oa
+                                return None
+                            if wait_for(probe, self.params.get('wait_timeout'), max_delay=60) is None:
+                                self.module.fail_json(
+                                    msg='Timed out waiting for Offline Analysis %(name)s to complete' % self.params, **self.result)
                 else:
                     fail = json.loads(auth.get('body'))['messages'][0]['message']
                     self.module.fail_json(msg=fail, **self.result)
             else:
                 self.module.fail_json(msg="Unsupported version", **self.result)
 
-    def get_all_OfflineAnalysis(self):
-        self.offlineAnalysis.clear()
-        has_more_data = True
-        while has_more_data:
-            url = 'https://%(host)s:%(port)s/nae/api/v1/config-services/offline-analysis' % self.params
-            resp, auth = fetch_url(self.module, url,
-                                headers=self.http_headers,
-                                data=None,
-                                method='GET')
-
-            if auth.get('status') != 200:
-                if('filename' in self.params):
-                    self.params['file'] = self.params['filename']
-                    del self.params['filename']
-                self.module.exit_json(
-                    msg=json.loads(
-                        auth.get('body'))['messages'][0]['message'],
-                    **self.result)
-
-            if resp.headers['Content-Encoding'] == "gzip":
-                r = gzip.decompress(resp.read())
-                has_more_data = json.loads(r.decode())['value']['data_summary']['has_more_data']
-                self.offlineAnalysis.append(json.loads(r.decode())['value']['data'])
+    def batch_item(self, **params):
+        """
+        Return a copy of this module sharing its session, with params
+        overridden and exit_json/fail_json raising NAEItemExit.
+        """
+        item = object.__new__(type(self))
+        item.__dict__.update(self.__dict__)
+        item.parent = self
+        item.params = dict(self.params, **params)
+        item.result = dict(changed=False)
+        item.module = NAEItemModule(self.module, item.params)
+        return item
+
+    def run_batch_item(self, status, stage, action):
+        """
+        Run action(), recording its outcome for the batch entry status and
+        returning whether it succeeded. Any exception fails the entry only.
+        """
+        status.pop('msg', None)
+        try:
+            action()
+            status['stage'] = stage
+            status['status'] = 'ok'
+        except NAEItemExit as e:
+            status['stage'] = stage
+            if e.failed:
+                status['status'] = 'failed'
+                status['msg'] = e.result.get('msg')
             else:
-                r= resp.read()
-                has_more_data = json.loads(r)['value']['data_summary']['has_more_data']
-                self.offlineAnalysis.append(json.loads(r)['value']['data'])
-            return self.offlineAnalysis
+                # exit_json is used both for success and for "nothing to do"
+                status['status'] = 'ok'
+                status['msg'] = e.result.get('msg')
+        except Exception as e:
+            # Unexpected errors (unreadable files, bad responses) only fail
+            # this entry.
+            status['stage'] = stage
+            status['status'] = 'failed'
+            status['msg'] = to_native(e)
+        status_file = self.params.get('batch_status_file')
+        if status_file:
+            with self.batch_status_lock:
+                with open(status_file, 'a') as f:
+                    f.write(json.dumps(status) + '\n')
+        return status['status'] == 'ok'
+
+    def offline_batch(self):
+        """
+        Upload a batch of offline collections and analyse each of them in
+        one session.
+
+        Files are uploaded by batch_workers threads. Offline analyses are
+        then created and run one at a time, as NAE only runs one analysis
+        at a time: before each, wait for any running analysis to finish.
+        Each entry's outcome is appended to batch_status_file as soon as
+        it is known; a failed entry does not stop the others.
+        """
+        entries = []
+        for entry in self.params.get('batch'):
+            filename = entry.get('filename') or os.path.basename(entry['file'])
+            entries.append(dict(file=entry['file'],
+                                filename=filename,
+                                name=entry.get('name') or filename))
+        statuses = [dict(name=e['name'], filename=e['filename'], stage='upload', status='pending')
+                    for e in entries]
+
+        def upload(entry, status):
+            item = self.batch_item(file=entry['file'], name=entry['filename'])
+
+            def action():
+                if item.find_uploaded_file(entry['filename']):
+                    status['msg'] = 'File %s already uploaded' % entry['filename']
+                    return
+                item.upload_file()
+            return self.run_batch_item(status, 'upload', action)
+
+        workers = max(1, self.params.get('batch_workers') or 1)
+        with self.get_logout_lock():
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                uploaded = list(pool.map(upload, entries, statuses))
+
+        for entry, status, ok in zip(entries, statuses, uploaded):
+            if not ok:
+                continue
+            item = self.batch_item(name=entry['name'], filename=entry['filename'], complete=True)
+
+            def idle():
+                item.invalidate_assurance_groups()
+                if item.isOnDemandAnalysis() or item.isLiveAnalysis():
+                    return None
+                return True
+
+            def action():
+                if wait_for(idle, self.params.get('wait_timeout'), max_delay=60) is None:
+                    item.module.fail_json(msg='Timed out waiting for the running analysis to finish')
+                item.newOfflineAnalysis()
+            self.run_batch_item(status, 'analysis', action)
+
+        self.result['batch'] = statuses
+        failed = [s['name'] for s in statuses if s['status'] != 'ok']
+        self.result['changed'] = len(failed) < len(statuses)
+        if failed:
+            self.module.fail_json(msg='Batch entries failed: %s' % ', '.join(failed), **self.result)
+        self.result['Result'] = '%d offline analyses completed' % len(statuses)
+
+    def iter_OfflineAnalysis(self):
+        url = 'https://%(host)s:%(port)s/nae/api/v1/config-services/offline-analysis' % self.params
+        return self.iter_pages(url)
+
+    def get_all_OfflineAnalysis(self):
+        self.offlineAnalysis = list(self.iter_OfflineAnalysis())
+        return self.offlineAnalysis
 
     def get_OfflineAnalysis(self, name):
-        self.get_all_OfflineAnalysis()
-        #To support multipl pages of returned data 
-        for pages in self.offlineAnalysis:
-            for oa in pages:
-                if oa['unique_name'] == name:
-                    return oa
-        return None
-    
-    def deleteOfflineAnalysis(self):  
-            try:
-                for page in self.get_all_OfflineAnalysis():
-                    self.params['OfflineAnalysisId'] = [f for f in page if f['unique_name'] == self.params.get('name')][0]['uuid']
+        return find_item(self.iter_OfflineAnalysis(), unique_name=name)
 
-            except IndexError:
+    def deleteOfflineAnalysis(self):
+            analysis = self.get_OfflineAnalysis(self.params.get('name'))
+            if not analysis:
                 fail = "Offline Analysis %(name)s does not exist on." % self.params
                 self.module.fail_json(msg=fail, **self.result)
+            self.params['OfflineAnalysisId'] = analysis['uuid']
             url = 'https://%(host)s/nae/api/v1/config-services/offline-analysis/%(OfflineAnalysisId)s' % self.params
-            resp, auth = fetch_url(self.module, url, data=None,
+            resp, auth = self.send(url, data=None,
                                 headers=self.http_headers, method='DELETE')
             if 'OK' in auth.get('msg'):
                 self.result['Result'] = 'Offline Analysis %(name)s successfully deleted' % self.params
@@ -35,6 +35,38 @@ options:
     type: str
     required: yes
     aliases: [ name ]
+  prior_epoch:
+    description:
+    - Epoch the delta analysis compares from.
+    - Either an epoch id, an offset from the latest epoch (C(0) is the latest, C(-1) the one before it),
+      a Unix timestamp in seconds or milliseconds, or an ISO 8601 date and time (UTC unless an offset is given).
+    - A time selects the last epoch collected at or before it.
+    type: str
+    default: '-1'
+  later_epoch:
+    description:
+    - Epoch the delta analysis compares to, in the same forms as I(prior_epoch).
+    type: str
+    default: '0'
+  diff:
+    description:
+    - When querying a named analysis, fetch the smart events of both epochs once and diff them locally
+      instead of only listing later-epoch events.
+    - The result holds a C(smart_event_diff) summary of added, removed, count_changed and unchanged events,
+      by severity, as classified by the epoch status NAE reports for each event.
+      The query fails if events above INFO were added or their count grew.
+    type: bool
+    default: no
+  diff_dir:
+    description:
+    - With I(diff), directory the events of each change are written to, as C(<name>-<change>.json).
+    type: path
+    required: no
+  job_status:
+    description:
+    - When querying all delta analyses, only return those with this status, e.g. C(COMPLETED_SUCCESSFULLY).
+    type: str
+    required: no
   state:
     description:
     - Use C(present) or C(absent) for adding or removing.
@@ -57,6 +89,17 @@ EXAMPLES = \
     ag_name: fab1
     name: Delta_Analysis_1
     state: present
+- name: Create delta analysis across a change window
+  nae_delta:
+    host: nae
+    port: 8080
+    username: Admin
+    password: 1234
+    ag_name: fab1
+    name: Change_Window_42
+    prior_epoch: '2026-10-03T22:00:00Z'
+    later_epoch: '2026-10-04T02:00:00Z'
+    state: present
 - name: Query delta analysis results
   nae_delta:
     host: nae
@@ -84,6 +127,11 @@ def main():
     argument_spec.update(  # Not required for querying all objects
         validate_certs=dict(type='bool', default=False),
         name=dict(type='str', default=""),
+        prior_epoch=dict(type='str', default='-1'),
+        later_epoch=dict(type='str', default='0'),
+        job_status=dict(type='str'),
+        diff=dict(type='bool', default=False),
+        diff_dir=dict(type='path'),
         ag_name=dict(type='str', default=""),
         state=dict(type='str', default="")
     )
@@ -35,6 +35,34 @@ options:
     type: str
     required: no
     aliases: [ file_name ]
+  dedup:
+    description:
+    - Skip the upload when a file with the same content was already uploaded to this NAE, and return that file.
+    - Uploads are recorded by SHA-256 of their content in an index under I(cache_dir)/uploads, checked against
+      the files NAE reports. When the existing file has another name, I(name) is recorded as an alias for it,
+      which M(nae_offline_analysis) resolves.
+    - The result holds the file's C(uuid) and C(deduplicated), true when the upload was skipped. The name of the
+      existing file is then in C(duplicate_of).
+    type: bool
+    default: no
+  resume:
+    description:
+    - Record the progress of the upload in a manifest under I(cache_dir)/uploads, so that a rerun after a
+      failed or interrupted upload only sends the chunks that were not acknowledged and then completes it.
+    - The manifest is removed once the upload completes.
+    type: bool
+    default: yes
+  upload_workers:
+    description:
+    - Number of file chunks uploaded concurrently.
+    type: int
+    default: 4
+  wait_timeout:
+    description:
+    - How long to wait, in seconds, for NAE to finish processing an uploaded file.
+    - Status is polled with an exponential backoff, starting at a couple of seconds.
+    type: int
+    default: 300
   state:
     description:
     - Use C(present) or C(absent) for adding or removing.
@@ -94,6 +122,10 @@ def main():
         file=dict(type='str', aliases=['file_name']),
         state=dict(type='str', default='present', choices=['absent',
                                                            'present', 'query']),
+        dedup=dict(type='bool', default=False),
+        resume=dict(type='bool', default=True),
+        upload_workers=dict(type='int', default=4),
+        wait_timeout=dict(type='int', default=300),
         validate_certs=dict(type='bool', default=False)
     )
 
@@ -32,9 +32,53 @@ options:
   filename:
     description:
     - The uploaded file name
+    - Names recorded as aliases by M(nae_file_management) with I(dedup) resolve to the file they duplicate.
     type: str
     required: no
     aliases: [ file_name ]
+  batch:
+    description:
+    - Upload and analyse several offline collections in one task, instead of I(name) and I(filename).
+    - Files are uploaded concurrently, then one offline analysis per file is created and run to completion,
+      one at a time, in list order.
+    - The outcome of each entry is returned in C(batch).
+    type: list
+    elements: dict
+    suboptions:
+      file:
+        description:
+        - Path of the offline collection to upload.
+        type: path
+        required: yes
+      filename:
+        description:
+        - Unique name of the uploaded file. Defaults to the base name of I(file).
+        - A file already uploaded under this name is not uploaded again.
+        type: str
+      name:
+        description:
+        - Unique name of the offline analysis. Defaults to I(filename).
+        type: str
+  batch_workers:
+    description:
+    - Number of I(batch) files uploaded concurrently.
+    type: int
+    default: 2
+  batch_status_file:
+    description:
+    - Local file the outcome of each I(batch) entry is appended to, as a JSON line, as soon as it is known.
+    type: path
+  upload_workers:
+    description:
+    - Number of chunks of each I(batch) file uploaded concurrently.
+    type: int
+    default: 4
+  wait_timeout:
+    description:
+    - How long to wait, in seconds, for the offline analysis to complete when I(complete) is set.
+    - Status is polled with an exponential backoff, starting at a couple of seconds.
+    type: int
+    default: 3600
   state:
     description:
     - Use C(present) or C(absent) for adding or removing.
@@ -67,6 +111,19 @@ EXAMPLES = \
     name: OfflineAnalysis_1
     ag_name: Assurance_Group_1
     filename: OfflineCollection_1
+- name: Upload and analyse a batch of offline collections
+  nae_offline_analysis:
+    host: nae
+    port: 8080
+    username: Admin
+    password: 1234
+    state: present
+    ag_name: Assurance_Group_1
+    batch:
+    - file: /data/epochs/collection_0101.tar.gz
+    - file: /data/epochs/collection_0102.tar.gz
+      name: OfflineAnalysis_0102
+    batch_status_file: /tmp/nae_batch.jsonl
 - name: Delete Offline/Online Assurance Group
   nae_offline_analysis:
     host: nae
@@ -97,14 +154,23 @@ def main():
         complete=dict(type='bool', default=False),
         state=dict(type='str', default='present', choices=['absent',
                                                            'present', 'query','complete']),
+        batch=dict(type='list', elements='dict', options=dict(
+            file=dict(type='path', required=True),
+            filename=dict(type='str'),
+            name=dict(type='str'),
+        )),
+        batch_workers=dict(type='int', default=2),
+        batch_status_file=dict(type='path'),
+        upload_workers=dict(type='int', default=4),
+        wait_timeout=dict(type='int', default=3600),
         validate_certs=dict(type='bool', default=False)
     )
 
     module = AnsibleModule(argument_spec=argument_spec,
                            supports_check_mode=True,
                            required_if=[['state', 'absent', ['name']],
-                                        ['state', 'present', ['filename']],
-                                        ['state', 'present', ['name']],
+                                        ['state', 'present', ['filename', 'batch'], True],
+                                        ['state', 'present', ['name', 'batch'], True],
                                         ['state', 'present', ['ag_name']],
                                         ])
 
@@ -114,7 +180,10 @@ def main():
     ag_name = module.params.get('ag_name')
     nae = NAEModule(module)
 
-    if state == 'present':
+    if state == 'present' and module.params.get('batch'):
+        nae.offline_batch()
+        module.exit_json(**nae.result)
+    elif state == 'present':
         nae.newOfflineAnalysis()
         module.exit_json(**nae.result)
     elif state == 'absent':
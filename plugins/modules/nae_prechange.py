@@ -45,8 +45,43 @@ options:
   verify:
     description:
     - Flag specifying if pre-change analysis is made from aci config dump.
+    - The flat dump is converted to a hierarchical payload which is cached under I(cache_dir), keyed by the
+      SHA-256 of the file, so repeat runs of the same file skip parsing. The input file is not modified.
     type: bool
     required: no
+  gate_severity:
+    description:
+    - When querying a named analysis, only check whether the later epoch has smart events of this severity or higher.
+    - Only those severities are fetched, and reading stops as soon as I(gate_sample) of them have been found, instead
+      of returning the full table. The query fails if any are found.
+    type: str
+    choices: [ critical, major, minor, warning ]
+    required: no
+  gate_sample:
+    description:
+    - With I(gate_severity), the maximum number of offending smart events to return.
+    type: int
+    default: 5
+  diff:
+    description:
+    - When querying a named analysis, fetch the smart events of both epochs once and diff them locally
+      instead of only listing later-epoch events.
+    - The result holds a C(smart_event_diff) summary of added, removed, count_changed and unchanged events,
+      by severity, as classified by the epoch status NAE reports for each event.
+      The query fails if events above INFO were added or their count grew.
+    type: bool
+    default: no
+  diff_dir:
+    description:
+    - With I(diff), directory the events of each change are written to, as C(<name>-<change>.json).
+    type: path
+    required: no
+  wait_timeout:
+    description:
+    - How long to wait, in seconds, for the pre-change analysis to complete when querying with I(verify).
+    - Status is polled with an exponential backoff, starting at a couple of seconds.
+    type: int
+    default: 3600
   state:
     description:
     - Use C(present) or C(absent) for adding or removing.
@@ -60,6 +95,17 @@ options:
   changes:
     description:
     - Optional parameter if creating new pre-change analysis from change-list (manual)
+  aci_class_map:
+    description:
+    - Additional or overriding mappings of DN prefix to ACI class used when parsing a flat config dump (C(verify)).
+    - 'E.g. C({"lbp": "l3extLoopBackIfP"}).'
+    type: dict
+    required: no
+  aci_class_file:
+    description:
+    - Path to a JSON file with additional mappings of DN prefix to ACI class, applied before I(aci_class_map).
+    type: path
+    required: no
 author:
 - Shantanu Kulkarni (@shan_kulk)
 '''
@@ -120,6 +166,17 @@ delegate_to: localhost
     name: Analysis1
     state: query
   delegate_to: localhost
+- name: Fail the pipeline if a pre-change analysis found CRITICAL or MAJOR events
+  nae_prechange:
+    host: nae
+    port: 8080
+    username: Admin
+    password: C@ndidadmin1234
+    ag_name: FAB2
+    name: Analysis1
+    gate_severity: major
+    state: query
+  delegate_to: localhost
 - name: Query all pre-change analyses
   nae_prechange:
     host: nae
@@ -153,6 +210,13 @@ def main():
         changes=dict(type='str'),
         verify=dict(type='bool', default=False),
         file=dict(type='str', default=None),
+        aci_class_map=dict(type='dict', default=None),
+        aci_class_file=dict(type='path', default=None),
+        wait_timeout=dict(type='int', default=3600),
+        gate_severity=dict(type='str', choices=['critical', 'major', 'minor', 'warning']),
+        gate_sample=dict(type='int', default=5),
+        diff=dict(type='bool', default=False),
+        diff_dir=dict(type='path'),
         validate_certs=dict(type='bool', default=False),
         state=dict(type='str', default='present', choices=['absent',
                                                            'present', 'query']),
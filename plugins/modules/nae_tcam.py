@@ -34,6 +34,68 @@ options:
     - Path to file to write tcam data to (csv)
     type: str
     required: no
+  csv_columns:
+    description:
+    - Columns to write to the csv file, in order.
+    - Defaults to all of C(Provider EPG), C(Consumer EPG), C(Consumer VRF), C(Contract), C(Filter),
+      C(Monthly Hits), C(Total Hits) and C(TCAM Usage).
+    type: list
+    elements: str
+    required: no
+  compress:
+    description:
+    - Write the csv gzip compressed, to C(<file>.csv.gz).
+    type: bool
+    default: no
+  group_by:
+    description:
+    - Return per-group totals of rules, C(tcam_entry_count), C(cumulative_count) and C(month_count)
+      in C(tcam_summary) instead of the raw pages.
+    - C(epg_pair) groups by provider and consumer EPG.
+    type: str
+    choices: [ contract, epg_pair, vrf, filter, provider_epg, consumer_epg ]
+    required: no
+  sort_by:
+    description:
+    - Counter the C(group_by) totals are sorted by, largest first.
+    type: str
+    choices: [ tcam_entry_count, cumulative_count, month_count, rules ]
+    default: tcam_entry_count
+  zero_hit:
+    description:
+    - Return rules that were never hit, largest TCAM usage first, in C(zero_hit).
+    type: bool
+    default: no
+  top:
+    description:
+    - Only return the first N groups or zero-hit rules.
+    type: int
+    required: no
+  delta:
+    description:
+    - Return only the rows whose counters changed since the most recent earlier epoch with a local snapshot,
+      in C(tcam_delta). With I(file), only those rows are written, with a leading C(Change) column.
+    - Each run stores a snapshot of the latest epoch under I(cache_dir)/tcam. The first run has nothing to
+      compare against, it only records the baseline and reports how many rows it holds.
+    - The number of added, changed and removed rows is returned in C(tcam_delta_counts).
+    type: bool
+    default: no
+  keep_snapshots:
+    description:
+    - Number of TCAM snapshots kept per assurance group when I(delta) is set. The snapshots of the most
+      recent epochs are kept.
+    type: int
+    default: 48
+  tcam_page_size:
+    description:
+    - Number of TCAM rule buckets requested per page.
+    type: int
+    default: 200
+  tcam_workers:
+    description:
+    - Number of pages fetched concurrently. Pages are still returned in order.
+    type: int
+    default: 4
 author:
 - Shantanu Kulkarni (@shan_kulk)
 '''
@@ -54,6 +116,16 @@ EXAMPLES = \
     password: 1234
     ag_name: fab1
     file: tcam_data
+- name: Top 10 contracts by TCAM usage and the rules that were never hit
+  nae_tcam:
+    host: nae
+    port: 8080
+    username: Admin
+    password: 1234
+    ag_name: fab1
+    group_by: contract
+    zero_hit: yes
+    top: 10
 '''
 
 RETURN = \
@@ -72,7 +144,19 @@ def main():
     argument_spec.update(  # Not required for querying all objects
         validate_certs=dict(type='bool', default=False),
         file=dict(type='str', default=""),
-        ag_name=dict(type='str', default="")
+        ag_name=dict(type='str', default=""),
+        csv_columns=dict(type='list', elements='str'),
+        compress=dict(type='bool', default=False),
+        group_by=dict(type='str', choices=['contract', 'epg_pair', 'vrf', 'filter',
+                                           'provider_epg', 'consumer_epg']),
+        sort_by=dict(type='str', default='tcam_entry_count',
+                     choices=['tcam_entry_count', 'cumulative_count', 'month_count', 'rules']),
+        zero_hit=dict(type='bool', default=False),
+        top=dict(type='int'),
+        delta=dict(type='bool', default=False),
+        keep_snapshots=dict(type='int', default=48),
+        tcam_page_size=dict(type='int', default=200),
+        tcam_workers=dict(type='int', default=4)
     )
 
     module = AnsibleModule(argument_spec=argument_spec,
@@ -81,9 +165,25 @@ def main():
     file = module.params.get('file')
     ag_name = module.params.get('ag_name')
     nae = NAEModule(module)
+    if ag_name and module.params.get('delta'):
+        delta = nae.get_tcam_delta()
+        if file:
+            nae.tcam_to_csv(pages=[delta], change=True)
+        else:
+            nae.result['tcam_delta'] = delta
+        module.exit_json(**nae.result)
     if ag_name and file:
         nae.tcam_to_csv()
         module.exit_json(**nae.result)
+    if ag_name and (module.params.get('group_by') or module.params.get('zero_hit')):
+        dataset = nae.get_tcam_dataset()
+        if module.params.get('group_by'):
+            nae.result['tcam_summary'] = dataset.group_by(module.params.get('group_by'),
+                                                          module.params.get('sort_by'),
+                                                          module.params.get('top'))
+        if module.params.get('zero_hit'):
+            nae.result['zero_hit'] = dataset.zero_hit(module.params.get('top'))
+        module.exit_json(**nae.result)
     if ag_name:
         nae.result['tcam'] = nae.get_tcam_stats()
         module.exit_json(**nae.result)
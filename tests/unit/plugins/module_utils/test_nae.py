@@ -0,0 +1,1050 @@
+# -*- coding: utf-8 -*-
+
+# GNU General Public License v3.0+ (see COPYING or
+# https://www.gnu.org/licenses/gpl-3.0.txt)
+
+from __future__ import absolute_import, division, print_function
+__metaclass__ = type
+
+import gzip
+import io
+import json
+import os
+import random
+import re
+import threading
+import time
+
+import pytest
+import requests
+
+try:
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+
+    class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+        daemon_threads = True
+
+from ansible_collections.cisco.nae.plugins.module_utils import nae
+from ansible_collections.cisco.nae.plugins.module_utils.nae import (
+    EpochIndex,
+    NAEModule,
+    NAESessionCache,
+    TcamDataset,
+    UploadManifest,
+    diff_smart_events,
+    iter_json_array_items,
+    iter_json_key_array,
+    wait_for,
+)
+
+
+class AnsibleExitJson(Exception):
+    pass
+
+
+class AnsibleFailJson(Exception):
+    pass
+
+
+class FakeAnsibleModule(object):
+    def __init__(self, params):
+        self.params = params
+
+    def exit_json(self, **kwargs):
+        raise AnsibleExitJson(kwargs)
+
+    def fail_json(self, **kwargs):
+        raise AnsibleFailJson(kwargs)
+
+
+class FakeResponse(object):
+    def __init__(self, body=b'', headers=None):
+        if not isinstance(body, bytes):
+            body = json.dumps(body).encode()
+        self.body = io.BytesIO(body)
+        self.headers = headers or {}
+        self.closed = False
+
+    def read(self, amt=None):
+        return self.body.read(amt)
+
+    def close(self):
+        self.closed = True
+
+
+def page(data, has_more_data=False):
+    return {'value': {'data': data, 'data_summary': {'has_more_data': has_more_data}}}
+
+
+class FakeNAE(object):
+    """
+    Transport answering the login handshake and any routes added to it.
+
+    A route maps (method, url regex) to a handler called with the url and
+    the request headers, returning (status, body) or (status, body,
+    response headers). Every request is recorded in calls.
+    """
+
+    def __init__(self):
+        self.calls = []
+        self.logins = 0
+        self.token = 'token-0'
+        self.routes = []
+        self.route('GET', r'/whoami$', lambda url, headers: (200, {}, {
+            'Set-Cookie': 'otp-cookie', 'X-NAE-LOGIN-OTP': 'otp'}))
+        self.route('POST', r'/login$', self.login)
+        self.route('GET', r'/candid-version$', lambda url, headers: (200, page({'candid_version': '5.1'})))
+        self.route('POST', r'/logout$', lambda url, headers: (200, {}))
+
+    def route(self, method, pattern, handler):
+        self.routes.insert(0, (method, re.compile(pattern), handler))
+
+    def login(self, url, headers):
+        self.logins += 1
+        self.token = 'token-%d' % self.logins
+        return 200, {}, {'Set-Cookie': 'cookie-%d' % self.logins, 'X-NAE-CSRF-TOKEN': self.token}
+
+    def authorized(self, headers):
+        return headers.get('X-NAE-CSRF-TOKEN') == self.token
+
+    def request(self, method, url, headers=None, data=None, files=None, timeout=-1, stream=False):
+        headers = dict(headers or {})
+        self.calls.append((method, url, headers))
+        for route_method, pattern, handler in self.routes:
+            if route_method == method and pattern.search(url):
+                reply = handler(url, headers)
+                break
+        else:
+            reply = (404, {'messages': [{'message': 'No route for %s %s' % (method, url)}]})
+        status, body = reply[:2]
+        resp = FakeResponse(body, reply[2] if len(reply) > 2 else None)
+        info = dict(url=url, status=status, msg='HTTP %d' % status)
+        if status >= 400:
+            info['body'] = resp.read().decode()
+            resp = None
+        return resp, info
+
+
+@pytest.fixture
+def transport():
+    return FakeNAE()
+
+
+@pytest.fixture
+def make_nae(tmp_path, transport):
+    created = []
+
+    def make_nae(**params):
+        args = dict(host='nae', port=443, username='admin', password='secret',
+                    session_cache=False, session_ttl=900, ag_cache_ttl=60,
+                    cache_dir=str(tmp_path / 'cache'), page_size=100, validate_certs=False)
+        args.update(params)
+        module = NAEModule(FakeAnsibleModule(args), transport=transport)
+        created.append(module)
+        return module
+    yield make_nae
+    del created[:]
+
+
+# NAEModule.send (user-001)
+
+def test_login_sets_session_headers(make_nae, transport):
+    module = make_nae()
+    assert transport.logins == 1
+    assert module.http_headers['Cookie'] == 'cookie-1'
+    assert module.http_headers['X-NAE-CSRF-TOKEN'] == 'token-1'
+    assert 'X-NAE-LOGIN-OTP' not in module.http_headers
+    assert module.version == '5.1'
+
+
+def cache_session(tmp_path, token):
+    NAESessionCache(str(tmp_path / 'cache'), 900).save('nae', 443, 'admin', 'cached-cookie', token, '5.1')
+
+
+def test_send_reuses_cached_session(make_nae, transport, tmp_path):
+    cache_session(tmp_path, 'token-0')
+    transport.route('GET', r'/thing$', lambda url, headers: (200 if transport.authorized(headers) else 401, page([])))
+    module = make_nae(session_cache=True)
+    resp, auth = module.send('https://nae:443/nae/api/v1/thing')
+    assert auth['status'] == 200
+    assert transport.logins == 0
+
+
+def test_send_relogs_in_on_expired_cached_session(make_nae, transport, tmp_path):
+    cache_session(tmp_path, 'stale')
+    transport.route('GET', r'/thing$', lambda url, headers: (200 if transport.authorized(headers) else 401, page([])))
+    module = make_nae(session_cache=True)
+    headers = module.http_headers.copy()
+    resp, auth = module.send('https://nae:443/nae/api/v1/thing', headers=headers)
+    assert auth['status'] == 200
+    assert transport.logins == 1
+    assert headers['X-NAE-CSRF-TOKEN'] == 'token-1'
+    assert [c[1].rsplit('/', 1)[-1] for c in transport.calls] == ['thing', 'whoami', 'login', 'candid-version', 'thing']
+    # The fresh session replaced the stale one in the cache.
+    assert NAESessionCache(str(tmp_path / 'cache'), 900).load('nae', 443, 'admin')['csrf_token'] == 'token-1'
+
+
+def test_send_does_not_retry_fresh_session(make_nae, transport):
+    transport.route('GET', r'/thing$', lambda url, headers: (401, {'messages': [{'message': 'denied'}]}))
+    module = make_nae()
+    resp, auth = module.send('https://nae:443/nae/api/v1/thing')
+    assert auth['status'] == 401
+    assert transport.logins == 1
+
+
+def test_send_does_not_replay_streamed_body(make_nae, transport, tmp_path):
+    cache_session(tmp_path, 'stale')
+    transport.route('POST', r'/upload$', lambda url, headers: (200 if transport.authorized(headers) else 401, page([])))
+    module = make_nae(session_cache=True)
+    resp, auth = module.send('https://nae:443/nae/api/v1/upload', data=io.BytesIO(b'body'), method='POST')
+    assert auth['status'] == 401
+    assert transport.logins == 1
+    assert len([c for c in transport.calls if c[1].endswith('/upload')]) == 1
+
+
+# RequestsTransport (user-002)
+
+class KeepAliveHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    connections = []
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.connections.append(self.client_address)
+
+    def do_GET(self):
+        body = gzip.compress(json.dumps(page([{'n': n} for n in range(1000)])).encode())
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_POST = do_GET
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def http_server():
+    del KeepAliveHandler.connections[:]
+    server = ThreadingHTTPServer(('127.0.0.1', 0), KeepAliveHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield 'http://127.0.0.1:%d' % server.server_address[1]
+    server.shutdown()
+    server.server_close()
+
+
+def test_transport_reuses_connection_for_unread_responses(http_server):
+    transport = nae.RequestsTransport(pool_size=1)
+    transport.session = requests.Session()
+    transport.session.mount('http://', requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=1))
+    for dummy in range(3):
+        resp, auth = transport.request('POST', http_server + '/nae/api/v1/logout')
+        assert auth['status'] == 200
+    resp, auth = transport.request('GET', http_server + '/nae/api/v1/epochs')
+    assert nae.read_data(resp)[-1] == {'n': 999}
+    assert len(KeepAliveHandler.connections) == 1
+
+
+def test_transport_streamed_response(http_server):
+    transport = nae.RequestsTransport(pool_size=1)
+    transport.session = requests.Session()
+    resp, auth = transport.request('GET', http_server + '/nae/api/v1/epochs', stream=True)
+    assert resp.headers['Content-Encoding'] == 'gzip'
+    chunks = (chunk.decode() for chunk in nae.iter_response_body(resp, chunk_size=512))
+    assert [item['n'] for item in nae.iter_json_key_array(chunks, 'data')][-1] == 999
+    resp.close()
+
+
+def split(text, cuts):
+    """
+    Cut text at the given offsets into a list of chunks.
+    """
+    bounds = [0] + sorted(cuts) + [len(text)]
+    return [text[a:b] for a, b in zip(bounds, bounds[1:])]
+
+
+def random_splits(text, trials=100, seed=0):
+    rng = random.Random(seed)
+    for dummy in range(trials):
+        yield split(text, rng.sample(range(1, len(text)), rng.randint(0, min(30, len(text) - 1))))
+
+
+# iter_json_array_items / iter_json_key_array (user-005)
+
+ITEMS = [1, -2.5e3, "a \"quoted\" \\ string é", None, True, {"dn": "uni/tn-a", "x": [1, 2, {}]}, [], 12345678901234]
+
+
+def test_array_items_whole():
+    assert list(iter_json_array_items([json.dumps(ITEMS)])) == ITEMS
+
+
+def test_array_items_every_split():
+    text = json.dumps(ITEMS)
+    for i in range(1, len(text)):
+        assert list(iter_json_array_items([text[:i], text[i:]])) == ITEMS
+
+
+def test_array_items_random_splits():
+    text = json.dumps(ITEMS, indent=2)
+    for chunks in random_splits(text):
+        assert list(iter_json_array_items(chunks)) == ITEMS
+
+
+def test_array_items_single_chars():
+    text = json.dumps(ITEMS)
+    assert list(iter_json_array_items(iter(text))) == ITEMS
+
+
+def test_array_items_number_split_at_boundary():
+    assert list(iter_json_array_items(['[12', '34, 5', '6]'])) == [1234, 56]
+
+
+def test_array_items_concatenated_arrays():
+    chunks = ['[1, 2]\n', '[3]', ' []\r\n[4]']
+    assert list(iter_json_array_items(chunks)) == [1, 2, 3, 4]
+    assert list(iter_json_array_items(chunks, single=True)) == [1, 2]
+
+
+def test_array_items_empty():
+    assert list(iter_json_array_items(['[]'])) == []
+    assert list(iter_json_array_items([])) == []
+    assert list(iter_json_array_items(['  ', ''])) == []
+
+
+@pytest.mark.parametrize('text', [
+    '{"a": 1}',
+    '[1, 2',
+    '[1 2]',
+    '[1,]',
+    '[,1]',
+    '[1, {"a": ]',
+    '["unterminated]',
+])
+def test_array_items_malformed(text):
+    with pytest.raises(ValueError):
+        list(iter_json_array_items([text]))
+
+
+def test_array_items_malformed_split():
+    with pytest.raises(ValueError):
+        list(iter_json_array_items(['[1, {"a"', ': tru', 'x}]']))
+
+
+def test_key_array_random_splits():
+    doc = {'value': {'meta': '"data": fake', 'data': [{'i': i, 's': 'x"data":['} for i in range(50)],
+                     'data_summary': {'has_more_data': False}}}
+    text = json.dumps(doc)
+    for chunks in random_splits(text):
+        assert [x['i'] for x in iter_json_key_array(chunks, 'data')] == list(range(50))
+
+
+def test_key_array_stops_after_array():
+    def chunks():
+        yield '{"data": [1, 2], "rest": '
+        raise AssertionError('read past the array')
+    assert list(iter_json_key_array(chunks(), 'data')) == [1, 2]
+
+
+def test_key_array_missing_key():
+    with pytest.raises(ValueError):
+        list(iter_json_key_array(['{"value": ', '{"other": []}}'], 'data'))
+
+
+def test_first_json_char(tmp_path):
+    path = tmp_path / 'payload.json'
+    path.write_text(u' \n' * 5000 + u'{"imdata": []}')
+    assert nae.first_json_char(str(path), block_size=64) == '{'
+    path.write_text(u'\r\n[1]\n[2]')
+    assert nae.first_json_char(str(path)) == '['
+    path.write_text(u'  ')
+    assert nae.first_json_char(str(path)) == ''
+
+
+def test_parsed_payload_passthrough(make_nae, tmp_path):
+    path = tmp_path / 'payload.json'
+    path.write_text(u'\n{"totalCount": "1", "imdata": [{"fvTenant": {"attributes": {"dn": "uni/tn-a"}}}]}')
+    module = make_nae()
+    assert module.get_parsed_payload(str(path)) == str(path)
+    # Recorded, so the next run does not even look at the content.
+    assert module.get_parsed_payload(str(path)) == str(path)
+
+
+# DN tree (user-006, user-008)
+
+def mo(aci_class, dn, children=None, **attributes):
+    attributes['dn'] = dn
+    desc = {'attributes': attributes}
+    if children is not None:
+        desc['children'] = children
+    return {aci_class: desc}
+
+
+def build(module, items):
+    dn_index = {}
+    cmap = {}
+    tree = module.construct_tree(items, dn_index, cmap)
+    module.copy_children(dn_index, cmap)
+    out = io.StringIO()
+    module.export_tree(module.find_tree_roots(tree), out)
+    return json.loads(out.getvalue())
+
+
+def test_construct_tree_nests_by_dn(make_nae):
+    module = make_nae()
+    dn_index = {}
+    tree = module.construct_tree([
+        mo('fvAEPg', 'uni/tn-a/ap-x/epg-w'),
+        mo('fvTenant', 'uni/tn-a', descr='A'),
+        mo('fvBD', 'uni/tn-a/BD-b'),
+    ], dn_index, {})
+    assert set(tree.children) == {'uni'}
+    tenant = tree.children['uni'].children['tn-a']
+    assert tenant.data == ('fvTenant', {'dn': 'uni/tn-a', 'descr': 'A'})
+    # Intermediate nodes without an item get the DN and class of their prefix.
+    assert tenant.children['ap-x'].data == ('fvAp', {'dn': 'uni/tn-a/ap-x'})
+    assert dn_index['uni/tn-a/ap-x/epg-w'] is tenant.children['ap-x'].children['epg-w']
+    assert [r.name for r in module.find_tree_roots(tree)] == ['tn-a']
+
+
+def test_export_tree_appends_existing_children(make_nae):
+    module = make_nae()
+    existing = mo('fvRsCtx', 'uni/tn-a/BD-b/rsctx', tnFvCtxName='c')
+    doc = build(module, [
+        mo('fvTenant', 'uni/tn-a'),
+        mo('fvBD', 'uni/tn-a/BD-b', children=[existing]),
+        mo('fvSubnet', 'uni/tn-a/BD-b/subnet-[10.0.0.1/24]', ip='10.0.0.1/24'),
+    ])
+    assert doc['totalCount'] == '1'
+    tenant = doc['imdata'][0]['fvTenant']
+    bd = tenant['children'][0]['fvBD']
+    assert bd['attributes'] == {'dn': 'uni/tn-a/BD-b'}
+    # Constructed children first, then the ones the item already had.
+    assert [list(c)[0] for c in bd['children']] == ['fvSubnet', 'fvRsCtx']
+    assert bd['children'][1] == existing
+
+
+def test_export_tree_deep_tree(make_nae):
+    module = make_nae()
+    # Deeper than the recursion limit, the export must not recurse.
+    depth = 1500
+    items = [mo('fvTenant', 'uni/tn-a')]
+    dn = 'uni/tn-a'
+    for i in range(depth):
+        dn += '/ap-%d' % i
+        items.append(mo('fvAp', dn))
+    dn_index = {}
+    tree = module.construct_tree(items, dn_index, {})
+    out = io.StringIO()
+    module.export_tree(module.find_tree_roots(tree), out)
+    text = out.getvalue()
+    assert text.count('{"fvAp": ') == depth
+    assert text.endswith('}}' + ']}}' * depth + ']}')
+
+
+def test_parsed_payload_unsupported_object(make_nae, tmp_path):
+    path = tmp_path / 'dump.json'
+    path.write_text(json.dumps([mo('fvTenant', 'uni/tn-a'), mo('fooBar', 'uni/tn-a/zz-q')]))
+    module = make_nae()
+    with pytest.raises(AnsibleFailJson) as exc:
+        module.get_parsed_payload(str(path))
+    assert exc.value.args[0]['unsupported_dn'] == 'uni/tn-a/zz-q'
+    # fail_json sanitizes params, they must stay plain data.
+    json.dumps(module.params)
+
+
+# Pre-change payload cache (user-009)
+
+def write_dump(tmp_path, name='dump.json'):
+    path = tmp_path / name
+    path.write_text(json.dumps([mo('fvTenant', 'uni/tn-a'), mo('fvBD', 'uni/tn-a/BD-b')]))
+    return str(path)
+
+
+def test_parsed_payload_cache_hit(make_nae, tmp_path, monkeypatch):
+    filename = write_dump(tmp_path)
+    module = make_nae()
+    cached = module.get_parsed_payload(filename)
+    assert cached.startswith(str(tmp_path / 'cache' / 'prechange'))
+    with open(cached) as f:
+        assert json.load(f)['imdata'][0]['fvTenant']['children'][0]['fvBD']
+    os.utime(cached, (0, 0))
+
+    def construct_tree(*args):
+        raise AssertionError('parsed again')
+    monkeypatch.setattr(module, 'construct_tree', construct_tree)
+    assert module.get_parsed_payload(filename) == cached
+    # A hit counts as a use for pruning.
+    assert os.stat(cached).st_mtime > 0
+
+
+def test_parsed_payload_keyed_by_class_registry(make_nae, tmp_path):
+    filename = write_dump(tmp_path)
+    module = make_nae()
+    cached = module.get_parsed_payload(filename)
+    module.aci_classes.update({'zz': 'fooBar'})
+    assert module.get_parsed_payload(filename) != cached
+
+
+def test_parsed_payload_failed_export_leaves_no_file(make_nae, tmp_path, monkeypatch):
+    filename = write_dump(tmp_path)
+    module = make_nae()
+
+    def export_tree(roots, fh):
+        fh.write('{"totalCount"')
+        raise IOError('disk full')
+    monkeypatch.setattr(module, 'export_tree', export_tree)
+    with pytest.raises(IOError):
+        module.get_parsed_payload(filename)
+    assert os.listdir(str(tmp_path / 'cache' / 'prechange')) == []
+
+
+def test_prune_cache_dir(tmp_path):
+    now = time.time()
+    for name, age, size in [('old.json', 100, 1), ('a.json', 1, 10), ('b.json', 2, 10),
+                            ('c.json', 3, 10), ('run.tmp', 1, 50), ('stale.tmp', 100, 1)]:
+        path = tmp_path / name
+        path.write_bytes(b'x' * size)
+        os.utime(str(path), (now - age, now - age))
+    nae.prune_cache_dir(str(tmp_path), max_age=50, max_bytes=20)
+    # Expired files go, then the least recently used over the size bound.
+    assert sorted(os.listdir(str(tmp_path))) == ['a.json', 'b.json', 'run.tmp']
+
+
+# Upload completion (user-010)
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(nae, 'time', clock)
+    return clock
+
+
+def test_wait_for_immediate(clock):
+    assert wait_for(lambda: 'done', 10) == 'done'
+    assert clock.sleeps == []
+
+
+def test_wait_for_backoff(clock):
+    results = iter([None] * 6 + [0])
+    assert wait_for(lambda: next(results), None, initial_delay=1, max_delay=8, jitter=0) == 0
+    assert clock.sleeps == [1, 2, 4, 8, 8, 8]
+
+
+def test_wait_for_timeout(clock):
+    calls = []
+
+    def probe():
+        calls.append(clock.now)
+        return None
+    assert wait_for(probe, 10, initial_delay=4, max_delay=30, jitter=0) is None
+    assert clock.sleeps == [4, 6]
+    assert calls == [1000.0, 1004.0, 1010.0]
+
+
+def test_wait_for_jitter(clock, monkeypatch):
+    monkeypatch.setattr(nae.random, 'uniform', lambda low, high: high)
+    results = iter([None, None, True])
+    assert wait_for(lambda: next(results), None, initial_delay=2, jitter=0.25)
+    assert clock.sleeps == [2.5, 5.0]
+
+
+def test_complete_upload_polls_file_list(make_nae, transport, clock):
+    statuses = iter(['UPLOADING', 'UPLOADING', 'UPLOAD_COMPLETED'])
+    transport.route('POST', r'/upload-file/u-1/complete$', lambda url, headers: (
+        400, {'messages': [{'message': 'timeout'}]}))
+    transport.route('GET', r'/upload-file\?', lambda url, headers: (200, page([
+        {'uuid': 'u-0', 'status': 'UPLOAD_COMPLETED'},
+        {'uuid': 'u-1', 'status': next(statuses)}])))
+    module = make_nae(wait_timeout=60)
+    module.login()
+    uuid = module.complete_upload('https://nae/nae/api/v1/file-services/upload-file/u-1/complete')
+    assert uuid == 'u-1'
+    assert len(clock.sleeps) == 2
+    assert not [url for method, url, headers in transport.calls if re.search(r'/upload-file/u-1$', url)]
+
+
+# Concurrent requests (user-011)
+
+def test_send_concurrent_relogin_logs_in_once(make_nae, transport, tmp_path):
+    threads = 8
+    barrier = threading.Barrier(threads, timeout=5)
+
+    def thing(url, headers):
+        if transport.authorized(headers):
+            return 200, page([])
+        # Every thread is rejected with the stale token before anyone logs in.
+        barrier.wait()
+        return 401, {'messages': [{'message': 'denied'}]}
+    cache_session(tmp_path, 'stale')
+    transport.route('GET', r'/thing$', thing)
+    module = make_nae(session_cache=True)
+    statuses = []
+
+    def worker():
+        resp, auth = module.send('https://nae:443/nae/api/v1/thing')
+        statuses.append(auth['status'])
+    workers = [threading.Thread(target=worker) for i in range(threads)]
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    assert statuses == [200] * threads
+    assert transport.logins == 1
+
+
+def test_iter_tcam_pages_in_page_order(make_nae, transport):
+    pages = 10
+
+    def tcam(url, headers):
+        number = int(re.search(r'\$page=(\d+)', url).group(1))
+        # Later pages answer first.
+        time.sleep((pages - number) * 0.005)
+        body = page([number], has_more_data=number < pages - 1)
+        body['value']['data_summary']['total_count'] = 95
+        return 200, body
+    transport.route('GET', r'/hitcount-by-epgpair-contract-filter\?', tcam)
+    module = make_nae(ag_name='ag', tcam_page_size=10, tcam_workers=4)
+    module.get_assurance_group = lambda name: {'uuid': 'fab'}
+    assert list(module.iter_tcam_pages(epoch_id='e1')) == [[i] for i in range(pages)]
+    assert len([c for c in transport.calls if '$page=' in c[1]]) == pages
+
+
+# TcamDataset (user-013)
+
+def tcam_item(contract, epg, tcam, hits, month='absent'):
+    output = {'tcam_entry_count': tcam, 'cumulative_count': hits}
+    if month != 'absent':
+        output['month_count'] = month
+    bucket = dict((key, {'dn': 'uni/tn-a/%s-%s' % (key, contract if key == 'contract' else epg)})
+                  for key in TcamDataset.KEYS)
+    return {'bucket': bucket, 'output': output}
+
+
+def tcam_dataset(seed=0, rows=2000):
+    rng = random.Random(seed)
+    items = [tcam_item(rng.randrange(20), rng.randrange(30), rng.randrange(50), rng.choice([0, rng.randrange(10 ** 6)]),
+                      rng.choice(['absent', None, rng.randrange(1000)]))
+            for dummy in range(rows)]
+    dataset = TcamDataset()
+    dataset.add_page(items[:rows // 2])
+    dataset.add_page(items[rows // 2:])
+    return dataset
+
+
+def decoded(dataset, groups, keys):
+    return sorted((dict(g, **dict((k, dataset.dns[g[k]]) for k in keys)) for g in groups),
+                  key=lambda g: tuple(g[k] for k in keys))
+
+
+def test_tcam_missing_and_null_month_count():
+    dataset = TcamDataset()
+    dataset.add_page([tcam_item('a', 'x', 1, 0), tcam_item('a', 'x', 1, 0, None), tcam_item('a', 'x', 1, 0, 3)])
+    assert list(dataset.columns['month_count']) == [-1, -1, 3]
+    assert dataset.row(0)['month_count'] == "N/A"
+    assert nae.tcam_row(tcam_item('a', 'x', 1, 0, None))[1] == (1, 0, -1)
+
+
+@pytest.mark.parametrize('has_numpy', [False, True])
+def test_tcam_group_by(monkeypatch, has_numpy):
+    if has_numpy:
+        pytest.importorskip('numpy')
+    monkeypatch.setattr(nae, 'HAS_NUMPY', has_numpy)
+    dataset = TcamDataset()
+    dataset.add_page([tcam_item('a', 'x', 2, 10, 1), tcam_item('a', 'y', 3, 0), tcam_item('b', 'x', 6, 5, 2)])
+    assert dataset.group_by('contract') == [
+        {'contract': 'tn-a/contract-b', 'rules': 1, 'tcam_entry_count': 6, 'cumulative_count': 5, 'month_count': 2},
+        {'contract': 'tn-a/contract-a', 'rules': 2, 'tcam_entry_count': 5, 'cumulative_count': 10, 'month_count': 1},
+    ]
+    assert [g['contract'] for g in dataset.group_by('contract', sort_by='cumulative_count')] == [
+        'tn-a/contract-a', 'tn-a/contract-b']
+
+
+def test_tcam_group_by_sort_and_top():
+    dataset = tcam_dataset()
+    groups = dataset.group_by('epg_pair', sort_by='cumulative_count', top=5)
+    assert len(groups) == 5
+    counts = [g['cumulative_count'] for g in groups]
+    assert counts == sorted(counts, reverse=True)
+    assert all(isinstance(g['provider_epg'], str) for g in groups)
+
+
+@pytest.mark.parametrize('group', sorted(TcamDataset.GROUPS))
+def test_tcam_group_by_numpy_matches_loop(group):
+    pytest.importorskip('numpy')
+    dataset = tcam_dataset(seed=len(group))
+    keys = TcamDataset.GROUPS[group]
+    assert decoded(dataset, dataset._group_by_numpy(keys), keys) == decoded(dataset, dataset._group_by_loop(keys), keys)
+
+
+def test_tcam_group_by_numpy_large_sums():
+    pytest.importorskip('numpy')
+    dataset = TcamDataset()
+    dataset.add_page([tcam_item('a', 'x', 1, 2 ** 60 + 1), tcam_item('a', 'y', 1, 2 ** 60 + 3)])
+    keys = TcamDataset.GROUPS['contract']
+    numpy_groups = dataset._group_by_numpy(keys)
+    assert numpy_groups == dataset._group_by_loop(keys)
+    assert numpy_groups[0]['cumulative_count'] == 2 ** 61 + 4
+
+
+def test_tcam_zero_hit(monkeypatch):
+    dataset = TcamDataset()
+    dataset.add_page([tcam_item('a', 'x', 2, 0), tcam_item('b', 'x', 9, 0), tcam_item('c', 'x', 5, 1)])
+    expected = ['tn-a/contract-b', 'tn-a/contract-a']
+    assert [r['contract'] for r in dataset.zero_hit()] == expected
+    monkeypatch.setattr(nae, 'HAS_NUMPY', False)
+    assert [r['contract'] for r in dataset.zero_hit()] == expected
+    assert [r['contract'] for r in dataset.zero_hit(top=1)] == expected[:1]
+
+
+def test_tcam_empty():
+    dataset = TcamDataset()
+    assert dataset.group_by('contract') == []
+    assert dataset.zero_hit() == []
+
+
+# UploadManifest (user-016)
+
+@pytest.fixture
+def upload_source(tmp_path):
+    source = tmp_path / 'epoch.tar.gz'
+    source.write_bytes(b'x' * 100)
+    return str(source)
+
+
+def test_upload_manifest_round_trip(tmp_path, upload_source):
+    cache = str(tmp_path / 'cache')
+    manifest = UploadManifest(cache, 'nae', 443, 'upload', upload_source)
+    assert not manifest.load()
+    manifest.start('/api/chunk', 10)
+    manifest.ack(0, 0, 10, 'c0')
+    manifest.ack(3, 30, 10, 'c3', complete_url='/api/complete')
+
+    resumed = UploadManifest(cache, 'nae', 443, 'upload', upload_source)
+    assert resumed.load()
+    assert resumed.entry['chunk_url'] == '/api/chunk'
+    assert resumed.entry['chunk_size'] == 10
+    assert resumed.entry['complete_url'] == '/api/complete'
+    assert resumed.acked(0) and resumed.acked(3) and not resumed.acked(1)
+    assert resumed.entry['chunks']['3'] == dict(offset=30, size=10, checksum='c3')
+    assert not [f for f in os.listdir(os.path.dirname(resumed.path)) if f.endswith('.tmp')]
+
+    resumed.drop()
+    assert not UploadManifest(cache, 'nae', 443, 'upload', upload_source).load()
+    resumed.drop()
+
+
+def test_upload_manifest_keyed_by_source(tmp_path, upload_source):
+    cache = str(tmp_path / 'cache')
+    UploadManifest(cache, 'nae', 443, 'upload', upload_source).start('/api/chunk', 10)
+    assert not UploadManifest(cache, 'nae', 443, 'other', upload_source).load()
+    assert not UploadManifest(cache, 'other', 443, 'upload', upload_source).load()
+    with open(upload_source, 'ab') as f:
+        f.write(b'more')
+    assert not UploadManifest(cache, 'nae', 443, 'upload', upload_source).load()
+
+
+def test_upload_manifest_corrupt(tmp_path, upload_source):
+    manifest = UploadManifest(str(tmp_path), 'nae', 443, 'upload', upload_source)
+    os.makedirs(os.path.dirname(manifest.path))
+    with open(manifest.path, 'w') as f:
+        f.write('{"chunk_url": ')
+    assert not manifest.load()
+    assert manifest.entry is None
+
+
+
+# Lazy pagination (user-019)
+
+def paged_files(transport, pages):
+    def files(url, headers):
+        number = int(re.search(r'\$page=(\d+)', url).group(1))
+        return 200, page(pages[number], has_more_data=number < len(pages) - 1)
+    transport.route('GET', r'/file-services/upload-file\?', files)
+
+
+def file_pages(transport):
+    return [int(re.search(r'\$page=(\d+)', c[1]).group(1)) for c in transport.calls if '/upload-file?' in c[1]]
+
+
+def test_iter_pages_walks_all_pages(make_nae, transport):
+    paged_files(transport, [[{'uuid': 'a'}], [{'uuid': 'b'}], [{'uuid': 'c'}]])
+    module = make_nae(page_size=1)
+    assert module.get_all_files() == [[{'uuid': 'a'}], [{'uuid': 'b'}], [{'uuid': 'c'}]]
+    assert file_pages(transport) == [0, 1, 2]
+    assert all('$size=1' in c[1] for c in transport.calls if '/upload-file?' in c[1])
+
+
+def test_find_item_stops_at_first_hit(make_nae, transport):
+    paged_files(transport, [[{'uuid': 'a'}], [{'uuid': 'b', 'unique_name': 'x'}], [{'uuid': 'c'}]])
+    module = make_nae(page_size=1)
+    assert module.find_uploaded_file(uuid='b')['unique_name'] == 'x'
+    assert file_pages(transport) == [0, 1]
+
+
+# Offline analysis batch (user-020)
+
+def test_offline_batch_isolates_failed_entries(make_nae, transport, tmp_path, monkeypatch):
+    monkeypatch.chdir(str(tmp_path))
+    good = tmp_path / 'good.tgz'
+    good.write_bytes(b'epoch')
+    transport.route('GET', r'/file-services/upload-file\?', lambda url, headers: (200, page([])))
+    analysed = []
+
+    def upload_file(self):
+        # The real upload reads the file before sending anything.
+        os.stat(self.params['file'])
+    monkeypatch.setattr(NAEModule, 'upload_file', upload_file)
+    monkeypatch.setattr(NAEModule, 'isOnDemandAnalysis', lambda self: None)
+    monkeypatch.setattr(NAEModule, 'isLiveAnalysis', lambda self: None)
+    monkeypatch.setattr(NAEModule, 'newOfflineAnalysis', lambda self: analysed.append(self.params['name']))
+    status_file = tmp_path / 'status.jsonl'
+    module = make_nae(batch=[{'file': str(tmp_path / 'missing.tgz')}, {'file': str(good), 'name': 'good'}],
+                      batch_workers=2, batch_status_file=str(status_file), wait_timeout=10)
+    with pytest.raises(AnsibleFailJson) as exc:
+        module.offline_batch()
+    result = exc.value.args[0]
+    assert result['msg'] == 'Batch entries failed: missing.tgz'
+    missing, ok = result['batch']
+    assert (missing['stage'], missing['status']) == ('upload', 'failed')
+    assert 'missing.tgz' in missing['msg']
+    assert (ok['stage'], ok['status']) == ('analysis', 'ok')
+    assert analysed == ['good']
+    assert len(status_file.read_text().splitlines()) == 3
+
+
+# EpochIndex (user-021)
+
+# 2020-09-13T12:26:40Z
+BASE = 1600000000
+
+
+def epoch(epoch_id, seconds):
+    return {'epoch_id': epoch_id, 'collection_timestamp': (BASE + seconds) * 1000}
+
+
+EPOCHS = [epoch('e3', 3000), epoch('e1', 1000), epoch('e2', 2000)]
+
+
+def test_epoch_index_orders_by_timestamp(tmp_path):
+    index = EpochIndex(str(tmp_path), 'nae', 443, 'fab')
+    index.update(EPOCHS)
+    assert [e['epoch_id'] for e in index.epochs] == ['e1', 'e2', 'e3']
+    assert index.latest()['epoch_id'] == 'e3'
+    assert index.previous()['epoch_id'] == 'e2'
+    assert index.previous(2)['epoch_id'] == 'e1'
+    assert index.previous(3) is None
+    assert index.previous(-1) is None
+
+
+def test_epoch_index_merge_and_persist(tmp_path):
+    index = EpochIndex(str(tmp_path), 'nae', 443, 'fab')
+    index.update(EPOCHS[:2])
+    index.update([epoch('e1', 1000), epoch('e4', 4000)])
+    assert [e['epoch_id'] for e in index.epochs] == ['e1', 'e3', 'e4']
+    index.save()
+    loaded = EpochIndex(str(tmp_path), 'nae', 443, 'fab')
+    assert loaded.load()
+    assert loaded.epochs == index.epochs
+    assert not EpochIndex(str(tmp_path), 'nae', 443, 'other').load()
+
+
+def test_epoch_index_at_or_before(tmp_path):
+    index = EpochIndex(str(tmp_path), 'nae', 443, 'fab')
+    index.update(EPOCHS)
+    assert index.at_or_before((BASE + 1000) * 1000 - 1) is None
+    assert index.at_or_before((BASE + 1000) * 1000)['epoch_id'] == 'e1'
+    assert index.at_or_before((BASE + 2500) * 1000)['epoch_id'] == 'e2'
+    assert index.at_or_before(10 ** 14)['epoch_id'] == 'e3'
+
+
+def test_epoch_index_rejects_missing_timestamp(tmp_path):
+    index = EpochIndex(str(tmp_path), 'nae', 443, 'fab')
+    with pytest.raises(ValueError, match='e9'):
+        index.update(EPOCHS + [{'epoch_id': 'e9'}])
+    assert index.epochs == []
+
+
+# resolve_epoch (user-022)
+
+@pytest.fixture
+def resolver(make_nae, tmp_path):
+    index = EpochIndex(str(tmp_path), 'nae', 443, 'fab')
+    index.update(EPOCHS)
+    module = make_nae()
+    module.get_epoch_index = lambda: index
+    return module
+
+
+@pytest.mark.parametrize('selector, expected', [
+    ('e2', 'e2'),
+    ('0', 'e3'),
+    (0, 'e3'),
+    ('-1', 'e2'),
+    ('-2', 'e1'),
+    ('-3', None),
+    (str(BASE + 2500), 'e2'),
+    (str((BASE + 2500) * 1000), 'e2'),
+    (str(BASE + 999), None),
+    ('2020-09-13T13:20:00', 'e3'),
+    ('2020-09-13T13:05:00Z', 'e2'),
+    ('2020-09-13T15:05:00+02:00', 'e2'),
+    ('2020-09-13T12:00:00Z', None),
+    ('not an epoch', None),
+])
+def test_resolve_epoch(resolver, selector, expected):
+    epoch = resolver.resolve_epoch(selector)
+    assert (epoch and epoch['epoch_id']) == expected
+
+
+# diff_smart_events (user-024)
+
+def event_row(mnemonic, status, before=None, after=None, count=1):
+    row = {'mnemonic': mnemonic, 'category': 'SYSTEM', 'count': count, 'epoch_status': status}
+    if before:
+        row['epoch1_details'] = before
+    if after:
+        row['epoch2_details'] = after
+    return row
+
+
+def test_diff_smart_events():
+    major = 'EVENT_SEVERITY_MAJOR'
+    rows = [
+        event_row('A', 'BOTH_EPOCHS', {'severity': major, 'count': 2}, {'severity': major, 'count': 2}),
+        event_row('B', 'BOTH_EPOCHS', {'severity': major, 'count': 1}, {'severity': major, 'count': 5}),
+        event_row('C', 'EPOCH2_ONLY', after={'severity': 'EVENT_SEVERITY_CRITICAL', 'count': 1}),
+        event_row('D', 'EPOCH1_ONLY', before={'severity': 'EVENT_SEVERITY_MINOR', 'count': 1}),
+    ]
+    diff = diff_smart_events(iter(rows))
+    assert [e['mnemonic'] for e in diff['added']] == ['C']
+    assert [e['mnemonic'] for e in diff['removed']] == ['D']
+    assert [e['mnemonic'] for e in diff['unchanged']] == ['A']
+    assert diff['count_changed'] == [{'mnemonic': 'B', 'category': 'SYSTEM', 'severity': major,
+                                      'count': 5, 'prior_count': 1}]
+    summary = diff['summary']
+    assert (summary['added'], summary['removed'], summary['count_changed'], summary['unchanged']) == (1, 1, 1, 1)
+    assert summary['by_severity'][major] == dict(added=0, removed=0, count_changed=1, unchanged=1)
+
+
+def test_diff_smart_events_never_matches_across_rows():
+    # Events resolved in the prior epoch and raised again in the later
+    # one are distinct rows, the new ones are still added.
+    major = 'EVENT_SEVERITY_MAJOR'
+    rows = [
+        event_row('X', 'EPOCH1_ONLY', before={'severity': major, 'count': 3}, count=3),
+        event_row('X', 'EPOCH2_ONLY', after={'severity': major, 'count': 2}, count=2),
+    ]
+    diff = diff_smart_events(rows)
+    assert [(e['mnemonic'], e['count']) for e in diff['removed']] == [('X', 3)]
+    assert [(e['mnemonic'], e['count']) for e in diff['added']] == [('X', 2)]
+    assert diff['count_changed'] == diff['unchanged'] == []
+
+
+def test_diff_smart_events_side_from_status():
+    # The status decides the side, whatever details the row carries, and
+    # the count comes from that side only.
+    row = event_row('A', 'EPOCH2_ONLY', before={'severity': 'EVENT_SEVERITY_MAJOR', 'count': 4},
+                    after={'severity': 'EVENT_SEVERITY_MAJOR', 'count': 4}, count=4)
+    diff = diff_smart_events([row])
+    assert [e['count'] for e in diff['added']] == [4]
+    assert diff['unchanged'] == []
+    row = event_row('B', 'BOTH_EPOCHS', {'severity': 'EVENT_SEVERITY_MAJOR'},
+                    {'severity': 'EVENT_SEVERITY_MAJOR', 'count': 2}, count=2)
+    assert diff_smart_events([row])['count_changed'][0]['prior_count'] == 0
+
+
+def test_diff_smart_events_unknown_status():
+    with pytest.raises(ValueError, match='SOMETIMES'):
+        diff_smart_events([event_row('A', 'SOMETIMES')])
+
+
+def test_diff_smart_events_empty():
+    diff = diff_smart_events([])
+    assert diff['summary'] == dict(added=0, removed=0, count_changed=0, unchanged=0, by_severity={})
+
+
+def test_gate_smart_event_diff_fails_on_reraised_events(make_nae, transport):
+    major = 'EVENT_SEVERITY_MAJOR'
+    transport.route('GET', r'/job/j1/health/view/aggregate-table\?', lambda url, headers: (200, page([
+        event_row('X', 'EPOCH1_ONLY', before={'severity': major, 'count': 3}, count=3),
+        event_row('X', 'EPOCH2_ONLY', after={'severity': major, 'count': 2}, count=2),
+    ])))
+    module = make_nae(fabric_id='fab', name='check')
+    with pytest.raises(AnsibleFailJson) as exc:
+        module.gate_smart_event_diff('j1', 'Pre-change analysis')
+    assert [e['count'] for e in exc.value.args[0]['New Smart Events']] == [2]
+
+
+# gate_pre_change_result (user-025)
+
+def capped_aggregate_table(transport, rows, cap=2):
+    """
+    Serve rows from the aggregate table, at most cap per page whatever
+    $size asks for.
+    """
+    def table(url, headers):
+        number = int(re.search(r'\$page=(\d+)', url).group(1))
+        return 200, page(rows[number * cap:(number + 1) * cap], has_more_data=(number + 1) * cap < len(rows))
+    transport.route('GET', r'/job/j1/health/view/aggregate-table\?', table)
+
+
+def table_pages(transport):
+    return [int(re.search(r'\$page=(\d+)', c[1]).group(1)) for c in transport.calls if 'aggregate-table' in c[1]]
+
+
+def gate_row(mnemonic, severity, count=1):
+    return event_row(mnemonic, 'EPOCH2_ONLY', after={'severity': severity, 'count': count}, count=count)
+
+
+def test_gate_pre_change_result_reads_past_capped_pages(make_nae, transport):
+    rows = [gate_row('A', 'EVENT_SEVERITY_MAJOR', count=0)] * 5 + [gate_row('B', 'EVENT_SEVERITY_CRITICAL')]
+    capped_aggregate_table(transport, rows)
+    module = make_nae(fabric_id='fab', name='check', gate_severity='major', gate_sample=5)
+    with pytest.raises(AnsibleFailJson) as exc:
+        module.gate_pre_change_result('j1')
+    result = exc.value.args[0]
+    assert [r['mnemonic'] for r in result['Later Epoch Smart Events']] == ['B']
+    assert result['gate'] == dict(severity='EVENT_SEVERITY_MAJOR', passed=False, sample=1, sample_limit=5)
+    assert table_pages(transport) == [0, 1, 2, 3]
+    url = [c[1] for c in transport.calls if 'aggregate-table' in c[1]][0]
+    assert 'epoch_status=EPOCH2_ONLY' in url
+    assert 'severity=EVENT_SEVERITY_CRITICAL,EVENT_SEVERITY_MAJOR&' in url
+
+
+def test_gate_pre_change_result_stops_at_sample(make_nae, transport):
+    capped_aggregate_table(transport, [gate_row(m, 'EVENT_SEVERITY_CRITICAL') for m in 'ABCDEF'])
+    module = make_nae(fabric_id='fab', name='check', gate_severity='critical', gate_sample=3)
+    with pytest.raises(AnsibleFailJson) as exc:
+        module.gate_pre_change_result('j1')
+    assert [r['mnemonic'] for r in exc.value.args[0]['Later Epoch Smart Events']] == ['A', 'B', 'C']
+    assert table_pages(transport) == [0, 1]
+
+
+def test_gate_pre_change_result_passes(make_nae, transport):
+    capped_aggregate_table(transport, [])
+    module = make_nae(fabric_id='fab', name='check', gate_severity='minor', gate_sample=5)
+    assert module.gate_pre_change_result('j1') == "Pre-change analysis 'check' passed."
+    assert module.result['gate']['passed']
+    assert table_pages(transport) == [0]